@@ -0,0 +1,33 @@
+"""
+A bounded thread pool for CPU-heavy or blocking work started by async views,
+such as laying out PDFs.
+
+``run_blocking`` keeps that work off the event loop without letting it take
+an unbounded number of threads: at most ``BLOCKING_WORKERS`` jobs run at
+once (per process), and the rest wait their turn while the loop goes on
+serving quick requests.
+
+Work sent to the pool must not touch the database. Django connections
+belong to the thread that opened them, so queries made from a pool thread
+would run outside the request's connection (and transaction). Load the data
+first, on the request's own thread (the async ORM or ``sync_to_async``), and
+hand only the rendering to the pool.
+"""
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+DEFAULT_BLOCKING_WORKERS = 4
+
+
+@functools.cache
+def executor():
+    workers = getattr(settings, 'BLOCKING_WORKERS', DEFAULT_BLOCKING_WORKERS)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix='blocking')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run ``func(*args, **kwargs)`` in the bounded pool and return its result."""
+    return await sync_to_async(func, thread_sensitive=False, executor=executor())(*args, **kwargs)
@@ -0,0 +1,145 @@
+"""
+Dashboard metrics for the home page, kept in Django's cache.
+
+A write that affects the metrics (a sale, a product change or a stock
+update) queues a ``dashboard.refresh`` job once it commits, and the job
+worker recomputes them (three aggregate queries) ``REFRESH_DELAY`` later.
+Pending refreshes coalesce, so a burst of checkouts costs one
+recomputation instead of one each, and none of it runs on the checkout
+request. Pages showing the metrics just read the cache. Each snapshot
+records when it was computed, so the page can say how fresh it is. A cold
+cache, or the first read of a new day, recomputes it inline.
+
+``metric_events`` streams the metrics to open dashboards as Server-Sent
+Events. A refresh is published to the broker of the process that ran it,
+and web processes pick up the worker's refreshes from the cache every
+``LIVE_POLL_INTERVAL`` seconds; either way it is fanned out from the
+broker, so open dashboards add no queries. Every client gets only the
+metrics that changed since its last event.
+"""
+import asyncio
+import json
+import logging
+from datetime import datetime, time, timedelta
+
+from asgiref.local import Local
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.utils import timezone
+
+from inventory.live import broker
+
+logger = logging.getLogger(__name__)
+
+CACHE_KEY = 'dashboard:metrics'
+# An upper bound on staleness should a refresh ever be missed
+CACHE_TIMEOUT = 15 * 60
+# Changes within this window are covered by a single refresh
+REFRESH_DELAY = timedelta(seconds=2)
+
+LIVE_CHANNEL = 'dashboard'
+# How often each process checks the cache for refreshes made by other processes
+LIVE_POLL_INTERVAL = 5
+# Comment lines sent on idle streams so proxies keep them open
+LIVE_HEARTBEAT = 15
+
+_pending = Local()
+
+
+def compute_metrics(day=None):
+    # Imported here: products.models reports its stock changes to this module
+    from products.models import Product
+    from sales.models import Sale
+    from statement.models import ProductDailySales
+
+    day = day or timezone.localdate()
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    products = Product.objects.aggregate(
+        total_products=Count('pk'),
+        low_stock_count=Count('pk', filter=Q(needs_restock=True)),
+        total_stock=Sum('quantity'),
+    )
+    sales = ProductDailySales.objects.filter(date=day).aggregate(
+        total_income=Sum(F('regular_revenue') + F('bulk_revenue') + F('dozen_revenue')),
+        items_sold=Sum('units_sold'),
+    )
+    return {
+        'date': day,
+        'total_products': products['total_products'],
+        'low_stock_count': products['low_stock_count'],
+        'total_stock': products['total_stock'] or 0,
+        'today_sales': Sale.objects.filter(sale_date__gte=start, sale_date__lt=start + timedelta(days=1)).count(),
+        'total_income': sales['total_income'] or 0,
+        'items_sold': sales['items_sold'] or 0,
+        'computed_at': timezone.now(),
+    }
+
+
+def refresh_dashboard():
+    """Recompute the metrics and store them in the cache."""
+    metrics = compute_metrics()
+    cache.set(CACHE_KEY, metrics, CACHE_TIMEOUT)
+    broker.publish(LIVE_CHANNEL, metrics)
+    return metrics
+
+
+def dashboard_metrics():
+    """Today's metrics, from the cache unless they are missing or from another day."""
+    metrics = cache.get(CACHE_KEY)
+    if metrics is None or metrics['date'] != timezone.localdate():
+        metrics = refresh_dashboard()
+    return metrics
+
+
+def dashboard_changed():
+    """
+    Queue a refresh of the metrics once the current transaction commits
+    (right away outside one). Several changes in one transaction queue one
+    refresh, and a refresh already waiting to run covers them too.
+    """
+    _pending.stale = True
+    transaction.on_commit(flush_dashboard)
+
+
+def flush_dashboard():
+    # Imported here: jobs.models is loaded after the apps that report changes
+    from jobs.models import Job
+
+    # The first callback queues the refresh; the rest of the transaction's find nothing to do
+    if not getattr(_pending, 'stale', False):
+        return
+    _pending.stale = False
+    try:
+        Job.enqueue('dashboard.refresh', key='dashboard', delay=REFRESH_DELAY)
+    except Exception as e:
+        logger.error(f"Error queueing the dashboard refresh: {str(e)}")
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+async def metric_events():
+    """
+    Server-Sent Events for a dashboard: the current metrics, then the
+    metrics that changed whenever they are refreshed.
+    """
+    loop = asyncio.get_running_loop()
+    async with broker.subscribe(LIVE_CHANNEL) as subscription:
+        broker.watch(LIVE_CHANNEL, sync_to_async(dashboard_metrics), LIVE_POLL_INTERVAL)
+        sent = {}
+        metrics = await sync_to_async(dashboard_metrics)()
+        last_write = loop.time()
+        while True:
+            changed = {name: value for name, value in (metrics or {}).items() if sent.get(name) != value}
+            if changed:
+                sent.update(changed)
+                yield sse_event('metrics', changed)
+                last_write = loop.time()
+            elif loop.time() - last_write >= LIVE_HEARTBEAT:
+                yield ": keepalive\n\n"
+                last_write = loop.time()
+            metrics = await subscription.get(timeout=LIVE_HEARTBEAT)
@@ -0,0 +1,81 @@
+import csv
+import io
+import itertools
+
+from asgiref.sync import sync_to_async
+from django.http import StreamingHttpResponse
+
+# Rows fetched from the database per round trip, and written per chunk sent
+EXPORT_CHUNK_SIZE = 2000
+
+
+def stream_csv(filename, header, rows, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Return a streaming CSV download of ``rows``.
+
+    ``rows`` is consumed lazily while the response is sent, so pass an
+    iterator such as ``queryset.values_list(...).iterator()`` to keep memory
+    use constant however large the export is. Under ASGI pass an async
+    iterator (see ``aqueryset_rows``): the server would otherwise read a
+    synchronous one into memory in full before sending it.
+    """
+    if hasattr(rows, '__aiter__'):
+        chunks = _acsv_chunks(header, rows, chunk_size)
+    else:
+        chunks = _csv_chunks(header, rows, chunk_size)
+    response = StreamingHttpResponse(chunks, content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _csv_chunks(header, rows, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+async def _acsv_chunks(header, rows, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+
+    count = 0
+    async for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def queryset_rows(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """Iterate over only the given columns of ``queryset``, fetched in chunks."""
+    return queryset.values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+async def aqueryset_rows(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    ``queryset_rows`` as an async iterator, for exports served over ASGI.
+    Each chunk is fetched on the request's thread: Django's own
+    ``aiterator()`` runs ``values_list()`` queries on the event loop.
+    """
+    rows = queryset_rows(queryset, fields, chunk_size)
+    next_chunk = sync_to_async(lambda: list(itertools.islice(rows, chunk_size)))
+    try:
+        while chunk := await next_chunk():
+            for row in chunk:
+                yield row
+    finally:
+        await sync_to_async(rows.close)()
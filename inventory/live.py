@@ -0,0 +1,104 @@
+"""
+In-process publish/subscribe for live pages (Server-Sent Events).
+
+Each open event stream subscribes to a channel with a one-slot mailbox:
+publishing puts the latest message in every subscriber's mailbox,
+replacing one it hasn't read yet, so a slow client skips to the newest
+state instead of queueing a backlog. ``publish`` may be called from any
+thread (for instance a WSGI worker, or sync code running under ASGI);
+the messages are handed to each subscriber's event loop.
+
+Publishing only reaches subscribers in the same process. Producers in
+other processes are picked up by ``watch``, which runs a single poller
+per channel and process while anyone is subscribed.
+"""
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    def __init__(self, loop):
+        self.loop = loop
+        self.mailbox = asyncio.Queue(maxsize=1)
+
+    def deliver(self, message):
+        # Runs on the subscriber's loop
+        if self.mailbox.full():
+            self.mailbox.get_nowait()
+        self.mailbox.put_nowait(message)
+
+    async def get(self, timeout=None):
+        """The next message, or None if none arrives within ``timeout`` seconds."""
+        try:
+            return await asyncio.wait_for(self.mailbox.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Broker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = {}  # channel -> set of subscriptions
+        self._watchers = {}  # channel -> poller task
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        subscription = Subscription(asyncio.get_running_loop())
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                subscribers = self._channels.get(channel, set())
+                subscribers.discard(subscription)
+                if not subscribers:
+                    self._channels.pop(channel, None)
+                    watcher = self._watchers.pop(channel, None)
+                    if watcher is not None:
+                        watcher.cancel()
+
+    def publish(self, channel, message):
+        """Fan ``message`` out to the channel's subscribers; returns how many there were."""
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, message)
+            except RuntimeError:
+                pass  # The subscriber's loop has closed
+        return len(subscribers)
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._channels.get(channel, ()))
+
+    def watch(self, channel, poll, interval):
+        """
+        While the channel has subscribers, await ``poll()`` every
+        ``interval`` seconds and publish what it returns (unless None).
+        Starts one poller per channel, on the calling loop; call it after
+        subscribing.
+        """
+        with self._lock:
+            if channel in self._watchers or channel not in self._channels:
+                return
+            self._watchers[channel] = asyncio.get_running_loop().create_task(self._poll(channel, poll, interval))
+
+    async def _poll(self, channel, poll, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                message = await poll()
+            except Exception as e:
+                logger.error(f"Error polling live channel {channel}: {str(e)}")
+                continue
+            if message is not None:
+                self.publish(channel, message)
+
+
+broker = Broker()
@@ -0,0 +1,53 @@
+class ChangeTrackingMixin:
+    """
+    Model mixin that remembers the field values an instance was loaded with,
+    so save() can tell which fields changed without reading the row again.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        self._snapshot(fields)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._snapshot(kwargs.get('update_fields'))
+
+    def is_tracked(self):
+        """Whether every field's loaded value is known."""
+        return hasattr(self, '_loaded_values') and not self.get_deferred_fields()
+
+    def get_loaded_value(self, field_name):
+        return self._loaded_values[self._meta.get_field(field_name).attname]
+
+    def get_changed_fields(self):
+        """Names of the loaded fields whose current value differs from the stored one."""
+        loaded = getattr(self, '_loaded_values', {})
+        return {
+            field.name
+            for field in self._meta.concrete_fields
+            if field.attname in loaded and getattr(self, field.attname) != loaded[field.attname]
+        }
+
+    def _snapshot(self, field_names=None):
+        """Record the current values of the given fields (all by default) as stored."""
+        if field_names is None:
+            fields = self._meta.concrete_fields
+            self._loaded_values = {}
+        else:
+            fields = [self._meta.get_field(name) for name in field_names]
+            self._loaded_values = getattr(self, '_loaded_values', {})
+
+        deferred = self.get_deferred_fields()
+        for field in fields:
+            value = self.__dict__.get(field.attname)
+            if field.attname in deferred or hasattr(value, 'resolve_expression'):
+                # Not loaded, or an expression such as F() whose result is unknown
+                self._loaded_values.pop(field.attname, None)
+            else:
+                self._loaded_values[field.attname] = value
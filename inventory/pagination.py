@@ -0,0 +1,159 @@
+import base64
+import binascii
+import datetime
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db.models import Q
+
+# Beyond this many rows, counts on backends without planner estimates stop
+APPROXIMATE_COUNT_CAP = 1000
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """Keep full microsecond precision, which DjangoJSONEncoder truncates."""
+
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+class KeysetPage:
+    def __init__(self, object_list, has_next, has_previous, next_cursor, previous_cursor, count=None, count_label=None):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.count = count
+        self.count_label = count_label
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Seek ("keyset") pagination over a queryset ordered by unique, indexed
+    columns, e.g. ``('name', 'id')`` or ``('-sale_date', '-id')``. Annotations
+    can lead the ordering too, such as a search rank.
+
+    Each page continues from the ordering values of the row before it, carried
+    in an opaque cursor token, so deep pages cost the same as the first one
+    and no COUNT(*) is needed.
+    """
+
+    def __init__(self, queryset, ordering, per_page, with_count=False):
+        self.queryset = queryset.order_by(*ordering)
+        self.ordering = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+        self.per_page = per_page
+        self.with_count = with_count
+
+    def get_page(self, cursor=None):
+        """Return the page for ``cursor`` (the first page if it is missing or invalid)."""
+        position, queryset = self._page_query(cursor)
+        rows = list(queryset)
+        count = approximate_count(self.queryset) if self.with_count else (None, None)
+        return self._build_page(rows, position, count)
+
+    async def aget_page(self, cursor=None):
+        """``get_page`` for async views, fetching the rows with the async ORM."""
+        position, queryset = self._page_query(cursor)
+        rows = [row async for row in queryset]
+        count = await sync_to_async(approximate_count)(self.queryset) if self.with_count else (None, None)
+        return self._build_page(rows, position, count)
+
+    def _page_query(self, cursor):
+        # One row more than a page, to tell whether there is another page
+        position = self.decode_cursor(cursor) if cursor else None
+        if position is None:
+            return None, self.queryset[:self.per_page + 1]
+
+        backwards, values = position
+        queryset = self.queryset.filter(self._seek(values, backwards))
+        if backwards:
+            queryset = queryset.reverse()
+        return position, queryset[:self.per_page + 1]
+
+    def _build_page(self, rows, position, count):
+        backwards = position is not None and position[0]
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        has_next = has_more if not backwards else True
+        has_previous = position is not None and (has_more if backwards else True)
+
+        count, count_label = count
+        return KeysetPage(
+            rows,
+            has_next=has_next and bool(rows),
+            has_previous=has_previous and bool(rows),
+            next_cursor=self.encode_cursor(rows[-1], backwards=False) if rows else None,
+            previous_cursor=self.encode_cursor(rows[0], backwards=True) if rows else None,
+            count=count,
+            count_label=count_label,
+        )
+
+    def _seek(self, values, backwards):
+        """Rows strictly after (or before) ``values`` in the pagination order."""
+        condition = Q(pk__in=[])
+        equal = Q()
+        for (name, descending), value in zip(self.ordering, values):
+            lookup = 'lt' if descending != backwards else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def encode_cursor(self, row, backwards):
+        values = [getattr(row, name) for name, _ in self.ordering]
+        token = json.dumps(['p' if backwards else 'n', values], cls=CursorEncoder)
+        return base64.urlsafe_b64encode(token.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            direction, raw_values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            if direction not in ('n', 'p') or len(raw_values) != len(self.ordering):
+                return None
+            values = [self._field(name).to_python(value) for (name, _), value in zip(self.ordering, raw_values)]
+        except (ValueError, TypeError, binascii.Error, ValidationError):
+            return None
+        return direction == 'p', values
+
+
+    def _field(self, name):
+        """The model field, or the annotation's output field, ordered by ``name``."""
+        annotation = self.queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        return self.queryset.model._meta.get_field('id' if name == 'pk' else name)
+
+
+def approximate_count(queryset, cap=APPROXIMATE_COUNT_CAP):
+    """
+    Return ``(count, label)`` without a full COUNT(*) scan: the planner's row
+    estimate on PostgreSQL, elsewhere an exact count that stops at ``cap``.
+    """
+    queryset = queryset.order_by()
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+        return estimate, f"about {estimate}"
+
+    count = queryset[:cap + 1].count()
+    if count > cap:
+        return cap, f"{cap}+"
+    return count, str(count)
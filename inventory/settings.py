@@ -1,7 +1,7 @@
 import os
 from pathlib import Path
 import dj_database_url
-from decouple import config
+from decouple import Csv, config
 
 
 
@@ -44,6 +44,7 @@ INSTALLED_APPS = [
     'sales',
     'products',
     'statement',
+    'jobs',
 ]
 
 MIDDLEWARE = [
@@ -132,6 +133,29 @@ STATIC_URL = 'static/'
 STATIC_ROOT = BASE_DIR / "staticfiles"
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 
+# The default cache for the whole project, not just the dashboard: anything
+# using django.core.cache goes to files under CACHE_LOCATION, shared by the
+# web and job worker processes of a host. Several hosts need a shared
+# backend instead (CACHE_BACKEND, e.g. Redis or Memcached), since the job
+# worker refreshes the dashboard metrics only in its own host's cache.
+CACHES = {
+    'default': {
+        'BACKEND': config("CACHE_BACKEND", default="django.core.cache.backends.filebased.FileBasedCache"),
+        'LOCATION': config("CACHE_LOCATION", default=str(BASE_DIR / "cache")),
+    }
+}
+
+# Rendered PDF receipts; see sales/receipts.py
+RECEIPT_CACHE_DIR = config("RECEIPT_CACHE_DIR", default=str(BASE_DIR / "receipt_cache"))
+# Cached receipts are deleted this many days after rendering (and rendered again if downloaded)
+RECEIPT_CACHE_MAX_AGE_DAYS = config("RECEIPT_CACHE_MAX_AGE_DAYS", default=90, cast=int)
+# "html" (xhtml2pdf, sales/receipt.html) or "reportlab" (drawn directly, faster)
+RECEIPT_RENDERER = config("RECEIPT_RENDERER", default="html")
+# Comma-separated bearer tokens of the POS terminals allowed to post sale batches; see sales.views.sale_batch
+POS_TERMINAL_TOKENS = config("POS_TERMINAL_TOKENS", default="", cast=Csv())
+# Threads per process for PDF rendering started by async views; see inventory/blocking.py
+BLOCKING_WORKERS = config("BLOCKING_WORKERS", default=4, cast=int)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from jobs.worker import delete_finished_jobs, requeue_stale_jobs, run_pending
+
+# Seconds between deletions of old finished jobs while the worker runs
+CLEANUP_INTERVAL = 60 * 60
+
+
+class Command(BaseCommand):
+    help = "Run background jobs from the database queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run the jobs that are due, then exit")
+        parser.add_argument('--sleep', type=float, default=1.0, help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        requeue_stale_jobs()
+        self.delete_finished_jobs()
+
+        if options['once']:
+            count = run_pending()
+            self.stdout.write(f"Ran {count} jobs.")
+            return
+
+        self.stdout.write("Job worker started. Press CTRL-C to stop.")
+        next_cleanup = time.monotonic() + CLEANUP_INTERVAL
+        try:
+            while True:
+                if time.monotonic() >= next_cleanup:
+                    self.delete_finished_jobs()
+                    next_cleanup = time.monotonic() + CLEANUP_INTERVAL
+                if not run_pending():
+                    time.sleep(options['sleep'])
+        except KeyboardInterrupt:
+            self.stdout.write("Job worker stopped.")
+
+    def delete_finished_jobs(self):
+        if deleted := delete_finished_jobs():
+            self.stdout.write(f"Deleted {deleted} old finished jobs.")
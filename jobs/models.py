@@ -0,0 +1,60 @@
+from django.db import IntegrityError, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+
+class Job(models.Model):
+    """A unit of background work, picked up by ``manage.py run_jobs``."""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    name = models.CharField(max_length=100)
+    key = models.CharField(max_length=200, blank=True, default='', help_text="Pending jobs with the same name and key are coalesced.")
+    payload = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    run_after = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['run_after', 'id']
+        indexes = [models.Index(fields=['status', 'run_after'])]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['name', 'key'],
+                condition=Q(status='pending'),
+                name='unique_pending_job',
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.name}[{self.key}] - {self.status}"
+
+    @classmethod
+    def enqueue(cls, name, key='', payload=None, delay=None):
+        """
+        Schedule a job, or coalesce it into an identical pending one.
+
+        Returns the new job, or None if a pending job with the same name and
+        key already exists (that job will do the work).
+        """
+        run_after = timezone.now()
+        if delay:
+            run_after += delay
+        try:
+            with transaction.atomic():
+                return cls.objects.create(name=name, key=key, payload=payload or {}, run_after=run_after)
+        except IntegrityError:
+            return None
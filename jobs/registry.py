@@ -0,0 +1,13 @@
+_handlers = {}
+
+
+def register(name):
+    """Register the decorated function as the handler for jobs called ``name``."""
+    def decorator(func):
+        _handlers[name] = func
+        return func
+    return decorator
+
+
+def get_handler(name):
+    return _handlers[name]
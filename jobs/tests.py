@@ -0,0 +1,138 @@
+import io
+from datetime import timedelta
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from jobs.models import Job
+from jobs.registry import register
+from jobs.worker import KEEP_DONE_FOR, KEEP_FAILED_FOR, MAX_ATTEMPTS, STALE_AFTER, retry_or_fail, run_pending
+
+calls = []
+
+
+@register('tests.record')
+def record(value=None):
+    calls.append(value)
+
+
+@register('tests.fail')
+def fail():
+    raise RuntimeError("boom")
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_pending_jobs_with_the_same_key_are_coalesced(self):
+        first = Job.enqueue('tests.record', key='a', payload={'value': 1})
+        self.assertIsNotNone(first)
+        self.assertIsNone(Job.enqueue('tests.record', key='a', payload={'value': 2}))
+        self.assertIsNotNone(Job.enqueue('tests.record', key='b', payload={'value': 3}))
+
+        self.assertEqual(run_pending(), 2)
+        self.assertEqual(sorted(calls), [1, 3])
+        # Once the job has run, the key can be queued again
+        self.assertIsNotNone(Job.enqueue('tests.record', key='a'))
+
+    def test_delayed_jobs_wait_for_run_after(self):
+        job = Job.enqueue('tests.record', payload={'value': 'later'}, delay=timedelta(minutes=5))
+        self.assertEqual(run_pending(), 0)
+        self.assertEqual(calls, [])
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(calls, ['later'])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.attempts, 1)
+
+    def test_failures_are_retried_with_backoff_then_fail(self):
+        job = Job.enqueue('tests.fail')
+        before = timezone.now()
+        with self.assertLogs('jobs.worker', 'ERROR'):
+            run_pending()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.PENDING)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.last_error, 'boom')
+        self.assertGreaterEqual(job.run_after, before + timedelta(seconds=2))
+
+        for attempt in range(2, MAX_ATTEMPTS + 1):
+            Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+            with self.assertLogs('jobs.worker', 'ERROR'):
+                run_pending()
+            job.refresh_from_db()
+            self.assertEqual(job.attempts, attempt)
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertIsNotNone(job.finished)
+
+    def test_retry_gives_way_to_an_identical_pending_job(self):
+        job = Job.enqueue('tests.fail', key='x')
+        Job.objects.filter(pk=job.pk).update(status=Job.RUNNING)
+        Job.enqueue('tests.fail', key='x', delay=timedelta(minutes=5))
+        job.refresh_from_db()
+        retry_or_fail(job, 'boom')
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(Job.objects.filter(name='tests.fail', key='x', status=Job.PENDING).count(), 1)
+
+    def test_run_jobs_once_requeues_stale_jobs_and_runs_what_is_due(self):
+        stale = Job.objects.create(
+            name='tests.record', payload={'value': 'stale'}, status=Job.RUNNING, attempts=1,
+            started=timezone.now() - STALE_AFTER - timedelta(minutes=1),
+        )
+        Job.enqueue('tests.record', key='due', payload={'value': 'due'})
+        out = io.StringIO()
+        call_command('run_jobs', '--once', stdout=out)
+        self.assertIn('Ran 1 jobs.', out.getvalue())
+        self.assertEqual(calls, ['due'])
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, Job.PENDING)
+        self.assertGreater(stale.run_after, timezone.now())
+
+    def test_run_jobs_deletes_old_finished_jobs(self):
+        now = timezone.now()
+        old = [
+            Job.objects.create(name='tests.record', key='done', status=Job.DONE, finished=now - KEEP_DONE_FOR - timedelta(hours=1)),
+            Job.objects.create(name='tests.fail', key='failed', status=Job.FAILED, finished=now - KEEP_FAILED_FOR - timedelta(hours=1)),
+        ]
+        kept = [
+            Job.objects.create(name='tests.record', key='recent', status=Job.DONE, finished=now - timedelta(hours=1)),
+            Job.objects.create(name='tests.fail', key='recent', status=Job.FAILED, finished=now - KEEP_DONE_FOR - timedelta(hours=1)),
+            Job.objects.create(name='tests.record', key='pending', run_after=now + timedelta(days=1)),
+        ]
+        out = io.StringIO()
+        call_command('run_jobs', '--once', stdout=out)
+        self.assertIn('Deleted 2 old finished jobs.', out.getvalue())
+        self.assertQuerySetEqual(Job.objects.order_by('pk'), kept)
+        self.assertFalse(Job.objects.filter(pk__in=[job.pk for job in old]).exists())
+
+    def test_worker_loop_deletes_old_finished_jobs_periodically(self):
+        sleeps = []
+
+        def finish_a_job_long_ago(seconds):
+            # The job finished during the first sleep is deleted before the second
+            if sleeps:
+                raise KeyboardInterrupt
+            sleeps.append(seconds)
+            Job.objects.create(name='tests.record', status=Job.DONE, finished=timezone.now() - KEEP_DONE_FOR - timedelta(hours=1))
+
+        out = io.StringIO()
+        with mock.patch('jobs.management.commands.run_jobs.CLEANUP_INTERVAL', 0), \
+                mock.patch('jobs.management.commands.run_jobs.time.sleep', side_effect=finish_a_job_long_ago):
+            call_command('run_jobs', stdout=out)
+        self.assertIn('Deleted 1 old finished jobs.', out.getvalue())
+        self.assertFalse(Job.objects.exists())
+
+    def test_worker_loop_runs_jobs_until_interrupted(self):
+        Job.enqueue('tests.record', payload={'value': 1})
+        out = io.StringIO()
+        with mock.patch('jobs.management.commands.run_jobs.time.sleep', side_effect=KeyboardInterrupt) as sleep:
+            call_command('run_jobs', '--sleep', '0.5', stdout=out)
+        self.assertEqual(calls, [1])
+        sleep.assert_called_once_with(0.5)
+        self.assertIn('Job worker stopped.', out.getvalue())
@@ -0,0 +1,90 @@
+import logging
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+from .registry import get_handler
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+# Jobs left running this long are assumed to belong to a dead worker
+STALE_AFTER = timedelta(minutes=10)
+# Finished jobs are kept this long for inspection in the admin, then deleted
+KEEP_DONE_FOR = timedelta(days=7)
+KEEP_FAILED_FOR = timedelta(days=30)
+
+
+def claim_next_job():
+    """Atomically mark the next due job as running and return it, or None."""
+    now = timezone.now()
+    with transaction.atomic():
+        candidates = list(
+            Job.objects.select_for_update(skip_locked=True)
+            .filter(status=Job.PENDING, run_after__lte=now)
+            .values_list('pk', flat=True)[:5]
+        )
+        for pk in candidates:
+            # The conditional UPDATE is the claim on backends without row locks
+            claimed = Job.objects.filter(pk=pk, status=Job.PENDING).update(
+                status=Job.RUNNING, started=now, attempts=F('attempts') + 1
+            )
+            if claimed:
+                return Job.objects.get(pk=pk)
+    return None
+
+
+def run_job(job):
+    try:
+        get_handler(job.name)(**job.payload)
+    except Exception as e:
+        logger.error(f"Job {job.pk} ({job.name}) failed: {str(e)}", exc_info=True)
+        retry_or_fail(job, str(e))
+    else:
+        Job.objects.filter(pk=job.pk).update(status=Job.DONE, finished=timezone.now(), last_error='')
+
+
+def retry_or_fail(job, error):
+    if job.attempts < MAX_ATTEMPTS:
+        backoff = timedelta(seconds=2 ** job.attempts)
+        try:
+            with transaction.atomic():
+                Job.objects.filter(pk=job.pk).update(
+                    status=Job.PENDING, run_after=timezone.now() + backoff, last_error=error
+                )
+            return
+        except IntegrityError:
+            # An identical job is already pending and will redo the work
+            pass
+    Job.objects.filter(pk=job.pk).update(status=Job.FAILED, finished=timezone.now(), last_error=error)
+
+
+def run_pending(limit=None):
+    """Run due jobs until there are none left (or ``limit`` is reached)."""
+    count = 0
+    while limit is None or count < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+def requeue_stale_jobs():
+    stale = Job.objects.filter(status=Job.RUNNING, started__lt=timezone.now() - STALE_AFTER)
+    for job in stale:
+        retry_or_fail(job, "Worker stopped while the job was running")
+
+
+def delete_finished_jobs():
+    """Delete the jobs that finished longer ago than they are kept for. Returns the number deleted."""
+    now = timezone.now()
+    deleted, _ = Job.objects.filter(
+        Q(status=Job.DONE, finished__lt=now - KEEP_DONE_FOR)
+        | Q(status=Job.FAILED, finished__lt=now - KEEP_FAILED_FOR)
+    ).delete()
+    return deleted
@@ -16,4 +16,4 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ('name', 'category__name')
     prepopulated_fields = {'slug': ('name',)}
     ordering = ('name',)
-    readonly_fields = ('needs_restock',)
\ No newline at end of file
+    readonly_fields = ('needs_restock', 'shard_count')
\ No newline at end of file
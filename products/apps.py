@@ -5,4 +5,5 @@ class ProductsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'products'
 
-    
\ No newline at end of file
+    def ready(self):
+        import products.signals
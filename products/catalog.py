@@ -0,0 +1,85 @@
+"""
+Compact, versioned product catalog for the sale form.
+
+Every change to a catalog field stamps the product with a new
+``catalog_version`` (see ``next_catalog_version``), and deleted products are
+logged as ``CatalogRemoval`` rows. The catalog version is the highest stamp
+of either kind, so clients can cache a snapshot and ask only for the
+products changed since the version they hold.
+
+Removals are kept for ``REMOVAL_RETENTION``; a client asking for the
+changes since an older version gets a full snapshot instead.
+"""
+from datetime import timedelta
+
+from django.db.models import Max
+
+from .models import CatalogRemoval, Product, next_catalog_version
+
+# Order of the values in each product row of a snapshot
+CATALOG_COLUMNS = [
+    'id', 'name', 'regular_price', 'bulk_price', 'dozen_price', 'quantity',
+    'minimum_bulk_quantity', 'quantity_per_carton',
+]
+
+# Versions are stamped before commit, so a slow transaction can become
+# visible after a later version was served. Deltas reach back this far
+# before ``since`` so such changes are still picked up.
+DELTA_OVERLAP = timedelta(minutes=5)
+# How long removals are logged for deltas; must be longer than DELTA_OVERLAP
+REMOVAL_RETENTION = timedelta(days=1)
+
+
+def _microseconds(delta):
+    # Catalog versions count microseconds (see next_catalog_version)
+    return delta // timedelta(microseconds=1)
+
+
+def catalog_version():
+    """The current catalog version (0 for an empty, never-changed catalog)."""
+    product_version = Product.objects.aggregate(version=Max('catalog_version'))['version'] or 0
+    removal_version = CatalogRemoval.objects.aggregate(version=Max('version'))['version'] or 0
+    return max(product_version, removal_version)
+
+
+def catalog_snapshot(version, since=None):
+    """
+    Return the catalog as a JSON-ready dict.
+
+    Without ``since`` (or with a version the server never issued, or one
+    older than the removal log reaches) this is every in-stock product. With
+    ``since`` it holds only the products changed after that version,
+    including those that sold out, plus the ids of removed products.
+    """
+    products = Product.objects.order_by()
+    cutoff = None if since is None else since - _microseconds(DELTA_OVERLAP)
+    full = cutoff is None or since > version or cutoff < version - _microseconds(REMOVAL_RETENTION)
+    removed = []
+
+    if full:
+        products = products.filter(quantity__gt=0)
+    else:
+        products = products.filter(catalog_version__gt=cutoff)
+        removed = list(CatalogRemoval.objects.filter(version__gt=cutoff).values_list('product_id', flat=True))
+
+    rows = [
+        [pk, name, float(regular_price), float(bulk_price), float(dozen_price), quantity,
+         minimum_bulk_quantity or 1, quantity_per_carton]
+        for pk, name, regular_price, bulk_price, dozen_price, quantity, minimum_bulk_quantity, quantity_per_carton
+        in products.values_list(*CATALOG_COLUMNS).iterator()
+    ]
+
+    return {
+        'version': version,
+        'full': full,
+        'columns': CATALOG_COLUMNS,
+        'products': rows,
+        'removed': removed,
+    }
+
+
+def record_removal(product_id):
+    """Log a deleted product for catalog deltas, dropping entries past REMOVAL_RETENTION."""
+    removal = CatalogRemoval.objects.create(product_id=product_id, version=next_catalog_version())
+    CatalogRemoval.objects.filter(version__lt=removal.version - _microseconds(REMOVAL_RETENTION)).delete()
+    return removal
@@ -0,0 +1,72 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+
+from products.models import Category, Product
+from products.search import search_products
+
+WORDS = [
+    'cotton', 'silk', 'linen', 'denim', 'wool', 'lace', 'ankara', 'chiffon', 'velvet', 'satin',
+    'shirt', 'gown', 'scarf', 'trouser', 'skirt', 'blouse', 'jacket', 'cap', 'wrapper', 'kaftan',
+    'red', 'blue', 'green', 'black', 'white', 'gold', 'navy', 'maroon', 'cream', 'grey',
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Benchmark product search against a substring scan on a generated catalog (changes are rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100_000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--terms', nargs='+', default=['cot', 'silk gown', 'navy', 'maroon kaf', 'xyz'])
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.populate(options['products'])
+                self.run(options['terms'], options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def populate(self, size):
+        rng = random.Random(42)
+        categories = Category.objects.bulk_create([
+            Category(name=f'{word.title()} Collection {i}', slug=f'bench-{word}-{i}')
+            for i, word in enumerate(WORDS)
+        ])
+        started = time.perf_counter()
+        for start in range(0, size, 5000):
+            Product.objects.bulk_create([
+                Product(
+                    category=rng.choice(categories),
+                    name=f"{' '.join(rng.sample(WORDS, 3))} {i}",
+                    slug=f'bench-{i}', regular_price=10, bulk_price=8, quantity=10,
+                )
+                for i in range(start, min(start + 5000, size))
+            ])
+        self.stdout.write(f"Created {size} products in {time.perf_counter() - started:.1f}s ({connection.vendor})")
+
+    def run(self, terms, repeat):
+        base = Product.objects.select_related('category')
+        self.stdout.write(f"{'term':>12} {'engine':>10} {'matches':>8} {'ms/query':>9}")
+        for term in terms:
+            engines = [
+                ('icontains', lambda: base.filter(Q(name__icontains=term) | Q(category__name__icontains=term)).order_by('name')),
+                ('search', lambda: search_products(base, term)),
+            ]
+            for name, build in engines:
+                matches = build().count()
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    # A page of results, as product_list shows
+                    list(build()[:25])
+                elapsed = (time.perf_counter() - started) / repeat
+                self.stdout.write(f"{term:>12} {name:>10} {matches:>8} {elapsed * 1000:>9.2f}")
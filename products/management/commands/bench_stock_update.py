@@ -0,0 +1,80 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F
+
+from products.models import Category, Product
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def legacy_update_quantity(product, amount):
+    """The original Product.update_quantity, kept here as the benchmark baseline."""
+    Product.objects.filter(pk=product.pk).update(quantity=F('quantity') + amount)
+    product.refresh_from_db()
+    current_quantity = Product.objects.filter(pk=product.pk).values_list('quantity', flat=True).first()
+    needs_restock = current_quantity <= product.restock_level
+    Product.objects.filter(pk=product.pk).update(needs_restock=needs_restock)
+    product.refresh_from_db(fields=['quantity'])
+    return product.quantity
+
+
+class Command(BaseCommand):
+    help = "Microbenchmark stock mutations: legacy update_quantity vs adjust_stock vs adjust_stock_bulk (changes are rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=40, help="Products per batch (basket size)")
+        parser.add_argument('--rounds', type=int, default=50)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['products'], options['rounds'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, size, rounds):
+        category = Category.objects.create(name='Benchmark', slug='benchmark')
+        Product.objects.bulk_create([
+            Product(
+                category=category, name=f'Bench product {i}', slug=f'bench-product-{i}',
+                regular_price=10, bulk_price=8, quantity=10 ** 6, restock_level=10,
+            )
+            for i in range(size)
+        ])
+        products = list(Product.objects.filter(category=category))
+
+        def legacy():
+            for product in products:
+                legacy_update_quantity(product, -1)
+
+        def single():
+            for product in products:
+                Product.adjust_stock(product.pk, -1)
+
+        def bulk():
+            Product.adjust_stock_bulk({product.pk: -1 for product in products})
+
+        self.stdout.write(f"{size} products x {rounds} rounds")
+        self.stdout.write(f"{'method':>18} {'queries/round':>14} {'ms/round':>9}")
+        for name, method in [('update_quantity', legacy), ('adjust_stock', single), ('adjust_stock_bulk', bulk)]:
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries):
+                started = time.perf_counter()
+                for _ in range(rounds):
+                    method()
+                elapsed = time.perf_counter() - started
+            self.stdout.write(f"{name:>18} {queries.count / rounds:>14.0f} {elapsed / rounds * 1000:>9.2f}")
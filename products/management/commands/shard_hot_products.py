@@ -0,0 +1,54 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Sum
+from django.utils import timezone
+
+from products.models import Product
+from products.stock import disable_sharding, enable_sharding
+from statement.models import ProductDailySales
+
+
+class Command(BaseCommand):
+    help = (
+        "Split the stock of the best-selling products (or the ones given) over several "
+        "StockShard counters so concurrent checkouts don't queue on their rows, or fold it back. "
+        "Sharded products rely on the job worker (run_jobs) to reconcile their quantity."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=10, help="Shard the N products with the most units sold")
+        parser.add_argument('--days', type=int, default=7, help="Sales window used to rank products")
+        parser.add_argument('--product', type=int, nargs='+', help="Shard these product ids instead")
+        parser.add_argument('--shards', type=int, default=8)
+        parser.add_argument('--disable', action='store_true', help="Fold the shards back into the products")
+
+    def handle(self, *args, **options):
+        if options['shards'] < 1:
+            raise CommandError("--shards must be at least 1")
+
+        if options['disable']:
+            products = Product.objects.filter(shard_count__gt=0)
+            if options['product']:
+                products = products.filter(pk__in=options['product'])
+            for product in products.order_by('pk'):
+                disable_sharding(product.pk)
+                self.stdout.write(f"{product.name}: shards folded back")
+            return
+
+        if options['product']:
+            product_ids = options['product']
+        else:
+            since = timezone.localdate() - timedelta(days=options['days'])
+            product_ids = list(
+                ProductDailySales.objects.filter(date__gte=since).order_by()
+                .values('product').annotate(sold=Sum('units_sold'))
+                .order_by('-sold').values_list('product', flat=True)[:options['top']]
+            )
+
+        products = Product.objects.in_bulk(product_ids)
+        for product_id in product_ids:
+            if product_id not in products:
+                raise CommandError(f"Product with ID {product_id} not found")
+            enable_sharding(product_id, options['shards'])
+            self.stdout.write(f"{products[product_id].name}: {options['shards']} shards")
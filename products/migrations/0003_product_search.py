@@ -0,0 +1,86 @@
+from django.db import migrations
+
+FTS_TABLE = 'products_product_fts'
+
+POSTGRES_FORWARDS = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS products_product_name_trgm ON products_product USING gin (UPPER(name) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS products_category_name_trgm ON products_category USING gin (UPPER(name) gin_trgm_ops)",
+]
+POSTGRES_BACKWARDS = [
+    "DROP INDEX IF EXISTS products_product_name_trgm",
+    "DROP INDEX IF EXISTS products_category_name_trgm",
+]
+
+# First SQLite release with the FTS5 trigram tokenizer, which matches
+# substrings like PostgreSQL's icontains rather than word prefixes
+TRIGRAM_SQLITE_VERSION = (3, 34)
+
+SQLITE_FORWARDS = [
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(name, category, tokenize='trigram')",
+    f"""INSERT INTO {FTS_TABLE}(rowid, name, category)
+        SELECT p.id, p.name, c.name FROM products_product p JOIN products_category c ON c.id = p.category_id""",
+    f"""CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON products_product BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, category)
+        VALUES (new.id, new.name, (SELECT name FROM products_category WHERE id = new.category_id));
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF name, category_id ON products_product BEGIN
+        UPDATE {FTS_TABLE} SET name = new.name,
+            category = (SELECT name FROM products_category WHERE id = new.category_id)
+        WHERE rowid = new.id;
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON products_product BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_category_update AFTER UPDATE OF name ON products_category BEGIN
+        UPDATE {FTS_TABLE} SET category = new.name
+        WHERE rowid IN (SELECT id FROM products_product WHERE category_id = new.id);
+    END""",
+]
+SQLITE_BACKWARDS = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_insert",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_update",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_delete",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_category_update",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+
+def sqlite_has_fts5(schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        return any(option == 'ENABLE_FTS5' for option, in cursor.fetchall())
+
+
+def create_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        statements = POSTGRES_FORWARDS
+    elif (
+        vendor == 'sqlite'
+        and schema_editor.connection.Database.sqlite_version_info >= TRIGRAM_SQLITE_VERSION
+        and sqlite_has_fts5(schema_editor)
+    ):
+        statements = SQLITE_FORWARDS
+    else:
+        return  # products.search falls back to a substring scan
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+def drop_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    statements = {'postgresql': POSTGRES_BACKWARDS, 'sqlite': SQLITE_BACKWARDS}.get(vendor, [])
+    for sql in statements:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_alter_product_dozen_price_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
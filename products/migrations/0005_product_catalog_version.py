@@ -0,0 +1,80 @@
+# Generated by Django 5.1.5 on 2026-10-18 02:00
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+search_migration = import_module('products.migrations.0003_product_search')
+
+# SQLite adds the column by rebuilding products_product, which drops the FTS
+# sync triggers on it and trips over the one on products_category
+FTS_TRIGGERS = [sql for sql in search_migration.SQLITE_FORWARDS if sql.startswith('CREATE TRIGGER')]
+FTS_DROP_TRIGGERS = [sql for sql in search_migration.SQLITE_BACKWARDS if sql.startswith('DROP TRIGGER')]
+
+
+CATALOG_VERSION_SEQUENCE = 'products_catalog_version_seq'
+
+
+def create_catalog_version_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f"CREATE SEQUENCE IF NOT EXISTS {CATALOG_VERSION_SEQUENCE} AS bigint")
+    else:
+        apps.get_model('products', 'CatalogVersionCounter').objects.create(pk=1)
+
+
+def drop_catalog_version_sequence(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f"DROP SEQUENCE IF EXISTS {CATALOG_VERSION_SEQUENCE}")
+
+
+def fts_installed(schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return False
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [search_migration.FTS_TABLE])
+        return cursor.fetchone() is not None
+
+
+def drop_fts_triggers(apps, schema_editor):
+    if fts_installed(schema_editor):
+        for sql in FTS_DROP_TRIGGERS:
+            schema_editor.execute(sql)
+
+
+def create_fts_triggers(apps, schema_editor):
+    if fts_installed(schema_editor):
+        for sql in FTS_TRIGGERS:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_fts_triggers, create_fts_triggers),
+        migrations.CreateModel(
+            name='CatalogRemoval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_id', models.BigIntegerField()),
+                ('version', models.BigIntegerField(db_index=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='catalog_version',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.RunPython(create_fts_triggers, drop_fts_triggers),
+        migrations.CreateModel(
+            name='CatalogVersionCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_catalog_version_sequence, drop_catalog_version_sequence),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.5 on 2026-10-18 02:11
+
+from importlib import import_module
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Rebuilding products_product on SQLite drops the FTS sync triggers; see 0005
+catalog_migration = import_module('products.migrations.0005_product_catalog_version')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0005_product_catalog_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(catalog_migration.drop_fts_triggers, catalog_migration.create_fts_triggers),
+        migrations.AddField(
+            model_name='product',
+            name='shard_count',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, help_text="Number of StockShard counters holding this product's stock (0: kept on the product row only)."),
+        ),
+        migrations.CreateModel(
+            name='StockShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_shards', to='products.product')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('product', 'shard'), name='unique_stock_shard'), models.CheckConstraint(condition=models.Q(('quantity__gte', 0)), name='stock_shard_quantity_not_negative')],
+            },
+        ),
+        migrations.RunPython(catalog_migration.create_fts_triggers, catalog_migration.drop_fts_triggers),
+    ]
@@ -1,6 +1,15 @@
-from django.db import models
+import random
+import time
+
+from django.db import connection, models, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.lookups import LessThanOrEqual
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
 from django.utils.text import slugify
+from inventory.dashboard import dashboard_changed
+from inventory.mixins import ChangeTrackingMixin
 
 class Category(models.Model):
     name = models.CharField(max_length=200, blank=False)
@@ -8,14 +17,61 @@ class Category(models.Model):
 
     class Meta:
         ordering = ['name'] 
-        indexes = [models.Index(fields=['name'])]
+        indexes = [models.Index(fields=['name', 'id'], name='category_name_id_idx')]
         verbose_name = 'category'
         verbose_name_plural = 'categories'
 
     def __str__(self):
         return self.name
 
-class Product(models.Model):
+# Product fields served by the sale form catalog; changing any of them bumps
+# the product's catalog version
+CATALOG_FIELDS = {
+    'name', 'regular_price', 'bulk_price', 'dozen_price', 'quantity',
+    'minimum_bulk_quantity', 'quantity_per_carton',
+}
+
+# PostgreSQL sequence the catalog versions are drawn from; other backends
+# use the CatalogVersionCounter row
+CATALOG_VERSION_SEQUENCE = 'products_catalog_version_seq'
+
+
+def next_catalog_version():
+    """
+    Return a new catalog version, issued by the database so that every web
+    and worker process draws from the same series.
+
+    Versions are the database clock in microseconds since the epoch, pushed
+    past the last version issued when the clock hasn't moved on, so they
+    never go backwards. (Two PostgreSQL sessions asking within the same
+    microsecond may share one; catalog deltas reach back DELTA_OVERLAP
+    before the version a client holds, which covers such ties.)
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT setval(%s, GREATEST(nextval(%s), "
+                "(EXTRACT(EPOCH FROM clock_timestamp()) * 1000000)::bigint))",
+                [CATALOG_VERSION_SEQUENCE, CATALOG_VERSION_SEQUENCE],
+            )
+            return cursor.fetchone()[0]
+    return CatalogVersionCounter.next_value(time.time_ns() // 1000)
+
+
+def can_update_returning():
+    """
+    Whether the database supports ``UPDATE ... RETURNING``: PostgreSQL, and
+    SQLite from 3.35. (MariaDB can return columns from an INSERT, but not
+    from an UPDATE.)
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35)
+    return False
+
+
+class Product(ChangeTrackingMixin, models.Model):
     category = models.ForeignKey(Category, blank=False, related_name='products', on_delete=models.CASCADE)
     name = models.CharField(max_length=200)
     slug = models.SlugField(max_length=200)
@@ -30,12 +86,17 @@ class Product(models.Model):
     available = models.BooleanField(default=True)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+    catalog_version = models.BigIntegerField(default=0, db_index=True, editable=False)
+    shard_count = models.PositiveSmallIntegerField(
+        default=0, editable=False,
+        help_text="Number of StockShard counters holding this product's stock (0: kept on the product row only)."
+    )
 
     class Meta:
         ordering = ['name']
         indexes = [
             models.Index(fields=['id', 'slug']),
-            models.Index(fields=['name']),
+            models.Index(fields=['name', 'id'], name='product_name_id_idx'),
             models.Index(fields=['-created']),
         ]
         constraints = [
@@ -46,25 +107,251 @@ class Product(models.Model):
         return self.name
 
     def clean(self):
-        from django.core.exceptions import ValidationError
         if self.bulk_price > self.regular_price:
             raise ValidationError("Bulk price cannot be greater than regular price.")
 
     def save(self, *args, form_edit=False, **kwargs):
-        if self.pk and not form_edit:
-            current_quantity = Product.objects.filter(pk=self.pk).values_list('quantity', flat=True).first()
-            if current_quantity is not None:
-                self.quantity = current_quantity
-        self.needs_restock = self.quantity <= self.restock_level
+        tracked = self.pk and self.is_tracked() and 'update_fields' not in kwargs
+        changed = self.get_changed_fields() if tracked else set()
+        shard_change = None
+        if form_edit and self.shard_count and tracked:
+            shard_change = self.quantity - self.get_loaded_value('quantity')
+
+        if tracked and not form_edit and 'restock_level' not in changed:
+            # quantity and needs_restock are maintained by adjust_stock; keep
+            # the stored values instead of re-reading them from the database
+            self.quantity = self.get_loaded_value('quantity')
+            self.needs_restock = self.get_loaded_value('needs_restock')
+            kwargs['update_fields'] = (changed - {'quantity', 'needs_restock'}) | {'updated'}
+        else:
+            if self.pk and not form_edit:
+                current_quantity = Product.objects.filter(pk=self.pk).values_list('quantity', flat=True).first()
+                if current_quantity is not None:
+                    self.quantity = current_quantity
+            self.needs_restock = self.quantity <= self.restock_level
+            if tracked:
+                kwargs['update_fields'] = changed | {'needs_restock', 'updated'}
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or CATALOG_FIELDS.intersection(update_fields):
+            self.catalog_version = next_catalog_version()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'catalog_version'}
+
         self.clean()
         super().save(*args, **kwargs)
 
-    def update_quantity(self, amount, save=True):
-        from django.db.models import F
-        Product.objects.filter(pk=self.pk).update(quantity=F('quantity') + amount)
-        self.refresh_from_db()
-        current_quantity = Product.objects.filter(pk=self.pk).values_list('quantity', flat=True).first()
-        needs_restock = current_quantity <= self.restock_level
-        Product.objects.filter(pk=self.pk).update(needs_restock=needs_restock)
-        self.refresh_from_db(fields=['quantity'])
+        if form_edit and self.shard_count:
+            # The quantity the form was shown may lag the shards by sales not
+            # yet reconciled, so apply the edit to the shards as a change
+            if shard_change is None:
+                StockShard.reset(self.pk, self.shard_count, self.quantity)
+                Product.reconcile_stock([self.pk])
+            else:
+                Product.adjust_stock_bulk({self.pk: shard_change}, sharded={self.pk: self.shard_count})
+            self.refresh_from_db(fields=['quantity', 'needs_restock', 'catalog_version'])
+
+    def update_quantity(self, amount):
+        """Add ``amount`` to the stock in the database (see adjust_stock) and to this instance."""
+        self.quantity = Product.adjust_stock(self.pk, amount)
+        self.needs_restock = self.quantity <= self.restock_level
+        # Now the stored values, so a later save() doesn't see them as edits
+        self._snapshot(['quantity', 'needs_restock'])
         return self.quantity
+
+    @classmethod
+    def adjust_stock(cls, product_id, amount):
+        """
+        Add ``amount`` (negative to remove) to a product's stock and
+        recompute ``needs_restock`` in a single statement.
+
+        Returns the new quantity, or None if the product does not exist.
+        """
+        return cls.adjust_stock_bulk({product_id: amount}).get(product_id)
+
+    @classmethod
+    def adjust_stock_bulk(cls, deltas, sharded=None):
+        """
+        Apply ``{product_id: amount}`` stock changes to many products in one
+        UPDATE, recomputing ``needs_restock`` and bumping the catalog version
+        for each of them.
+
+        Products with stock shards have the change applied to their shards
+        and their quantity reconciled. ``sharded`` is ``{product_id:
+        shard_count}`` of those among ``deltas``, when the caller already
+        knows it.
+
+        Returns ``{product_id: new_quantity}`` for the products updated.
+        """
+        if not deltas:
+            return {}
+        dashboard_changed()
+
+        if sharded is None:
+            sharded = dict(cls.objects.filter(pk__in=deltas, shard_count__gt=0).values_list('pk', 'shard_count'))
+        if sharded:
+            # Lock the product rows before their shards, as lock_products does
+            list(cls.objects.select_for_update().filter(pk__in=sharded).order_by('pk').values_list('pk'))
+            for product_id in sorted(sharded):
+                StockShard.add(product_id, sharded[product_id], deltas[product_id])
+            cls.reconcile_stock(sharded)
+            new_quantities = dict(cls.objects.filter(pk__in=sharded).values_list('pk', 'quantity'))
+            deltas = {product_id: amount for product_id, amount in deltas.items() if product_id not in sharded}
+            return {**new_quantities, **cls.adjust_stock_bulk(deltas, sharded={})}
+
+        version = next_catalog_version()
+
+        if not can_update_returning():
+            delta = Case(*[When(pk=pk, then=Value(amount)) for pk, amount in deltas.items()], default=Value(0))
+            products = cls.objects.filter(pk__in=deltas)
+            products.update(quantity=F('quantity') + delta, catalog_version=version)
+            products.update(needs_restock=Q(quantity__lte=F('restock_level')))
+            return dict(products.order_by().values_list('pk', 'quantity'))
+
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        pk, quantity, restock_level, needs_restock, catalog_version = (
+            qn(cls._meta.get_field(name).column)
+            for name in ('id', 'quantity', 'restock_level', 'needs_restock', 'catalog_version')
+        )
+        delta = f"CASE {pk} {' '.join(['WHEN %s THEN %s'] * len(deltas))} END"
+        delta_params = [value for item in deltas.items() for value in item]
+
+        # Every column reference in SET reads the row as it was before the
+        # UPDATE, so needs_restock is computed from the new quantity here
+        sql = (
+            f"UPDATE {table} SET {quantity} = {quantity} + {delta}, "
+            f"{needs_restock} = ({quantity} + {delta} <= {restock_level}), "
+            f"{catalog_version} = %s "
+            f"WHERE {pk} IN ({', '.join(['%s'] * len(deltas))}) "
+            f"RETURNING {pk}, {quantity}"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, delta_params + delta_params + [version] + list(deltas))
+            return dict(cursor.fetchall())
+
+    @classmethod
+    def reconcile_stock(cls, product_ids):
+        """
+        Set the quantity (and needs_restock) of the given sharded products to
+        the total held by their shards.
+        """
+        dashboard_changed()
+        total = Coalesce(
+            Subquery(
+                StockShard.objects.filter(product=OuterRef('pk')).order_by()
+                .values('product').annotate(total=Sum('quantity')).values('total')
+            ),
+            0,
+        )
+        return cls.objects.filter(pk__in=product_ids, shard_count__gt=0).update(
+            quantity=total,
+            needs_restock=LessThanOrEqual(total, F('restock_level')),
+            catalog_version=next_catalog_version(),
+        )
+
+
+class StockShard(models.Model):
+    """
+    One of the ``shard_count`` counters that hold a hot product's stock.
+    Concurrent sales take from different shards instead of all queueing on
+    the product row; ``Product.quantity`` is reconciled from the shards
+    shortly after.
+    """
+    product = models.ForeignKey(Product, related_name='stock_shards', on_delete=models.CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    quantity = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'shard'], name='unique_stock_shard'),
+            models.CheckConstraint(condition=Q(quantity__gte=0), name='stock_shard_quantity_not_negative'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id}#{self.shard}: {self.quantity}"
+
+    @staticmethod
+    def split(quantity, shard_count):
+        """``quantity`` spread as evenly as possible over ``shard_count`` shards."""
+        share, extra = divmod(quantity, shard_count)
+        return [share + (1 if shard < extra else 0) for shard in range(shard_count)]
+
+    @classmethod
+    def take(cls, product_id, shard_count, quantity):
+        """
+        Take ``quantity`` from a product's shards. Returns False, taking
+        nothing, if the shards together hold less.
+
+        Shards are tried one at a time from a random one, so concurrent sales
+        lock different rows; only when no single shard can cover the quantity
+        are all of them locked, in order, and drained together.
+        """
+        first = random.randrange(shard_count)
+        for offset in range(shard_count):
+            shard = (first + offset) % shard_count
+            taken = cls.objects.filter(product_id=product_id, shard=shard, quantity__gte=quantity).update(
+                quantity=F('quantity') - quantity
+            )
+            if taken:
+                return True
+
+        shards = list(cls.objects.select_for_update().filter(product_id=product_id).order_by('shard'))
+        if sum(shard.quantity for shard in shards) < quantity:
+            return False
+        remaining = quantity
+        for shard in shards:
+            taken = min(shard.quantity, remaining)
+            shard.quantity -= taken
+            remaining -= taken
+        cls.objects.bulk_update(shards, ['quantity'])
+        return True
+
+    @classmethod
+    def add(cls, product_id, shard_count, amount):
+        """Add ``amount`` (negative to remove) to a product's stock, spread over its shards."""
+        if amount < 0:
+            if not cls.take(product_id, shard_count, -amount):
+                raise ValidationError(f"Not enough stock in the shards of product {product_id}")
+            return
+        shares = cls.split(amount, shard_count)
+        cls.objects.filter(product_id=product_id).update(
+            quantity=F('quantity') + Case(*[When(shard=shard, then=Value(share)) for shard, share in enumerate(shares)], default=Value(0))
+        )
+
+    @classmethod
+    def reset(cls, product_id, shard_count, quantity):
+        """Replace a product's shards with ``shard_count`` shards holding ``quantity`` in total."""
+        cls.objects.filter(product_id=product_id).delete()
+        cls.objects.bulk_create([
+            cls(product_id=product_id, shard=shard, quantity=share)
+            for shard, share in enumerate(cls.split(quantity, shard_count))
+        ])
+
+
+class CatalogRemoval(models.Model):
+    """A deleted product, so catalog deltas can tell clients to drop it."""
+    product_id = models.BigIntegerField()
+    version = models.BigIntegerField(db_index=True)
+
+    def __str__(self):
+        return f"Product {self.product_id} removed at {self.version}"
+
+
+class CatalogVersionCounter(models.Model):
+    """
+    The single row holding the last catalog version issued, on backends
+    without sequences (see next_catalog_version). Incrementing it locks the
+    row until the transaction ends, which costs nothing extra on SQLite,
+    where writers take turns anyway.
+    """
+    value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def next_value(cls, at_least):
+        """Advance the counter to the greater of its next value and ``at_least``, and return it."""
+        with transaction.atomic():
+            if not cls.objects.filter(pk=1).update(value=Greatest(F('value') + 1, Value(at_least))):
+                # Removed along with the rest of the data, e.g. by flush
+                cls.objects.create(pk=1, value=at_least)
+            return cls.objects.values_list('value', flat=True).get(pk=1)
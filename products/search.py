@@ -0,0 +1,87 @@
+"""
+Product search by product or category name, ranked best match first.
+
+Every backend matches the same way: the search term, case-insensitively, as
+a substring of the product or category name. PostgreSQL serves that with
+pg_trgm GIN indexes on the upper-cased names; SQLite with an FTS5 table
+using the trigram tokenizer, kept in sync by triggers (see migration
+0003_product_search). Terms shorter than a trigram, and other backends,
+fall back to an unindexed substring scan.
+
+Results carry a ``search_rank`` annotation, higher for better matches, and
+are ordered by ``SEARCH_ORDERING``.
+"""
+from django.db import connection
+from django.db.models import Case, FloatField, Q, Value, When
+from django.db.models.expressions import RawSQL
+
+from .models import Category
+
+FTS_TABLE = 'products_product_fts'
+# The trigram tokenizer can't match anything shorter
+FTS_MIN_TERM_LENGTH = 3
+
+SEARCH_ORDERING = ('-search_rank', 'name', 'id')
+
+_fts_available = None
+
+
+def search_products(queryset, term):
+    """Filter ``queryset`` to products matching ``term`` and order them by relevance."""
+    term = term.strip()
+    if not term:
+        return queryset
+
+    if connection.vendor == 'postgresql':
+        queryset = _search_trigram(queryset, term)
+    elif connection.vendor == 'sqlite' and fts_available() and len(term) >= FTS_MIN_TERM_LENGTH:
+        queryset = _search_fts(queryset, term)
+    else:
+        queryset = queryset.filter(Q(name__icontains=term) | Q(category__name__icontains=term)).annotate(
+            search_rank=Value(0.0, output_field=FloatField())
+        )
+    return queryset.order_by(*SEARCH_ORDERING)
+
+
+def fts_available():
+    global _fts_available
+    if _fts_available is None:
+        _fts_available = FTS_TABLE in connection.introspection.table_names()
+    return _fts_available
+
+
+def _search_trigram(queryset, term):
+    from django.contrib.postgres.search import TrigramSimilarity
+
+    # Resolve matching categories first so each side of the OR is served by an index
+    category_ids = list(Category.objects.filter(name__icontains=term).values_list('pk', flat=True))
+    return (
+        queryset.filter(Q(name__icontains=term) | Q(category_id__in=category_ids))
+        .annotate(search_rank=TrigramSimilarity('name', term) + Case(
+            When(name__istartswith=term, then=Value(1.0)),
+            default=Value(0.0),
+            output_field=FloatField(),
+        ))
+    )
+
+
+def _search_fts(queryset, term):
+    qn = connection.ops.quote_name
+    product_id = f"{qn(queryset.model._meta.db_table)}.{qn(queryset.model._meta.pk.column)}"
+    match = fts_match_expression(term)
+    return queryset.filter(
+        pk__in=RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [match])
+    ).annotate(
+        # bm25 is lower for better matches; name hits weigh more than category hits
+        search_rank=RawSQL(
+            f"SELECT -bm25({FTS_TABLE}, 10.0, 1.0) FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH %s AND rowid = {product_id}",
+            [match],
+            output_field=FloatField(),
+        )
+    )
+
+
+def fts_match_expression(term):
+    """An FTS5 query matching ``term`` as a substring of either column."""
+    return '"' + term.replace('"', '""') + '"'
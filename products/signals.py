@@ -0,0 +1,17 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from inventory.dashboard import dashboard_changed
+from products.catalog import record_removal
+from products.models import Product
+
+
+@receiver(post_delete, sender=Product)
+def record_catalog_removal(sender, instance, **kwargs):
+    record_removal(instance.pk)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def refresh_dashboard_for_product(sender, instance, **kwargs):
+    dashboard_changed()
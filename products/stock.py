@@ -0,0 +1,253 @@
+"""
+Stock reservation for checkouts.
+
+Rows are always locked in primary key order, so two transactions locking
+overlapping sets of products queue behind each other instead of
+deadlocking. ``atomic_with_retry`` reruns a transaction that still hits a
+transient failure (a deadlock, a serialization failure or a lock timeout),
+with a short, bounded backoff. Lock waits and retries are counted in
+``lock_stats()``.
+
+Hot products can keep their stock in ``StockShard`` counters instead
+(``enable_sharding``). A checkout takes its units from one shard without
+locking the product row, so sales of the same product no longer queue
+behind each other; the product's quantity is reconciled from its shards
+by a coalesced background job shortly after.
+"""
+import logging
+import random
+import threading
+import time
+from datetime import timedelta
+
+from django.core.exceptions import ValidationError
+from django.db import OperationalError, connection, transaction
+from django.db.models import Sum
+
+from jobs.models import Job
+from .models import Product, StockShard
+
+logger = logging.getLogger(__name__)
+
+# SQLSTATEs worth retrying: serialization_failure, deadlock_detected, lock_not_available
+TRANSIENT_SQLSTATES = {'40001', '40P01', '55P03'}
+
+MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.02  # seconds, doubled on each attempt
+RETRY_MAX_DELAY = 0.5
+# Lock waits longer than this are logged
+SLOW_LOCK_WAIT = 0.5
+# Sales of a sharded product within this window share one reconciliation
+RECONCILE_DELAY = timedelta(seconds=5)
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def reset_lock_stats():
+    with _stats_lock:
+        _stats.update(locks=0, lock_wait_seconds=0.0, max_lock_wait_seconds=0.0, retries=0, failures=0)
+
+
+reset_lock_stats()
+
+
+def lock_stats():
+    """A snapshot of the lock counters of this process since the last reset."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['avg_lock_wait_seconds'] = stats['lock_wait_seconds'] / stats['locks'] if stats['locks'] else 0.0
+    return stats
+
+
+def _record(**increments):
+    with _stats_lock:
+        for name, value in increments.items():
+            _stats[name] += value
+
+
+class InsufficientStock(ValidationError):
+    """Raised by ``reserve_stock`` when a product can't cover the quantity asked for."""
+
+
+def _shard_totals(product_ids):
+    return dict(
+        StockShard.objects.filter(product__in=product_ids).order_by()
+        .values_list('product').annotate(total=Sum('quantity'))
+    )
+
+
+def lock_products(product_ids):
+    """
+    Lock the given products for the current transaction, in primary key
+    order, and return them as ``{pk: product}``.
+
+    The shards of sharded products are locked too, after the product rows,
+    and those products' ``quantity`` is set to their shards' total.
+    """
+    started = time.monotonic()
+    products = {
+        product.pk: product
+        for product in Product.objects.select_for_update().filter(pk__in=product_ids).order_by('pk')
+    }
+    sharded = [product_id for product_id, product in products.items() if product.shard_count]
+    if sharded:
+        list(StockShard.objects.select_for_update().filter(product__in=sharded).order_by('product', 'shard').values_list('pk'))
+        totals = _shard_totals(sharded)
+        for product_id in sharded:
+            products[product_id].quantity = totals.get(product_id, 0)
+    _record_lock_wait(time.monotonic() - started, len(product_ids))
+    return products
+
+
+def _record_lock_wait(waited, count):
+    with _stats_lock:
+        _stats['locks'] += 1
+        _stats['lock_wait_seconds'] += waited
+        _stats['max_lock_wait_seconds'] = max(_stats['max_lock_wait_seconds'], waited)
+    if waited > SLOW_LOCK_WAIT:
+        logger.warning("Waited %.3fs to lock %d products", waited, count)
+
+
+def reserve_stock(quantities):
+    """
+    Lock the products in ``{product_id: quantity}``, check that each has
+    enough stock and take the quantities off it.
+
+    Sharded products aren't locked: their quantities are taken from their
+    shards, and their reconciliation is scheduled for after the commit.
+
+    Returns the products, the unsharded ones with their new quantities.
+    Raises ``InsufficientStock`` (nothing is changed once the transaction
+    rolls back) if any product is short, and ``ValidationError`` if one
+    doesn't exist.
+    """
+    started = time.monotonic()
+    products = {
+        product.pk: product
+        for product in Product.objects.select_for_update().filter(pk__in=quantities, shard_count=0).order_by('pk')
+    }
+    _record_lock_wait(time.monotonic() - started, len(products))
+    unlocked = [product_id for product_id in quantities if product_id not in products]
+    if unlocked:
+        products.update(Product.objects.in_bulk(unlocked))
+
+    missing = [product_id for product_id in quantities if product_id not in products]
+    if missing:
+        raise ValidationError(f"Product with ID {missing[0]} not found")
+
+    shortages = [
+        f"{products[product_id].name}: Available: {products[product_id].quantity}, Needed: {quantity}"
+        for product_id, quantity in quantities.items()
+        if not products[product_id].shard_count and products[product_id].quantity < quantity
+    ]
+
+    sharded = {product_id: products[product_id].shard_count for product_id in sorted(unlocked)}
+    short_shards = [
+        product_id for product_id, shard_count in sharded.items()
+        if not StockShard.take(product_id, shard_count, quantities[product_id])
+    ]
+    if short_shards:
+        available = _shard_totals(short_shards)
+        shortages.extend(
+            f"{products[product_id].name}: Available: {available.get(product_id, 0)}, Needed: {quantities[product_id]}"
+            for product_id in short_shards
+        )
+
+    if shortages:
+        raise InsufficientStock(
+            "Not enough stock for the following products:\n" + "\n".join(shortages)
+        )
+
+    new_quantities = Product.adjust_stock_bulk(
+        {product_id: -quantity for product_id, quantity in quantities.items() if product_id not in sharded},
+        sharded={},
+    )
+    for product_id, new_quantity in new_quantities.items():
+        products[product_id].quantity = new_quantity
+        products[product_id].needs_restock = new_quantity <= products[product_id].restock_level
+    if sharded:
+        transaction.on_commit(lambda: schedule_reconcile(sharded))
+    return products
+
+
+def schedule_reconcile(product_ids):
+    """Queue (or coalesce into) the reconciliation of each sharded product."""
+    for product_id in product_ids:
+        Job.enqueue(
+            'products.reconcile_stock',
+            key=str(product_id),
+            payload={'product_id': product_id},
+            delay=RECONCILE_DELAY,
+        )
+
+
+def enable_sharding(product_id, shard_count):
+    """
+    Move a product's stock into ``shard_count`` shards (or re-spread it over
+    a new number of shards).
+
+    From then on, sales take stock from the shards only, and the product's
+    own fields lag behind them: ``quantity`` and ``needs_restock``, and so
+    the catalog feed and the closing stock of the day's statement, are only
+    correct once the ``products.reconcile_stock`` job has run (within
+    ``RECONCILE_DELAY`` of a sale). Only shard products where the job worker
+    (``manage.py run_jobs``) is running; without it, those fields stay at
+    their value from before the sales until ``disable_sharding``.
+    """
+    if shard_count < 1:
+        raise ValueError("shard_count must be at least 1")
+    with transaction.atomic():
+        product = lock_products([product_id])[product_id]
+        StockShard.reset(product_id, shard_count, product.quantity)
+        Product.objects.filter(pk=product_id).update(shard_count=shard_count, quantity=product.quantity)
+        Product.reconcile_stock([product_id])
+
+
+def disable_sharding(product_id):
+    """Fold a product's shards back into its quantity and drop them."""
+    with transaction.atomic():
+        product = lock_products([product_id])[product_id]
+        if product.shard_count:
+            Product.reconcile_stock([product_id])
+            Product.objects.filter(pk=product_id).update(shard_count=0)
+            StockShard.objects.filter(product_id=product_id).delete()
+
+
+def is_transient(error):
+    """Whether ``error`` is a concurrency failure that a rerun can get past."""
+    sqlstate = getattr(error.__cause__, 'pgcode', None)
+    if sqlstate:
+        return sqlstate in TRANSIENT_SQLSTATES
+    # SQLite reports lock contention only through the message
+    return isinstance(error, OperationalError) and 'database is locked' in str(error)
+
+
+def atomic_with_retry(func, *args, **kwargs):
+    """
+    Run ``func`` in a transaction, rerunning it from the start on a transient
+    failure, up to ``MAX_ATTEMPTS`` times.
+
+    ``func`` must be safe to rerun: build new model instances inside it.
+    Inside an outer transaction it runs just once, since only the outermost
+    transaction can be rolled back and retried.
+    """
+    if connection.in_atomic_block:
+        with transaction.atomic():
+            return func(*args, **kwargs)
+
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                return func(*args, **kwargs)
+        except OperationalError as e:
+            if not is_transient(e) or attempt == MAX_ATTEMPTS:
+                if is_transient(e):
+                    _record(failures=1)
+                raise
+            delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            # Jitter so the transactions that collided don't collide again
+            delay *= random.uniform(0.5, 1.0)
+            logger.info("Retrying transaction after %s (attempt %d, waiting %.3fs)", e, attempt, delay)
+            _record(retries=1)
+            time.sleep(delay)
@@ -0,0 +1,13 @@
+from inventory.dashboard import refresh_dashboard
+from jobs.registry import register
+from .models import Product
+
+
+@register('dashboard.refresh')
+def refresh_dashboard_metrics():
+    refresh_dashboard()
+
+
+@register('products.reconcile_stock')
+def reconcile_stock(product_id):
+    Product.reconcile_stock([product_id])
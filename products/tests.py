@@ -1,3 +1,456 @@
-from django.test import TestCase
+import base64
+import json
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from inventory.dashboard import dashboard_metrics, metric_events
+from inventory.pagination import KeysetPaginator
+from jobs.models import Job
+from jobs.worker import run_pending
+from products.catalog import DELTA_OVERLAP, REMOVAL_RETENTION
+from products.models import CatalogRemoval, Category, Product, can_update_returning, next_catalog_version
+from products.search import SEARCH_ORDERING, fts_available, search_products
+from products.stock import (
+    MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, atomic_with_retry, is_transient, lock_stats, reset_lock_stats,
+)
+
+
+
+def microseconds(delta):
+    """``delta`` in catalog version units."""
+    return delta // timedelta(microseconds=1)
+
+
+def encode_token(value):
+    """A cursor in KeysetPaginator's encoding, whatever it holds."""
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DashboardMetricsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Drinks', slug='drinks')
+        cls.product = Product.objects.create(
+            category=category, name='Juice', slug='juice',
+            regular_price=10, bulk_price=8, dozen_price=9, quantity=20, restock_level=5,
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def run_refresh(self):
+        Job.objects.filter(name='dashboard.refresh').update(run_after=timezone.now())
+        return run_pending()
+
+    def test_stock_changes_queue_one_refresh(self):
+        self.assertEqual(dashboard_metrics()['low_stock_count'], 0)
+        for change in (-10, -6):
+            with self.captureOnCommitCallbacks(execute=True):
+                Product.adjust_stock(self.product.pk, change)
+        job = Job.objects.get(name='dashboard.refresh', status=Job.PENDING)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertEqual(dashboard_metrics()['total_stock'], 20)
+
+        self.assertEqual(self.run_refresh(), 1)
+        metrics = dashboard_metrics()
+        self.assertEqual(metrics['low_stock_count'], 1)
+        self.assertEqual(metrics['total_stock'], 4)
+
+    def test_home_reads_the_metrics_from_the_cache(self):
+        computed_at = dashboard_metrics()['computed_at']
+        response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['metrics']['computed_at'], computed_at)
+        self.assertContains(response, f'Updated <span data-metric="computed_at">{computed_at:%H:%M:%S}</span>')
+
+    async def test_events_carry_only_the_changed_metrics(self):
+        def parse(event):
+            name, data = event.strip().split('\n')
+            return name, json.loads(data.removeprefix('data: '))
+
+        events = metric_events()
+        name, first = parse(await anext(events))
+        self.assertEqual(name, 'event: metrics')
+        self.assertEqual(first['low_stock_count'], 0)
+
+        def sell():
+            with self.captureOnCommitCallbacks(execute=True):
+                Product.adjust_stock(self.product.pk, -16)
+            self.run_refresh()
+
+        # Published by the refresh, not read by the stream
+        await sync_to_async(sell)()
+        _, changed = parse(await anext(events))
+        self.assertEqual(changed['low_stock_count'], 1)
+        self.assertNotIn('total_products', changed)
+        await events.aclose()
+
+
+
+class StockAdjustmentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Drinks', slug='drinks')
+        cls.juice, cls.water = (
+            Product.objects.create(
+                category=category, name=name, slug=name.lower(),
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=quantity, restock_level=5,
+            )
+            for name, quantity in (('Juice', 20), ('Water', 3))
+        )
+
+    def test_update_returning_and_orm_fallback_agree(self):
+        paths = [True, False] if can_update_returning() else [False]
+        for update_returning in paths:
+            with self.subTest(update_returning=update_returning):
+                Product.objects.filter(pk=self.juice.pk).update(quantity=20, needs_restock=False)
+                Product.objects.filter(pk=self.water.pk).update(quantity=3, needs_restock=True)
+                versions = dict(Product.objects.values_list('pk', 'catalog_version'))
+
+                with mock.patch('products.models.can_update_returning', return_value=update_returning):
+                    quantities = Product.adjust_stock_bulk({self.juice.pk: -16, self.water.pk: 4})
+
+                self.assertEqual(quantities, {self.juice.pk: 4, self.water.pk: 7})
+                products = {product.pk: product for product in Product.objects.all()}
+                self.assertTrue(products[self.juice.pk].needs_restock)
+                self.assertFalse(products[self.water.pk].needs_restock)
+                for pk, version in versions.items():
+                    self.assertGreater(products[pk].catalog_version, version)
+
+    def test_update_quantity_keeps_the_instance_in_step(self):
+        self.assertEqual(self.juice.update_quantity(-15), 5)
+        self.assertEqual((self.juice.quantity, self.juice.needs_restock), (5, True))
+        self.juice.refresh_from_db()
+        self.assertEqual(self.juice.quantity, 5)
+
+    def test_save_after_update_quantity_keeps_the_new_stock(self):
+        product = Product.objects.get(pk=self.juice.pk)
+        product.update_quantity(-15)
+        self.assertEqual(product.get_changed_fields(), set())
+
+        product.name = 'Orange juice'
+        product.save()
+        self.assertEqual((product.quantity, product.needs_restock), (5, True))
+        product.refresh_from_db()
+        self.assertEqual((product.name, product.quantity, product.needs_restock), ('Orange juice', 5, True))
+
+
+
+class CatalogTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Drinks', slug='drinks')
+        cls.juice, cls.water, cls.soda = (
+            Product.objects.create(
+                category=category, name=name, slug=name.lower(),
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=5,
+            )
+            for name in ('Juice', 'Water', 'Soda')
+        )
+
+    def get(self, **params):
+        headers = {'If-None-Match': params.pop('etag')} if 'etag' in params else {}
+        return self.client.get(reverse('product_catalog'), params, headers=headers)
+
+    def names(self, response):
+        name = response.json()['columns'].index('name')
+        return {row[name] for row in response.json()['products']}
+
+    def test_versions_come_from_the_database_and_increase(self):
+        versions = [next_catalog_version() for _ in range(3)]
+        self.assertEqual(versions, sorted(set(versions)))
+
+    def test_unchanged_catalog_is_not_modified(self):
+        first = self.get()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(self.names(first), {'Juice', 'Water', 'Soda'})
+        self.assertEqual(self.get(etag=first['ETag']).status_code, 304)
+
+        Product.adjust_stock(self.juice.pk, -1)
+        changed = self.get(etag=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], first['ETag'])
+
+    def test_since_returns_only_the_changes(self):
+        # Stamp the catalog as if the client had fetched it well before now
+        fetched = self.get().json()['version'] - 2 * microseconds(DELTA_OVERLAP)
+        Product.objects.update(catalog_version=fetched - microseconds(DELTA_OVERLAP))
+
+        self.juice.regular_price = 12
+        self.juice.save()
+        self.soda.delete()
+
+        delta = self.get(since=fetched).json()
+        self.assertFalse(delta['full'])
+        self.assertEqual(self.names(self.get(since=fetched)), {'Juice'})
+        self.assertEqual(len(delta['removed']), 1)
+        self.assertGreater(delta['version'], fetched)
+
+        etag = self.get(since=fetched)['ETag']
+        self.assertEqual(self.get(since=fetched, etag=etag).status_code, 304)
+
+    def test_since_beyond_the_removal_log_is_a_full_snapshot(self):
+        version = self.get().json()['version']
+        snapshot = self.get(since=version - microseconds(REMOVAL_RETENTION + DELTA_OVERLAP)).json()
+        self.assertTrue(snapshot['full'])
+        self.assertEqual(len(snapshot['products']), 3)
+        # A version the server never issued
+        self.assertTrue(self.get(since=version + 1).json()['full'])
+
+    def test_old_removals_are_pruned(self):
+        old = CatalogRemoval.objects.create(
+            product_id=999, version=next_catalog_version() - microseconds(REMOVAL_RETENTION) - 1,
+        )
+        water_id = self.water.pk
+        self.water.delete()
+        self.assertFalse(CatalogRemoval.objects.filter(pk=old.pk).exists())
+        self.assertTrue(CatalogRemoval.objects.filter(product_id=water_id).exists())
+
+
+def pg_error(sqlstate):
+    """An OperationalError as Django raises it for a psycopg error with ``sqlstate``."""
+    cause = Exception("simulated")
+    cause.pgcode = sqlstate
+    error = OperationalError("simulated")
+    error.__cause__ = cause
+    return error
+
+
+class RetryTests(TransactionTestCase):
+    """atomic_with_retry only retries outside a transaction, hence TransactionTestCase."""
+
+    def setUp(self):
+        reset_lock_stats()
+        sleep = mock.patch('products.stock.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def failing(self, *errors, result='done'):
+        """A function raising ``errors`` on its first calls, then returning ``result``."""
+        errors = list(errors)
+
+        def func():
+            func.calls += 1
+            if errors:
+                raise errors.pop(0)
+            return result
+        func.calls = 0
+        return func
+
+    def delays(self):
+        return [call.args[0] for call in self.sleep.call_args_list]
+
+    def test_classification(self):
+        for sqlstate in ('40001', '40P01', '55P03'):
+            self.assertTrue(is_transient(pg_error(sqlstate)), sqlstate)
+        self.assertFalse(is_transient(pg_error('23505')))
+        self.assertFalse(is_transient(pg_error('57014')))
+        self.assertTrue(is_transient(OperationalError('database is locked')))
+        self.assertFalse(is_transient(OperationalError('no such table: products_product')))
+        self.assertFalse(is_transient(IntegrityError('database is locked')))
+
+    def test_transient_failures_are_retried_with_backoff(self):
+        func = self.failing(pg_error('40P01'), OperationalError('database is locked'))
+        self.assertEqual(atomic_with_retry(func), 'done')
+        self.assertEqual(func.calls, 3)
+        self.assertEqual(lock_stats()['retries'], 2)
+
+        first, second = self.delays()
+        self.assertTrue(RETRY_BASE_DELAY / 2 <= first <= RETRY_BASE_DELAY)
+        self.assertTrue(RETRY_BASE_DELAY <= second <= RETRY_BASE_DELAY * 2)
+
+    def test_backoff_is_capped(self):
+        attempts = 12
+        func = self.failing(*[pg_error('40001')] * (attempts - 1))
+        with mock.patch('products.stock.MAX_ATTEMPTS', attempts):
+            atomic_with_retry(func)
+        delays = self.delays()
+        self.assertEqual(len(delays), attempts - 1)
+        self.assertTrue(all(delay <= RETRY_MAX_DELAY for delay in delays))
+        self.assertGreaterEqual(delays[-1], RETRY_MAX_DELAY / 2)
+
+    def test_last_failure_is_raised(self):
+        errors = [pg_error('55P03') for _ in range(MAX_ATTEMPTS)]
+        func = self.failing(*errors)
+        with self.assertRaises(OperationalError) as raised:
+            atomic_with_retry(func)
+        self.assertIs(raised.exception, errors[-1])
+        self.assertEqual(func.calls, MAX_ATTEMPTS)
+        self.assertEqual(len(self.delays()), MAX_ATTEMPTS - 1)
+        self.assertEqual((lock_stats()['retries'], lock_stats()['failures']), (MAX_ATTEMPTS - 1, 1))
+
+    def test_other_failures_are_not_retried(self):
+        func = self.failing(pg_error('23505'))
+        with self.assertRaises(OperationalError):
+            atomic_with_retry(func)
+        self.assertEqual(func.calls, 1)
+        self.sleep.assert_not_called()
+        self.assertEqual(lock_stats()['failures'], 0)
+
+    def test_runs_once_inside_a_transaction(self):
+        func = self.failing(pg_error('40001'))
+        with self.assertRaises(OperationalError), transaction.atomic():
+            atomic_with_retry(func)
+        self.assertEqual(func.calls, 1)
+        self.sleep.assert_not_called()
+
+class ProductSearchTests(TestCase):
+    """The matching rules every backend's search follows; see products/search.py."""
+
+    @classmethod
+    def setUpTestData(cls):
+        drinks = Category.objects.create(name='Drinks', slug='drinks')
+        kitchen = Category.objects.create(name='Kitchen', slug='kitchen')
+        juices = Category.objects.create(name='Fresh Juices', slug='fresh-juices')
+        for category, name in (
+            (drinks, 'Orange Juice'), (kitchen, 'Juicer'), (juices, 'Apple'), (drinks, 'Water'), (kitchen, 'Pan'),
+        ):
+            Product.objects.create(
+                category=category, name=name, slug=name.lower().replace(' ', '-'),
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=5,
+            )
+
+    def search(self, term):
+        return list(search_products(Product.objects.all(), term).values_list('name', flat=True))
+
+    def test_uses_the_index_where_there_is_one(self):
+        if connection.vendor == 'sqlite':
+            self.assertTrue(fts_available())
+
+    def test_matches_substrings_of_product_and_category_names(self):
+        self.assertEqual(set(self.search('uice')), {'Orange Juice', 'Juicer', 'Apple'})
+        self.assertEqual(self.search('range jui'), ['Orange Juice'])
+        self.assertEqual(self.search('ate'), ['Water'])
+
+    def test_is_case_insensitive(self):
+        self.assertEqual(set(self.search('JUICE')), {'Orange Juice', 'Juicer', 'Apple'})
+
+    def test_name_matches_rank_above_category_matches(self):
+        results = self.search('juice')
+        self.assertEqual(results[-1], 'Apple')
+
+    def test_short_terms_and_quotes(self):
+        self.assertEqual(set(self.search('an')), {'Orange Juice', 'Pan'})
+        self.assertEqual(self.search('"juice'), [])
+        self.assertEqual(self.search('nothing like it'), [])
+
+    def test_results_carry_a_rank(self):
+        ranks = list(search_products(Product.objects.all(), 'juice').values_list('search_rank', flat=True))
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+class ProductListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Drinks', slug='drinks')
+        Product.objects.bulk_create([
+            Product(
+                category=category, name=f'Juice {i:02}', slug=f'juice-{i}',
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=i, restock_level=5,
+            )
+            for i in range(60)
+        ])
+
+    async def test_pages_under_asgi(self):
+        response = await self.async_client.get(reverse('product_list'))
+        self.assertContains(response, 'Juice 49')
+        self.assertNotContains(response, 'Juice 50')
+        response = await self.async_client.get(reverse('product_list'), {'cursor': response.context['page'].next_cursor})
+        self.assertContains(response, 'Juice 59')
+
+    async def test_search_results_page_by_rank(self):
+        response = await self.async_client.get(reverse('product_list'), {'search_term': 'juice 0'})
+        page = response.context['page']
+        self.assertEqual([product.name for product in page], [f'Juice {i:02}' for i in range(10)])
+
+        response = await self.async_client.get(reverse('product_list'), {'search_term': 'juice'})
+        first = response.context['page']
+        self.assertEqual((len(first), first.count_label), (50, '60'))
+        response = await self.async_client.get(
+            reverse('product_list'), {'search_term': 'juice', 'cursor': first.next_cursor}
+        )
+        second = response.context['page']
+        self.assertEqual(len(second), 10)
+        self.assertFalse(second.has_next)
+        self.assertTrue(second.has_previous)
+        seen = {product.pk for product in first} | {product.pk for product in second}
+        self.assertEqual(len(seen), 60)
+
+    def test_csv_export_streams_only_the_needed_columns(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('product_list'), {'export': 'csv'})
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="products.csv"')
+        self.assertEqual(lines[0], 'Name,Regular Price,Bulk Price,Dozen Price,Quantity,Stock Level')
+        self.assertEqual(len(lines), 61)
+        self.assertEqual(lines[60], 'Juice 59,10.00,8.00,9.00,59,In Stock')
+
+    async def test_csv_export_streams_under_asgi(self):
+        response = await self.async_client.get(reverse('product_list'), {'export': 'csv', 'available_only': 'on'})
+        self.assertTrue(response.is_async)
+        lines = b''.join([chunk async for chunk in response.streaming_content]).decode().splitlines()
+        self.assertEqual(len(lines), 61)
+        self.assertEqual(lines[1], 'Juice 00,10.00,8.00,9.00,0,Low Stock')
+
+
+class KeysetPaginatorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Repeated names, so that the id breaks ties
+        Category.objects.bulk_create([
+            Category(name=f'Category {i // 2}', slug=f'category-{i}') for i in range(25)
+        ])
+        cls.ordered = list(Category.objects.order_by('name', 'id'))
+
+    def paginator(self):
+        return KeysetPaginator(Category.objects.all(), ('name', 'id'), per_page=10)
+
+    def test_pages_forwards_and_backwards(self):
+        paginator = self.paginator()
+        pages = [paginator.get_page()]
+        while pages[-1].has_next:
+            pages.append(paginator.get_page(pages[-1].next_cursor))
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual([category for page in pages for category in page], self.ordered)
+        self.assertFalse(pages[0].has_previous)
+
+        back = paginator.get_page(pages[2].previous_cursor)
+        self.assertEqual(list(back), list(pages[1]))
+        self.assertTrue(back.has_previous)
+        self.assertTrue(back.has_next)
+        first = paginator.get_page(back.previous_cursor)
+        self.assertEqual(list(first), list(pages[0]))
+        self.assertFalse(first.has_previous)
+
+    def test_invalid_cursors_give_the_first_page(self):
+        paginator = self.paginator()
+        first = list(paginator.get_page())
+        for cursor in ('', 'garbage', '!!!', encode_token(['x', ['Category 1', 1]]),
+                       encode_token(['n', ['Category 1']]), encode_token(['n', ['Category 1', 'one']]),
+                       encode_token({'n': 1})):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(list(paginator.get_page(cursor)), first)
+
+    def test_orders_by_an_annotation(self):
+        category = Category.objects.create(name='Drinks', slug='drinks')
+        Product.objects.bulk_create([
+            Product(
+                category=category, name=name, slug=f'lemon-{i}',
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=5,
+            )
+            for i, name in enumerate(['Lemon', 'Lemonade', 'Bitter Lemon', 'Lemon Curd', 'Fizzy Lemon Drink'])
+        ])
+        queryset = search_products(Product.objects.all(), 'lemon')
+        paginator = KeysetPaginator(queryset, SEARCH_ORDERING, per_page=2)
+        pages = [paginator.get_page()]
+        while pages[-1].has_next:
+            pages.append(paginator.get_page(pages[-1].next_cursor))
+        self.assertEqual([product.pk for page in pages for product in page], [product.pk for product in queryset])
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(list(paginator.get_page(pages[2].previous_cursor)), list(pages[1]))
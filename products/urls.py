@@ -1,9 +1,10 @@
 from django.urls import path
-from .views import category_list, product_list_by_category, product_list, product_detail, product_create, product_edit, product_delete, home
+from .views import category_list, product_list_by_category, product_list, product_detail, product_create, product_edit, product_delete, product_catalog, home, dashboard_events
 
 
 urlpatterns = [
     path('', home, name='home'), 
+    path('events/dashboard/', dashboard_events, name='dashboard_events'),
     # Category URLs
     path('category_list/', category_list, name='category_list'),
     path('categories/<int:category_id>/products/', product_list_by_category, name='product_list_by_category'),
@@ -11,6 +12,7 @@ urlpatterns = [
     # Product URLs
 
     path('product_list/', product_list, name='product_list'),
+    path('catalog/', product_catalog, name='product_catalog'),
     path('products/<slug:slug>/', product_detail, name='product_detail'),
     path('product_create/', product_create, name='product_create'),
     path('products/<slug:slug>/edit/', product_edit, name='product_edit'),
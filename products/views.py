@@ -1,76 +1,60 @@
-import csv
-from datetime import date
 from django.contrib import messages
-from django.http import HttpResponse
 from django.db import transaction
-from django.db.models import Q, Sum
-from django.shortcuts import render, redirect, get_object_or_404
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db.models import Q
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, render, redirect, get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+from inventory.dashboard import dashboard_metrics, metric_events, sse_event
+from inventory.exports import aqueryset_rows, queryset_rows, stream_csv
+from inventory.pagination import KeysetPaginator
+from products.catalog import catalog_snapshot, catalog_version
 from products.forms import ProductCreateForm, SearchProductCategory
 from products.models import Category, Product
-from sales.models import Sale, SaleItem
-from statement.models import InventoryStatement
+from products.search import SEARCH_ORDERING, search_products
 
+PAGE_SIZE = 10
+PRODUCT_PAGE_SIZE = 50
+# Milliseconds before a browser re-requests dashboard_events served over WSGI
+WSGI_EVENTS_RETRY = 10_000
 
 
 
 # Home View
 def home(request):
-    today = date.today()
-
-    # Get counts and totals
-    low_stock_count = Product.objects.filter(needs_restock=True).count()
-    total_products = Product.objects.count()
-    today_sales_count = Sale.objects.filter(sale_date__date=today).count()
-    total_stock = Product.objects.aggregate(total=Sum('quantity'))['total'] or 0
-
-    # Calculate today's sales data
-    today_sales = Sale.objects.filter(sale_date__date=today)
-    total_income = today_sales.aggregate(total=Sum('total_amount'))['total'] or 0
-    total_products_sold = SaleItem.objects.filter(sale__sale_date__date=today).aggregate(total=Sum('quantity'))['total'] or 0
-
-    # Ensure only one statement per day
-    statement, created = InventoryStatement.objects.get_or_create(
-        date=today,  # Changed from generated_at to date
-        defaults={
-            'company_name': 'Your Company',  # Add appropriate default values
-            'prepared_by': 'System',
-            'notes': 'Automatically generated daily statement'
-        }
-    )
-    
-    # Call your existing method to generate statement items
-    if created:
-        statement.generate_statement_items()
+    # Today's statement is opened by the day-open job, not by this page
+    metrics = dashboard_metrics()
 
     context = {
         'title': 'Welcome to the Inventory Management System',
-        'total_products': total_products,
-        'low_stock_count': low_stock_count,
-        'today_sales': today_sales_count,
-        'statement': statement
+        'metrics': metrics,
     }
 
     return render(request, 'home.html', context)
 
 
+async def dashboard_events(request):
+    """Live dashboard metrics as Server-Sent Events; see inventory.dashboard."""
+    if isinstance(request, ASGIRequest):
+        events = metric_events()
+    else:
+        # A WSGI worker can't be held by an endless stream: send the current
+        # metrics and let the browser reconnect, which makes it a cheap poll
+        metrics = await sync_to_async(dashboard_metrics)()
+        events = iter([f"retry: {WSGI_EVENTS_RETRY}\n" + sse_event('metrics', metrics)])
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
 
 # Category Views
 def category_list(request):
-    categories_list = Category.objects.all()
-    
-    # Define page size as a constant
-    PAGE_SIZE = 10
-    
-    paginator = Paginator(categories_list, PAGE_SIZE)
-    page = request.GET.get('page')
-    
-    try:
-        categories = paginator.page(page)
-    except PageNotAnInteger:
-        categories = paginator.page(1)
-    except EmptyPage:
-        categories = paginator.page(paginator.num_pages)
+    paginator = KeysetPaginator(Category.objects.all(), ('name', 'id'), PAGE_SIZE)
+    categories = paginator.get_page(request.GET.get('cursor'))
 
     context = {
         'title': 'Product Categories',
@@ -83,11 +67,14 @@ def product_list_by_category(request, category_id):
     category = get_object_or_404(Category, id=category_id)
     # Use select_related to reduce database hits
     products = Product.objects.filter(category=category).select_related('category')
+    paginator = KeysetPaginator(products, ('name', 'id'), PRODUCT_PAGE_SIZE, with_count=True)
+    page = paginator.get_page(request.GET.get('cursor'))
     
     context = {
         'title': f'Products in {category.name}',
         'category': category,
-        'products': products,
+        'products': page,
+        'page': page,
     }
     return render(request, 'products/product_list_by_category.html', context)
 
@@ -110,12 +97,17 @@ def product_create(request):
     return render(request, 'products/product_form.html', {'title': 'Add Product', 'form': form})
 
 
-def product_list(request):
+def _product_search(data):
+    """
+    The search form for the product_list filters in ``data``, the filtered
+    queryset and the search term. Validating the category and resolving a
+    search both query the database.
+    """
     # Start with base queryset and apply filters as needed
     queryset = Product.objects.all().select_related('category')
-    form = SearchProductCategory(request.GET or None)
-    restock_needed = Product.objects.filter(needs_restock=True).count()
-    
+    form = SearchProductCategory(data or None)
+    search_term = None
+
     if form.is_valid():
         category = form.cleaned_data.get('category')
         search_term = form.cleaned_data.get('search_term')
@@ -128,10 +120,6 @@ def product_list(request):
         if category:
             filters &= Q(category=category)
         
-        if search_term:
-            search_filters = Q(name__icontains=search_term) | Q(category__name__icontains=search_term)
-            filters &= search_filters
-        
         if available_only:
             filters &= Q(available=True)
             
@@ -141,57 +129,83 @@ def product_list(request):
         # Apply all filters at once
         if filters:
             queryset = queryset.filter(filters)
+
+        if search_term:
+            queryset = search_products(queryset, search_term)
+
+    return form, queryset, search_term
+
+
+def _stock_level_row(row):
+    # Determine stock level status text
+    name, regular_price, bulk_price, dozen_price, quantity, restock_level = row
+    return (name, regular_price, bulk_price, dozen_price, quantity,
+            "Low Stock" if quantity <= restock_level else "In Stock")
+
+
+async def product_list(request):
+    form, queryset, search_term = await sync_to_async(_product_search)(request.GET)
+    restock_needed = await Product.objects.filter(needs_restock=True).acount()
     
     # Check if the request is for CSV export
     is_csv_export = request.GET.get('export') == 'csv'
     
     if is_csv_export:
-        # Create a CSV response
-        response = HttpResponse(content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="products.csv"'
-        
-        # Create CSV writer
-        writer = csv.writer(response)
-        
-        # Write header row - matching the fields in your template
-        writer.writerow(['Name', 'Regular Price', 'Bulk Price', 'Dozen Price', 'Quantity', 'Stock Level'])
-        
-        # Write data rows
-        for product in queryset:
-            # Determine stock level status text
-            stock_status = "Low Stock" if product.quantity <= product.restock_level else "In Stock"
-            
-            writer.writerow([
-                product.name,
-                product.regular_price,
-                product.bulk_price,
-                product.dozen_price,
-                product.quantity,
-                stock_status
-            ])
-        
-        return response
+        fields = ['name', 'regular_price', 'bulk_price', 'dozen_price', 'quantity', 'restock_level']
+        if isinstance(request, ASGIRequest):
+            rows = (_stock_level_row(row) async for row in aqueryset_rows(queryset, fields))
+        else:
+            rows = (_stock_level_row(row) for row in queryset_rows(queryset, fields))
+        # Header row - matching the fields in your template
+        return stream_csv(
+            'products.csv',
+            ['Name', 'Regular Price', 'Bulk Price', 'Dozen Price', 'Quantity', 'Stock Level'],
+            rows,
+        )
     else:
-        # Standard HTML response
+        # Standard HTML response; search results page through in order of relevance
+        ordering = SEARCH_ORDERING if search_term else ('name', 'id')
+        paginator = KeysetPaginator(queryset, ordering, PRODUCT_PAGE_SIZE, with_count=True)
+        page = products = await paginator.aget_page(request.GET.get('cursor'))
+
         context = {
             'title': 'Products Inventory',
             'form': form,
-            'products': queryset,
+            'products': products,
+            'page': page,
             'restock_needed': restock_needed,
         }
         return render(request, 'products/product_list.html', context)
 
 
-def product_detail(request, slug):
+def product_catalog(request):
+    """
+    JSON catalog of in-stock products for the sale form. ``?since=<version>``
+    returns only what changed after that version; unchanged catalogs answer
+    ``If-None-Match`` with 304 Not Modified.
+    """
+    since = request.GET.get('since', '')
+    since = int(since) if since.isdigit() else None
+
+    version = catalog_version()
+    etag = quote_etag(f'catalog-{version}' if since is None else f'catalog-{version}-since-{since}')
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = JsonResponse(catalog_snapshot(version, since))
+    response.headers['ETag'] = etag
+    # Cache, but revalidate on every use so price and stock are never stale
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+async def product_detail(request, slug):
     # Use select_related to reduce queries
-    product = get_object_or_404(Product.objects.select_related('category'), slug=slug)
-    # Use select_related to get related sales data efficiently
-    sales = SaleItem.objects.filter(product=product).select_related('sale')
+    product = await aget_object_or_404(Product.objects.select_related('category'), slug=slug)
     
     context = {
         'title': f'Product: {product.name}',
         'product': product,
-        'sales': sales,
     }
     return render(request, 'products/product_detail.html', context)
 
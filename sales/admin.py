@@ -1,5 +1,5 @@
 from django.contrib import admin
-from sales.models import Sale, SaleItem
+from sales.models import Sale, SaleIdempotencyKey, SaleItem
 
 @admin.register(Sale)
 class SaleAdmin(admin.ModelAdmin):
@@ -18,3 +18,10 @@ class SaleItemAdmin(admin.ModelAdmin):
     @admin.display(description="Total Price")
     def total_price_display(self, obj):
         return f"${obj.total_price:.2f}" if hasattr(obj, 'total_price') else "N/A"
+
+
+@admin.register(SaleIdempotencyKey)
+class SaleIdempotencyKeyAdmin(admin.ModelAdmin):
+    list_display = ('key', 'sale', 'created')
+    search_fields = ('key', 'sale__id')
+    readonly_fields = ('key', 'sale', 'created')
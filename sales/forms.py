@@ -1,10 +1,17 @@
+import uuid
+
 from django import forms
 from django.db import transaction
-from django.forms import inlineformset_factory, ValidationError
+from django.forms import BaseInlineFormSet, inlineformset_factory, ValidationError
+from django.utils.functional import cached_property
 from products.models import Product
 from .models import Sale, SaleItem
 
 class SaleForm(forms.ModelForm):
+    # Issued with the form and recorded with the sale, so a resubmitted form
+    # finds the sale it already created instead of selling twice
+    idempotency_key = forms.CharField(max_length=64, required=False, widget=forms.HiddenInput)
+
     class Meta:
         model = Sale
         fields = ['seller_name']
@@ -16,9 +23,43 @@ class SaleForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         self.fields['seller_name'].label = "Seller Name"
         self.fields['seller_name'].required = True
+        if not self.is_bound:
+            self.initial.setdefault('idempotency_key', uuid.uuid4().hex)
+
+
+class ProductChoiceField(forms.ModelChoiceField):
+    """
+    A product choice that is looked up in ``products`` (``{pk: product}``,
+    preloaded by the formset) instead of with a query per form.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.products = None
+        super().__init__(*args, **kwargs)
+
+    def to_python(self, value):
+        if self.products is None or value in self.empty_values:
+            return super().to_python(value)
+        try:
+            product = self.products.get(int(value))
+        except (TypeError, ValueError):
+            product = None
+        if product is None:
+            raise ValidationError(
+                self.error_messages['invalid_choice'],
+                code='invalid_choice',
+                params={'value': value},
+            )
+        return product
 
 
 class SaleItemForm(forms.ModelForm):
+    # Declared rather than generated from the model, so an existing product
+    # isn't looked up again by the ForeignKey check in full_clean()
+    product = ProductChoiceField(
+        queryset=Product.objects.filter(quantity__gt=0),
+        widget=forms.Select(attrs={'class': 'form-control'}),
+    )
     custom_bulk_minimum = forms.IntegerField(
         required=False,
         widget=forms.NumberInput(attrs={
@@ -31,16 +72,15 @@ class SaleItemForm(forms.ModelForm):
 
     class Meta:
         model = SaleItem
-        fields = ['product', 'quantity', 'sale_type', 'custom_bulk_minimum']
+        fields = ['quantity', 'sale_type', 'custom_bulk_minimum']
         widgets = {
-            'product': forms.Select(attrs={'class': 'form-control'}),
             'quantity': forms.NumberInput(attrs={'class': 'form-control', 'min': '1'}),
             'sale_type': forms.Select(attrs={'class': 'form-control'}),
         }
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, products=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['product'].queryset = Product.objects.filter(quantity__gt=0)
+        self.fields['product'].products = products
 
     def clean(self):
         cleaned_data = super().clean()
@@ -49,6 +89,9 @@ class SaleItemForm(forms.ModelForm):
         sale_type = cleaned_data.get('sale_type')
         custom_bulk_minimum = cleaned_data.get('custom_bulk_minimum')
 
+        if product:
+            self.instance.product = product
+
         if not all([product, quantity, sale_type]):
             return cleaned_data
 
@@ -103,4 +146,31 @@ class SaleItemForm(forms.ModelForm):
         return sale_item
 
 
-SaleItemFormSet = inlineformset_factory(Sale, SaleItem, form=SaleItemForm, extra=1, can_delete=True)
+class BaseSaleItemFormSet(BaseInlineFormSet):
+    """
+    Resolves the products of all submitted forms with one query and shares
+    the instances between the forms, so validating a basket costs the same
+    however many lines it has.
+    """
+
+    @cached_property
+    def products(self):
+        if not self.is_bound:
+            return None
+        product_ids = set()
+        for i in range(self.total_form_count()):
+            value = self.data.get(self.add_prefix(i) + '-product')
+            if value and str(value).isdigit():
+                product_ids.add(int(value))
+        return Product.objects.filter(quantity__gt=0).in_bulk(product_ids)
+
+    def get_form_kwargs(self, index):
+        kwargs = super().get_form_kwargs(index)
+        if index is not None:
+            kwargs['products'] = self.products
+        return kwargs
+
+
+SaleItemFormSet = inlineformset_factory(
+    Sale, SaleItem, form=SaleItemForm, formset=BaseSaleItemFormSet, extra=1, can_delete=True
+)
@@ -0,0 +1,268 @@
+"""
+Batch ingestion of sales queued by offline POS terminals.
+
+A batch is validated, priced and recorded in one transaction (retried on
+deadlocks and serialization failures). Every product it touches is locked
+once, in primary key order, and the sales, their items
+and stock updates are written with bulk inserts. Each sale carries a
+client-chosen idempotency key; replaying a key returns the sale recorded
+the first time instead of selling the stock again.
+
+A sale may carry the time the terminal rang it up (``sold_at``), which
+becomes its ``sale_date`` so that replayed sales land on the right day's
+statement. Terminal clocks aren't trusted beyond ``MAX_SALE_AGE`` in the
+past or the server's own clock in the future; times outside that window
+are clamped to it.
+"""
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from inventory.dashboard import dashboard_changed
+from products.models import Product
+from products.stock import atomic_with_retry, lock_products
+from sales.models import Sale, SaleIdempotencyKey, SaleItem
+from sales.receipts import schedule_receipts
+from statement.models import ProductDailySales, ProductStockUpdate
+from statement.tasks import schedule_statement_update
+
+MAX_BATCH_SIZE = 200
+SALE_TYPES = {value for value, _ in SaleItem.SALE_TYPE_CHOICES}
+# Oldest sale time accepted from a terminal; older ones are recorded at this age
+MAX_SALE_AGE = timedelta(days=7)
+
+CREATED = 'created'
+DUPLICATE = 'duplicate'
+REJECTED = 'rejected'
+
+
+class BatchError(Exception):
+    """The batch as a whole is malformed; nothing was recorded."""
+
+
+def record_sales(sales, user=None):
+    """
+    Record a list of sales, each a dict with an ``idempotency_key``, a
+    ``seller_name``, optionally ``sold_at`` (an ISO 8601 date and time) and
+    ``items`` (``product``, ``quantity`` and optionally ``sale_type`` and
+    ``custom_bulk_minimum``).
+
+    Returns one result per sale, in order: ``created`` or ``duplicate`` with
+    the ``sale_id``, or ``rejected`` with the ``errors``. A rejected sale
+    doesn't affect the others.
+    """
+    if not isinstance(sales, list) or not sales:
+        raise BatchError("'sales' must be a non-empty list.")
+    if len(sales) > MAX_BATCH_SIZE:
+        raise BatchError(f"A batch can hold at most {MAX_BATCH_SIZE} sales.")
+
+    entries = [_parse_sale(data) for data in sales]
+
+    try:
+        return atomic_with_retry(_record, entries, user)
+    except IntegrityError:
+        # A concurrent request recorded one of the keys first; the retry
+        # sees it and reports that sale as a duplicate
+        return atomic_with_retry(_record, entries, user)
+
+
+def _parse_sale(data):
+    """Normalize one submitted sale, collecting its validation errors."""
+    errors = []
+    if not isinstance(data, dict):
+        return {'key': None, 'errors': ["Each sale must be an object."]}
+
+    key = data.get('idempotency_key')
+    if not isinstance(key, str) or not 0 < len(key) <= 64:
+        errors.append("'idempotency_key' must be a string of 1 to 64 characters.")
+        key = key if isinstance(key, str) else None
+
+    seller_name = data.get('seller_name')
+    if not isinstance(seller_name, str) or not seller_name.strip() or len(seller_name) > 200:
+        errors.append("'seller_name' is required (at most 200 characters).")
+
+    sold_at = data.get('sold_at')
+    if sold_at is not None:
+        sold_at = _parse_sold_at(sold_at)
+        if sold_at is None:
+            errors.append("'sold_at' must be an ISO 8601 date and time.")
+
+    items = []
+    raw_items = data.get('items')
+    if not isinstance(raw_items, list) or not raw_items:
+        errors.append("'items' must be a non-empty list.")
+        raw_items = []
+
+    for position, item in enumerate(raw_items, start=1):
+        if not isinstance(item, dict):
+            errors.append(f"Item {position} must be an object.")
+            continue
+        product_id = item.get('product')
+        quantity = item.get('quantity')
+        sale_type = item.get('sale_type', 'regular')
+        custom_bulk_minimum = item.get('custom_bulk_minimum')
+
+        if not isinstance(product_id, int) or isinstance(product_id, bool):
+            errors.append(f"Item {position}: 'product' must be a product id.")
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity <= 0:
+            errors.append(f"Item {position}: 'quantity' must be greater than zero.")
+        if sale_type not in SALE_TYPES:
+            errors.append(f"Item {position}: 'sale_type' must be one of {', '.join(sorted(SALE_TYPES))}.")
+        if custom_bulk_minimum is not None and (not isinstance(custom_bulk_minimum, int) or custom_bulk_minimum <= 0):
+            errors.append(f"Item {position}: 'custom_bulk_minimum' must be a positive number.")
+
+        items.append({
+            'product': product_id,
+            'quantity': quantity,
+            'sale_type': sale_type,
+            'custom_bulk_minimum': custom_bulk_minimum or None,
+        })
+
+    return {'key': key, 'seller_name': seller_name, 'sold_at': sold_at, 'items': items, 'errors': errors}
+
+
+def _parse_sold_at(value):
+    """The sale time in ``value``, clamped to the accepted window, or None if it isn't a date and time."""
+    try:
+        sold_at = parse_datetime(value) if isinstance(value, str) else None
+    except ValueError:
+        sold_at = None
+    if sold_at is None:
+        return None
+    if timezone.is_naive(sold_at):
+        sold_at = timezone.make_aware(sold_at)
+    now = timezone.now()
+    return min(max(sold_at, now - MAX_SALE_AGE), now)
+
+
+def _check_stock(entry, products, available):
+    """Validation errors for ``entry`` against the locked products and the stock left in the batch."""
+    errors = []
+    needed = {}
+    for item in entry['items']:
+        product = products.get(item['product'])
+        if product is None:
+            errors.append(f"Product with ID {item['product']} not found")
+            continue
+        needed[product.pk] = needed.get(product.pk, 0) + item['quantity']
+
+        custom_bulk_minimum = item['custom_bulk_minimum']
+        if item['sale_type'] == 'bulk' and custom_bulk_minimum and custom_bulk_minimum < product.minimum_bulk_quantity:
+            errors.append(
+                f"Custom bulk minimum ({custom_bulk_minimum}) for {product.name} cannot be less than "
+                f"the product's default minimum ({product.minimum_bulk_quantity})."
+            )
+
+    for product_id, quantity in needed.items():
+        if available[product_id] < quantity:
+            errors.append(
+                f"Not enough stock for {products[product_id].name}: "
+                f"Available: {available[product_id]}, Needed: {quantity}"
+            )
+    return errors, needed
+
+
+def _record(entries, user):
+    """Record the valid entries; runs in a transaction that may be retried."""
+    results = [None] * len(entries)
+    for index, entry in enumerate(entries):
+        if entry['errors']:
+            results[index] = {'idempotency_key': entry['key'], 'status': REJECTED, 'errors': entry['errors']}
+    valid = [(index, entry) for index, entry in enumerate(entries) if not entry['errors']]
+    if not valid:
+        return results
+
+    # Lock every product in the batch once, always in the same order
+    products = lock_products({item['product'] for _, entry in valid for item in entry['items']})
+    recorded = dict(
+        SaleIdempotencyKey.objects.filter(key__in=[entry['key'] for _, entry in valid]).values_list('key', 'sale_id')
+    )
+    available = {product_id: product.quantity for product_id, product in products.items()}
+
+    new_sales = []  # (index, entry, sale, sale_items)
+    batch_keys = {}  # key -> sale recorded earlier in this batch
+    repeats = []  # (index, key) of keys repeated within the batch
+    for index, entry in valid:
+        key = entry['key']
+        if key in recorded:
+            results[index] = {'idempotency_key': key, 'status': DUPLICATE, 'sale_id': recorded[key]}
+            continue
+        if key in batch_keys:
+            repeats.append((index, key))
+            continue
+
+        errors, needed = _check_stock(entry, products, available)
+        if errors:
+            results[index] = {'idempotency_key': key, 'status': REJECTED, 'errors': errors}
+            continue
+        for product_id, quantity in needed.items():
+            available[product_id] -= quantity
+
+        sale = Sale(seller_name=entry['seller_name'], user=user)
+        if entry['sold_at']:
+            sale.sale_date = entry['sold_at']
+        sale_items = []
+        for item in entry['items']:
+            product = products[item['product']]
+            sale_items.append(SaleItem(
+                product=product,
+                quantity=item['quantity'],
+                sale_type=item['sale_type'],
+                price_per_unit=SaleItem.unit_price(product, item['sale_type']),
+                custom_bulk_minimum=item['custom_bulk_minimum'] if item['sale_type'] == 'bulk' else None,
+            ))
+        sale.total_amount = sum(item.quantity * item.price_per_unit for item in sale_items)
+        batch_keys[key] = sale
+        new_sales.append((index, entry, sale, sale_items))
+
+    if new_sales:
+        Sale.objects.bulk_create([sale for _, _, sale, _ in new_sales])
+        for _, _, sale, sale_items in new_sales:
+            for item in sale_items:
+                item.sale = sale
+        SaleItem.objects.bulk_create([item for _, _, _, sale_items in new_sales for item in sale_items])
+        SaleIdempotencyKey.objects.bulk_create([
+            SaleIdempotencyKey(key=entry['key'], sale=sale) for _, entry, sale, _ in new_sales
+        ])
+
+        deltas = {
+            product_id: available[product_id] - product.quantity
+            for product_id, product in products.items()
+            if available[product_id] != product.quantity
+        }
+        Product.adjust_stock_bulk(deltas, sharded={
+            product_id: products[product_id].shard_count for product_id in deltas if products[product_id].shard_count
+        })
+        ProductDailySales.add_sales([(sale, sale_items) for _, _, sale, sale_items in new_sales])
+
+        stock_updates = []
+        for _, _, sale, sale_items in new_sales:
+            sold = {}
+            for item in sale_items:
+                sold[item.product_id] = sold.get(item.product_id, 0) + item.quantity
+            stock_updates.extend(
+                ProductStockUpdate(
+                    product=products[product_id],
+                    quantity_change=-quantity,
+                    notes=f"Sale ID: {sale.id} - Reduced stock by {quantity}",
+                )
+                for product_id, quantity in sold.items()
+            )
+        ProductStockUpdate.objects.bulk_create(stock_updates)
+
+        # Fold the sales into their statements in the background
+        sale_days = {timezone.localdate(sale.sale_date): sale.sale_date for _, _, sale, _ in new_sales}
+        for sale_date in sale_days.values():
+            transaction.on_commit(lambda sale_date=sale_date: schedule_statement_update(sale_date))
+        transaction.on_commit(lambda: schedule_receipts([sale.id for _, _, sale, _ in new_sales]))
+        dashboard_changed()
+
+        for index, entry, sale, _ in new_sales:
+            results[index] = {'idempotency_key': entry['key'], 'status': CREATED, 'sale_id': sale.id}
+
+    for index, key in repeats:
+        results[index] = {'idempotency_key': key, 'status': DUPLICATE, 'sale_id': batch_keys[key].id}
+
+    return results
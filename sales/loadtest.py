@@ -0,0 +1,168 @@
+"""
+Concurrent checkout load against sale_create, shared by the bench_checkout
+command and the tests.
+
+Worker threads post sales for random baskets of a few hot products through
+the full request stack, then the stock books are checked: no product may
+go negative, and every product's quantity must equal its starting stock
+plus its ProductStockUpdate changes, and its starting stock minus the
+units sold.
+
+On SQLite the workers still run as threads, but an in-memory database (the
+test runner's default) can't make a writer wait for another's lock, so
+there the sales are posted one at a time. A file-backed SQLite database
+takes them concurrently, waiting out its busy timeout.
+"""
+import random
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+from django.test import Client
+from django.urls import reverse
+
+from products.models import Product
+from sales.models import SaleItem
+from statement.models import ProductStockUpdate
+
+# sale_create re-renders the form with one of these when stock runs out: a
+# sold-out product fails form validation, a short one fails the reservation
+REJECTION_MESSAGES = [b'Not enough stock', b'Please correct errors in the sale items']
+
+
+def sale_form_data(lines, idempotency_key=None):
+    """
+    POST data for sale_create with one formset row per ``(product,
+    quantity)``, under a fresh idempotency key unless one is given.
+    """
+    data = {
+        'seller_name': 'Load test',
+        'idempotency_key': idempotency_key or uuid.uuid4().hex,
+        'items-TOTAL_FORMS': str(len(lines)),
+        'items-INITIAL_FORMS': '0',
+        'items-MIN_NUM_FORMS': '0',
+        'items-MAX_NUM_FORMS': '1000',
+    }
+    for i, (product, quantity) in enumerate(lines):
+        data[f'items-{i}-product'] = str(product.pk)
+        data[f'items-{i}-quantity'] = str(quantity)
+        data[f'items-{i}-sale_type'] = 'regular'
+    return data
+
+
+def request_host():
+    """A host name that ALLOWED_HOSTS accepts, for requests made outside the test runner."""
+    for host in settings.ALLOWED_HOSTS:
+        if host != '*':
+            return host.lstrip('.')
+    return 'localhost'
+
+
+def percentile(values, pct):
+    """The nearest-rank ``pct`` percentile of ``values``."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, round(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_checkout_load(products, workers, sales_per_worker, basket_size=3, max_quantity=3, seed=0):
+    """
+    Post ``workers * sales_per_worker`` sales from ``workers`` threads at
+    once and return the outcome counts, throughput and latencies.
+
+    A sale is ``recorded`` (redirected to its detail page), ``rejected``
+    for lack of stock, or an ``error`` (anything else, such as a
+    transaction that ran out of retries).
+    """
+    url = reverse('sale_create')
+    host = request_host()
+    outcomes = {'recorded': 0, 'rejected': 0, 'errors': 0}
+    latencies = []
+    results_lock = threading.Lock()
+    start_together = threading.Barrier(workers)
+    one_at_a_time = threading.Lock() if connection.vendor == 'sqlite' and connection.is_in_memory_db() else None
+
+    def worker(number):
+        rng = random.Random(seed * 10_000 + number)
+        client = Client(HTTP_HOST=host)
+        try:
+            start_together.wait()
+            for _ in range(sales_per_worker):
+                basket = rng.sample(products, min(basket_size, len(products)))
+                data = sale_form_data([(product, rng.randint(1, max_quantity)) for product in basket])
+
+                started = time.perf_counter()
+                if one_at_a_time:
+                    with one_at_a_time:
+                        response = client.post(url, data)
+                else:
+                    response = client.post(url, data)
+                elapsed = time.perf_counter() - started
+
+                if response.status_code == 302:
+                    outcome = 'recorded'
+                elif any(message in response.content for message in REJECTION_MESSAGES):
+                    outcome = 'rejected'
+                else:
+                    outcome = 'errors'
+                with results_lock:
+                    outcomes[outcome] += 1
+                    latencies.append(elapsed)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(workers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    return {
+        'workers': workers,
+        'seconds': seconds,
+        'sales_per_second': outcomes['recorded'] / seconds if seconds else 0.0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        **outcomes,
+    }
+
+
+def stock_violations(starting_stock):
+    """
+    Check the stock books of the products in ``{product_id: starting
+    quantity}`` and return a description of every inconsistency found.
+    """
+    product_ids = list(starting_stock)
+    # Sharded products are normally reconciled by a background job
+    Product.reconcile_stock(product_ids)
+    quantities = dict(Product.objects.filter(pk__in=product_ids).values_list('pk', 'quantity'))
+    changes = dict(
+        ProductStockUpdate.objects.filter(product__in=product_ids).order_by()
+        .values_list('product').annotate(total=Sum('quantity_change'))
+    )
+    sold = dict(
+        SaleItem.objects.filter(product__in=product_ids).order_by()
+        .values_list('product').annotate(total=Sum('quantity'))
+    )
+
+    violations = []
+    for product_id, start in starting_stock.items():
+        quantity = quantities[product_id]
+        if quantity < 0:
+            violations.append(f"Product {product_id} oversold: quantity {quantity}")
+        if quantity != start + changes.get(product_id, 0):
+            violations.append(
+                f"Product {product_id}: quantity {quantity} != {start} + stock updates {changes.get(product_id, 0)}"
+            )
+        if quantity != start - sold.get(product_id, 0):
+            violations.append(
+                f"Product {product_id}: quantity {quantity} != {start} - units sold {sold.get(product_id, 0)}"
+            )
+    return violations
@@ -0,0 +1,77 @@
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from products.models import Category, Product
+from products.stock import enable_sharding, lock_stats, reset_lock_stats
+from sales.loadtest import run_checkout_load, stock_violations
+from sales.models import Sale
+
+
+class Command(BaseCommand):
+    help = (
+        "Fire concurrent sales at sale_create against a few hot products, check that "
+        "stock was never oversold and report throughput and latency per concurrency level. "
+        "Sales are committed (then deleted), so run it against a scratch database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+        parser.add_argument('--sales-per-worker', type=int, default=25)
+        parser.add_argument('--products', type=int, default=5, help="Number of hot products shared by all baskets")
+        parser.add_argument('--stock', type=int, default=None,
+                            help="Starting stock per product (default: about 80%% of the demand, so some sales are refused)")
+        parser.add_argument('--basket', type=int, default=3)
+        parser.add_argument('--shards', type=int, default=0,
+                            help="Keep each hot product's stock in this many shards (0: on the product row)")
+        parser.add_argument('--keep', action='store_true', help="Keep the generated products and sales")
+
+    def handle(self, *args, **options):
+        suffix = uuid.uuid4().hex[:8]
+        category = Category.objects.create(name=f'Checkout benchmark {suffix}', slug=f'bench-checkout-{suffix}')
+        failures = []
+
+        self.stdout.write(
+            f"{connection.vendor}: {options['products']} hot products, baskets of {options['basket']}, "
+            f"{options['shards'] or 'no'} stock shards"
+        )
+        self.stdout.write(
+            f"{'workers':>7} {'recorded':>8} {'rejected':>8} {'errors':>6} {'sales/s':>8} "
+            f"{'p50 ms':>7} {'p99 ms':>7} {'lock wait ms':>12} {'retries':>7}"
+        )
+        try:
+            for workers in options['concurrency']:
+                demand = workers * options['sales_per_worker'] * options['basket'] * 2 // options['products']
+                stock = options['stock'] if options['stock'] is not None else max(1, demand * 4 // 5)
+                products = [
+                    Product.objects.create(
+                        category=category, name=f'Hot product {workers}-{i}', slug=f'bench-checkout-{suffix}-{workers}-{i}',
+                        regular_price=10, bulk_price=8, dozen_price=9, quantity=stock,
+                    )
+                    for i in range(options['products'])
+                ]
+                if options['shards']:
+                    for product in products:
+                        enable_sharding(product.pk, options['shards'])
+
+                reset_lock_stats()
+                result = run_checkout_load(products, workers, options['sales_per_worker'], basket_size=options['basket'])
+                stats = lock_stats()
+
+                self.stdout.write(
+                    f"{workers:>7} {result['recorded']:>8} {result['rejected']:>8} {result['errors']:>6} "
+                    f"{result['sales_per_second']:>8.1f} {result['p50'] * 1000:>7.1f} {result['p99'] * 1000:>7.1f} "
+                    f"{stats['avg_lock_wait_seconds'] * 1000:>12.2f} {stats['retries']:>7}"
+                )
+                failures += stock_violations({product.pk: stock for product in products})
+                if result['errors']:
+                    failures.append(f"{result['errors']} sales failed with {workers} workers")
+        finally:
+            if not options['keep']:
+                Sale.objects.filter(items__product__category=category).delete()
+                category.delete()
+
+        if failures:
+            raise CommandError("\n".join(failures))
+        self.stdout.write(self.style.SUCCESS("Stock books balance: no oversell"))
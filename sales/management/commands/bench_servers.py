@@ -0,0 +1,170 @@
+import http.client
+import importlib.util
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from products.models import Product
+from sales.loadtest import percentile, request_host
+from sales.models import Sale
+
+SERVERS = {
+    'gunicorn': lambda port, workers: [
+        sys.executable, '-m', 'gunicorn', 'inventory.wsgi:application',
+        '--workers', str(workers), '--bind', f'127.0.0.1:{port}', '--log-level', 'warning',
+    ],
+    'uvicorn': lambda port, workers: [
+        sys.executable, '-m', 'uvicorn', 'inventory.asgi:application',
+        '--workers', str(workers), '--port', str(port), '--log-level', 'warning', '--no-access-log',
+    ],
+}
+# Seconds to wait for a server to answer after starting it
+STARTUP_TIMEOUT = 30
+
+
+def fetch(connection, path, headers):
+    """GET ``path`` on a keep-alive connection; True on a successful response."""
+    try:
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status < 400
+    except (OSError, http.client.HTTPException):
+        # Reconnects on the next request
+        connection.close()
+        return False
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare read-path throughput under gunicorn (WSGI) and uvicorn (ASGI): clients fetch "
+        "product and sale pages while others download sales report PDFs. Uses the products and "
+        "sales already in the database, and reports lookups per second and their latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', choices=sorted(SERVERS), default=['gunicorn', 'uvicorn'])
+        parser.add_argument('--url', help="Benchmark the server already running at this URL instead")
+        parser.add_argument('--workers', type=int, default=2, help="Server worker processes")
+        parser.add_argument('--clients', type=int, default=32, help="Concurrent clients fetching pages")
+        parser.add_argument('--pdf-clients', type=int, default=2, help="Concurrent clients downloading the sales report")
+        parser.add_argument('--duration', type=float, default=20, help="Seconds per server")
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        if not options['url']:
+            for server in options['servers']:
+                if importlib.util.find_spec(server) is None:
+                    raise CommandError(f"{server} is not installed")
+        paths = self.lookup_paths()
+        self.stdout.write(
+            f"{options['clients']} page clients, {options['pdf_clients']} report clients, "
+            f"{options['duration']:.0f}s per server (DEBUG={settings.DEBUG})"
+        )
+        self.stdout.write(
+            f"{'server':>10} {'pages/s':>8} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'reports/s':>9} {'errors':>6}"
+        )
+        if options['url']:
+            self.report('url', self.run_load(options['url'], paths, options))
+            return
+
+        for server in options['servers']:
+            process = subprocess.Popen(
+                SERVERS[server](options['port'], options['workers']), cwd=settings.BASE_DIR, env=os.environ.copy(),
+            )
+            try:
+                base_url = f"http://127.0.0.1:{options['port']}"
+                self.wait_until_up(base_url, process)
+                self.report(server, self.run_load(base_url, paths, options))
+            finally:
+                process.terminate()
+                process.wait(timeout=10)
+
+    def lookup_paths(self):
+        slugs = list(Product.objects.order_by('?').values_list('slug', flat=True)[:200])
+        sale_ids = list(Sale.objects.order_by('?').values_list('id', flat=True)[:200])
+        if not slugs or not sale_ids:
+            raise CommandError("The database needs some products and sales (e.g. bench_checkout --keep)")
+        return (
+            [reverse('product_list'), reverse('sale_list')]
+            + [reverse('product_detail', args=[slug]) for slug in slugs]
+            + [reverse('sale_detail', args=[sale_id]) for sale_id in sale_ids]
+        )
+
+    def wait_until_up(self, base_url, process):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f"The server exited with status {process.returncode}")
+            if fetch(self.connect(base_url, timeout=2), reverse('product_list'), {'Host': request_host()}):
+                return
+            time.sleep(0.2)
+        raise CommandError(f"The server didn't answer within {STARTUP_TIMEOUT}s")
+
+    def connect(self, base_url, timeout):
+        url = urlsplit(base_url)
+        return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=timeout)
+
+    def run_load(self, base_url, paths, options):
+        """Run the page and report clients for the given duration and return their results."""
+        headers = {'Host': request_host()}
+        latencies = []
+        counts = {'reports': 0, 'errors': 0}
+        results_lock = threading.Lock()
+        start_together = threading.Barrier(options['clients'] + options['pdf_clients'])
+        deadline = None
+
+        def fetch_pages(seed):
+            rng = random.Random(seed)
+            connection = self.connect(base_url, timeout=60)
+            start_together.wait()
+            while time.monotonic() < deadline:
+                started = time.perf_counter()
+                ok = fetch(connection, rng.choice(paths), headers)
+                with results_lock:
+                    if ok:
+                        latencies.append(time.perf_counter() - started)
+                    else:
+                        counts['errors'] += 1
+
+        def fetch_reports():
+            connection = self.connect(base_url, timeout=300)
+            start_together.wait()
+            while time.monotonic() < deadline:
+                ok = fetch(connection, reverse('sales_report_pdf'), headers)
+                with results_lock:
+                    counts['reports' if ok else 'errors'] += 1
+
+        threads = [threading.Thread(target=fetch_pages, args=(seed,)) for seed in range(options['clients'])]
+        threads += [threading.Thread(target=fetch_reports) for _ in range(options['pdf_clients'])]
+        deadline = time.monotonic() + options['duration']
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        return {
+            'pages_per_second': len(latencies) / elapsed,
+            'reports_per_second': counts['reports'] / elapsed,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'errors': counts['errors'],
+        }
+
+    def report(self, label, result):
+        self.stdout.write(
+            f"{label:>10} {result['pages_per_second']:>8.1f} {result['p50'] * 1000:>7.1f} "
+            f"{result['p95'] * 1000:>7.1f} {result['p99'] * 1000:>7.1f} {result['reports_per_second']:>9.2f} "
+            f"{result['errors']:>6}"
+        )
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.5 on 2026-10-18 01:31
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_existing_sales_applied(apps, schema_editor):
+    # Sales recorded before this migration are already in their statements
+    Sale = apps.get_model('sales', 'Sale')
+    Sale.objects.update(statement_applied=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sales', '0002_alter_saleitem_custom_bulk_minimum'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sale',
+            name='statement_applied',
+            field=models.BooleanField(default=False, editable=False, help_text='Whether the sale has been folded into its daily inventory statement.'),
+        ),
+        migrations.RunPython(mark_existing_sales_applied, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(condition=models.Q(('statement_applied', False)), fields=['sale_date'], name='sale_statement_pending_idx'),
+        ),
+    ]
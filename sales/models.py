@@ -2,15 +2,25 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator
 from django.db.models import Sum, F
+from django.utils import timezone
+from inventory.mixins import ChangeTrackingMixin
 from products.models import Product  # adjust import path as necessary
 
 class Sale(models.Model):
     seller_name = models.CharField(max_length=200, null=True, blank=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, editable=False, default=0)
-    sale_date = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: sales replayed by offline terminals keep the time they were made
+    sale_date = models.DateTimeField(default=timezone.now, editable=False)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+    statement_applied = models.BooleanField(default=False, editable=False, help_text="Whether the sale has been folded into its daily inventory statement.")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sale_date', 'id'], name='sale_date_id_idx'),
+            models.Index(fields=['sale_date'], condition=models.Q(statement_applied=False), name='sale_statement_pending_idx'),
+        ]
 
     def __str__(self):
         return f"Sale {self.id} - User {self.user}"
@@ -20,7 +30,7 @@ class Sale(models.Model):
         self.total_amount = total
         self.save(update_fields=['total_amount'])
 
-class SaleItem(models.Model):
+class SaleItem(ChangeTrackingMixin, models.Model):
     SALE_TYPE_CHOICES = [
         ('regular', 'Regular'),
         ('bulk', 'Bulk'),
@@ -36,7 +46,7 @@ class SaleItem(models.Model):
 
     def clean(self):
         from django.core.exceptions import ValidationError
-        if not self.product:
+        if self.product_id is None:
             return
         if self.quantity is None:
             raise ValidationError("Quantity cannot be empty.")
@@ -46,9 +56,31 @@ class SaleItem(models.Model):
                 f"Custom bulk minimum ({self.custom_bulk_minimum}) cannot be less than default minimum ({self.product.minimum_bulk_quantity})."
             )
         
+    @staticmethod
+    def unit_price(product, sale_type):
+        """The price per unit of ``product`` when sold as ``sale_type``."""
+        if sale_type == 'bulk':
+            return product.bulk_price
+        if sale_type == 'dozen':
+            return product.dozen_price
+        return product.regular_price
+
     @property
     def total_price(self):
         return self.quantity * self.price_per_unit
 
     def __str__(self):
         return f"{self.quantity} x {self.product.name} ({self.sale_type})"
+
+
+class SaleIdempotencyKey(models.Model):
+    """
+    A client-chosen key identifying one submitted sale, so that replaying
+    the submission returns the recorded sale instead of selling twice.
+    """
+    key = models.CharField(max_length=64, unique=True)
+    sale = models.OneToOneField(Sale, related_name='idempotency_key', on_delete=models.CASCADE)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.key} -> Sale {self.sale_id}"
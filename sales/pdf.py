@@ -0,0 +1,117 @@
+"""
+ReportLab plumbing shared by the receipt and sales report PDFs.
+
+``PageWriter`` lays out flowables on one canvas as they are handed to it,
+splitting tables across pages. A document with thousands of sales is
+therefore built one batch of sales at a time, so the sales and their
+flowables are never all in memory, as they would be in a single story
+list. The canvas does keep every finished page's (compressed) content
+stream until ``save()``, so memory still grows with the page count, just
+far more slowly. The styles are built once per process, not once per
+document.
+
+``write`` lays out a document handed over in batches of flowables; async
+views use ``awrite``, which reads the batches (and so the database) on the
+request's thread and runs the layout in the bounded blocking pool.
+"""
+import functools
+
+from asgiref.sync import sync_to_async
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import mm
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import Frame, PageBreak, TableStyle
+from reportlab.platypus.doctemplate import LayoutError
+
+from inventory.blocking import run_blocking
+
+MARGIN = 20 * mm
+
+TABLE_STYLE = TableStyle([
+    ('GRID', (0, 0), (-1, -1), 0.5, colors.black),
+    ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f4f4f4')),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+])
+
+
+@functools.cache
+def styles():
+    return getSampleStyleSheet()
+
+
+class PageWriter:
+    """
+    Flow content onto A4 pages of a single PDF written to ``output``.
+
+    Flowables can be dropped once added, but the canvas holds the finished
+    pages until ``save()`` writes the whole document.
+    """
+
+    def __init__(self, output, title):
+        self.canvas = Canvas(output, pagesize=A4, pageCompression=1)
+        self.canvas.setTitle(title)
+        self.frame = None
+        self.blank = True
+        self.pages = 0
+
+    def add(self, flowables):
+        """Lay out ``flowables`` after the content added so far, starting new pages as they fill."""
+        story = list(flowables)
+        while story:
+            flowable = story.pop(0)
+            if isinstance(flowable, PageBreak):
+                self.new_page()
+                continue
+            if self.frame is None:
+                width, height = A4
+                self.frame = Frame(MARGIN, MARGIN, width - 2 * MARGIN, height - 2 * MARGIN, showBoundary=0)
+                self.blank = True
+            if self.frame.add(flowable, self.canvas):
+                self.blank = False
+                continue
+            # Put as much as fits on this page, e.g. the first rows of a table
+            parts = self.frame.split(flowable, self.canvas)
+            if parts and self.frame.add(parts[0], self.canvas):
+                story[:0] = parts[1:]
+            elif self.blank:
+                raise LayoutError(f"{flowable.identity()} does not fit on a page")
+            else:
+                story.insert(0, flowable)
+            self.new_page()
+
+    def new_page(self):
+        """End the current page, if anything was drawn on it."""
+        if self.frame is not None:
+            self.canvas.showPage()
+            self.frame = None
+            self.pages += 1
+
+    def save(self):
+        self.new_page()
+        self.canvas.save()
+
+
+def write(batches, output, title):
+    """Write a PDF of the flowable lists in ``batches``, one after the other. Returns the number of pages."""
+    writer = PageWriter(output, title)
+    for flowables in batches:
+        writer.add(flowables)
+    writer.save()
+    return writer.pages
+
+
+async def awrite(batches, output, title):
+    """
+    ``write`` for async views. ``batches`` is advanced on the request's
+    thread, so it may query the database; each batch is then laid out in
+    the blocking pool.
+    """
+    writer = PageWriter(output, title)
+    batches = iter(batches)
+    next_batch = sync_to_async(next)
+    while (flowables := await next_batch(batches, None)) is not None:
+        await run_blocking(writer.add, flowables)
+    await run_blocking(writer.save)
+    return writer.pages
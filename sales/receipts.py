@@ -0,0 +1,235 @@
+"""
+PDF receipts.
+
+A sale never changes once recorded, so its receipt is rendered once and
+kept in an on-disk cache. Files are addressed by a hash of the sale id
+and the receipt version: the template source, the company name and the
+renderer. Editing the template therefore misses the cache instead of
+serving stale receipts. Receipts are pre-rendered by a background job
+right after checkout, so downloads are normally just a file read.
+Receipts older than ``RECEIPT_CACHE_MAX_AGE_DAYS`` are pruned by a job
+queued (at most once a day) after each render; downloading a pruned
+receipt just renders it again.
+
+Two renderers are available through the ``RECEIPT_RENDERER`` setting:
+``html`` runs ``sales/receipt.html`` through xhtml2pdf, and ``reportlab``
+draws the same layout directly with ReportLab, skipping the HTML and
+CSS parsing. Batch exports of many receipts always use ReportLab.
+"""
+import functools
+import hashlib
+import io
+import os
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.template.loader import get_template, render_to_string
+from django.utils import timezone
+from reportlab.lib.units import mm
+from reportlab.platypus import PageBreak, Paragraph, Spacer, Table
+from xhtml2pdf import pisa
+
+from jobs.models import Job
+from sales import pdf
+from sales.models import Sale
+
+RECEIPT_TEMPLATE = 'sales/receipt.html'
+COMPANY_NAME = 'Modetex'
+RENDERERS = ('html', 'reportlab')
+# Sales loaded (with one prefetch of their items) per step of a batch export
+RECEIPT_CHUNK_SIZE = 500
+# The cache is pruned by a job queued this long after a render (and coalesced meanwhile)
+RECEIPT_PRUNE_INTERVAL = timedelta(days=1)
+
+
+class ReceiptError(Exception):
+    """The PDF renderer failed on a receipt."""
+
+
+def renderer():
+    name = getattr(settings, 'RECEIPT_RENDERER', 'html')
+    if name not in RENDERERS:
+        raise ValueError(f"RECEIPT_RENDERER must be one of {', '.join(RENDERERS)}, not {name!r}")
+    return name
+
+
+def cache_dir():
+    return Path(getattr(settings, 'RECEIPT_CACHE_DIR', settings.BASE_DIR / 'receipt_cache'))
+
+
+def cache_max_age():
+    return timedelta(days=getattr(settings, 'RECEIPT_CACHE_MAX_AGE_DAYS', 90))
+
+
+@functools.cache
+def _template_digest(template_name):
+    source = get_template(template_name).template.source
+    return hashlib.sha256(source.encode()).hexdigest()
+
+
+def receipt_version():
+    """Identifies everything besides the sale that goes into a receipt."""
+    return f"{renderer()}:{COMPANY_NAME}:{_template_digest(RECEIPT_TEMPLATE)}"
+
+
+def receipt_path(sale_id):
+    """Where the receipt of ``sale_id`` is cached for the current receipt version."""
+    digest = hashlib.sha256(f"{sale_id}:{receipt_version()}".encode()).hexdigest()
+    return cache_dir() / digest[:2] / f"{digest}.pdf"
+
+
+def receipt_queryset():
+    return Sale.objects.select_related('user').prefetch_related('items__product')
+
+
+def render_receipt(sale):
+    """Render the receipt of ``sale`` (with its items and products loaded) to PDF bytes."""
+    if renderer() == 'reportlab':
+        return _render_reportlab(sale)
+
+    html = render_to_string(RECEIPT_TEMPLATE, {'sale': sale, 'company_name': COMPANY_NAME})
+    output = io.BytesIO()
+    if pisa.CreatePDF(html, dest=output).err:
+        raise ReceiptError(f"Error generating receipt {sale.id}")
+    return output.getvalue()
+
+
+def _render_reportlab(sale):
+    output = io.BytesIO()
+    write_receipts([sale], output, title=f"Receipt #{sale.id}")
+    return output.getvalue()
+
+
+def receipt_flowables(sale):
+    """The receipt of ``sale`` (with its items and products loaded), as ReportLab flowables."""
+    style = pdf.styles()
+    rows = [['Product', 'Qty', 'Price (NGN)', 'Total (NGN)']]
+    rows += [
+        [item.product.name, item.quantity, f"{item.price_per_unit:,.2f}", f"{item.total_price:,.2f}"]
+        for item in sale.items.all()
+    ]
+    table = Table(rows, colWidths=[80 * mm, 15 * mm, 35 * mm, 35 * mm], repeatRows=1, style=pdf.TABLE_STYLE)
+
+    user = sale.user.username if sale.user else 'N/A'
+    return [
+        Paragraph(f"{COMPANY_NAME} Sales Receipt", style['Title']),
+        Paragraph(f"Receipt #{sale.id}", style['Heading3']),
+        Paragraph(f"<b>Date:</b> {timezone.localtime(sale.sale_date):%Y-%m-%d %H:%M}", style['Normal']),
+        Paragraph(f"<b>Seller:</b> {escape(sale.seller_name or '')}", style['Normal']),
+        Paragraph(f"<b>User:</b> {escape(user)}", style['Normal']),
+        Spacer(1, 5 * mm),
+        table,
+        Spacer(1, 5 * mm),
+        Paragraph(f"<b>Total: NGN {sale.total_amount:,.2f}</b>", style['Heading3']),
+        Spacer(1, 5 * mm),
+        Paragraph("Thank you for your patronage!", style['Normal']),
+        Paragraph("For inquiries, please contact: +234 8132055194", style['Normal']),
+    ]
+
+
+def receipt_batches(sales):
+    """The receipts of ``sales``, one flowable list (and page) per receipt."""
+    for sale in sales:
+        yield receipt_flowables(sale) + [PageBreak()]
+
+
+def write_receipts(sales, output, title="Receipts"):
+    """
+    Write the receipts of ``sales`` to ``output`` as one PDF, each receipt
+    starting on a new page. Returns the number of pages.
+
+    ``sales`` can be a lazy iterable (such as ``iter_receipt_sales``); the
+    receipts are laid out as they come.
+    """
+    return pdf.write(receipt_batches(sales), output, title)
+
+
+async def awrite_receipts(sales, output, title="Receipts"):
+    """``write_receipts`` for async views, laying out the receipts in the blocking pool."""
+    return await pdf.awrite(receipt_batches(sales), output, title)
+
+
+def iter_receipt_sales(sales):
+    """
+    Iterate ``sales`` in date order with their items and products, loading
+    them ``RECEIPT_CHUNK_SIZE`` sales (and one prefetch) at a time.
+    """
+    return (
+        sales.select_related('user').prefetch_related('items__product')
+        .order_by('sale_date', 'id').iterator(chunk_size=RECEIPT_CHUNK_SIZE)
+    )
+
+
+def store_receipt(sale_id, pdf):
+    """Write a rendered receipt to the cache; concurrent writers of the same receipt are harmless."""
+    path = receipt_path(sale_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp:
+            temp.write(pdf)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return path
+
+
+def cached_receipt(sale):
+    """The path of the cached receipt of ``sale``, rendering and storing it on a miss."""
+    path = receipt_path(sale.id)
+    if not path.exists():
+        store_receipt(sale.id, render_receipt(sale))
+    return path
+
+
+def prerender_receipts(sale_ids):
+    """Render and cache the receipts of the given sales that aren't cached yet."""
+    missing = [sale_id for sale_id in sale_ids if not receipt_path(sale_id).exists()]
+    for sale in receipt_queryset().filter(pk__in=missing):
+        store_receipt(sale.id, render_receipt(sale))
+    return len(missing)
+
+
+def schedule_receipts(sale_ids):
+    """Queue the pre-rendering of the receipts of freshly recorded sales."""
+    sale_ids = sorted(sale_ids)
+    Job.enqueue(
+        'sales.render_receipts',
+        key=f"{sale_ids[0]}-{sale_ids[-1]}-{len(sale_ids)}",
+        payload={'sale_ids': sale_ids},
+    )
+
+
+def prune_receipts(older_than=None):
+    """
+    Delete cached receipts (and leftover temporary files) last written more
+    than ``older_than`` ago, defaulting to ``RECEIPT_CACHE_MAX_AGE_DAYS``.
+    Returns the number of files deleted.
+    """
+    cutoff = time.time() - (older_than or cache_max_age()).total_seconds()
+    deleted = 0
+    for directory in cache_dir().glob('??'):
+        for path in directory.iterdir():
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    deleted += 1
+            except FileNotFoundError:
+                # Replaced or deleted by a concurrent writer or prune
+                pass
+        try:
+            directory.rmdir()
+        except OSError:
+            # Not empty, or already removed
+            pass
+    return deleted
+
+
+def schedule_receipt_prune():
+    """Queue (or coalesce into) the next prune of the receipt cache."""
+    Job.enqueue('sales.prune_receipts', delay=RECEIPT_PRUNE_INTERVAL)
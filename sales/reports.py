@@ -0,0 +1,99 @@
+"""
+End-of-day sales report PDF: totals, revenue by sale type and by product,
+then every sale in the period. The sales list is read and laid out
+``REPORT_CHUNK_SIZE`` rows at a time, so a day with thousands of sales
+never has all its model instances or table rows in memory at once (the
+finished pages still are; see ``sales.pdf``).
+"""
+from xml.sax.saxutils import escape
+
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Sum
+from django.utils import timezone
+from reportlab.lib.units import mm
+from reportlab.platypus import Paragraph, Spacer, Table
+
+from sales import pdf
+from sales.models import SaleItem
+from sales.receipts import COMPANY_NAME
+
+REPORT_CHUNK_SIZE = 500
+
+SALES_HEADER = ['Sale', 'Time', 'Seller', 'User', 'Items', 'Total (NGN)']
+SALES_COLUMNS = [18 * mm, 30 * mm, 40 * mm, 30 * mm, 15 * mm, 32 * mm]
+
+
+def write_sales_report(sales, output, period):
+    """
+    Write the report on the ``sales`` queryset to ``output``, headed with
+    ``period`` (such as "2026-10-18"). Returns the number of pages.
+    """
+    return pdf.write(report_batches(sales, period), output, f"Sales report {period}")
+
+
+async def awrite_sales_report(sales, output, period):
+    """``write_sales_report`` for async views, laying out the report in the blocking pool."""
+    return await pdf.awrite(report_batches(sales, period), output, f"Sales report {period}")
+
+
+def report_batches(sales, period):
+    """The report's flowables: the summary tables, then the sales list a chunk at a time."""
+    style = pdf.styles()
+    items = SaleItem.objects.filter(sale__in=sales.order_by().values('pk'))
+    revenue = ExpressionWrapper(F('quantity') * F('price_per_unit'), output_field=DecimalField())
+    totals = items.aggregate(units=Sum('quantity'), revenue=Sum(revenue))
+    by_type = items.order_by().values('sale_type').annotate(units=Sum('quantity'), revenue=Sum(revenue)).order_by('sale_type')
+    by_product = (
+        items.order_by().values('product__name').annotate(units=Sum('quantity'), revenue=Sum(revenue))
+        .order_by('-revenue', 'product__name')
+    )
+
+    yield [
+        Paragraph(f"{COMPANY_NAME} Sales Report", style['Title']),
+        Paragraph(escape(period), style['Heading3']),
+        Paragraph(f"Generated {timezone.localtime():%Y-%m-%d %H:%M}", style['Normal']),
+        Spacer(1, 5 * mm),
+        Table(
+            [
+                ['Sales', 'Units sold', 'Revenue (NGN)'],
+                [sales.count(), totals['units'] or 0, f"{totals['revenue'] or 0:,.2f}"],
+            ],
+            style=pdf.TABLE_STYLE,
+        ),
+        Spacer(1, 5 * mm),
+        Paragraph("Revenue by sale type", style['Heading3']),
+        Table(
+            [['Sale type', 'Units', 'Revenue (NGN)']]
+            + [[row['sale_type'].title(), row['units'], f"{row['revenue']:,.2f}"] for row in by_type],
+            style=pdf.TABLE_STYLE,
+        ),
+        Spacer(1, 5 * mm),
+        Paragraph("Revenue by product", style['Heading3']),
+        Table(
+            [['Product', 'Units', 'Revenue (NGN)']]
+            + [[row['product__name'], row['units'], f"{row['revenue']:,.2f}"] for row in by_product],
+            repeatRows=1,
+            style=pdf.TABLE_STYLE,
+        ),
+        Spacer(1, 5 * mm),
+        Paragraph("Sales", style['Heading3']),
+    ]
+
+    rows = []
+    sales = (
+        sales.select_related('user').annotate(item_count=Count('items')).order_by('sale_date', 'id')
+        .iterator(chunk_size=REPORT_CHUNK_SIZE)
+    )
+    for sale in sales:
+        rows.append([
+            sale.id,
+            f"{timezone.localtime(sale.sale_date):%Y-%m-%d %H:%M}",
+            (sale.seller_name or '')[:30],
+            sale.user.username if sale.user else 'N/A',
+            sale.item_count,
+            f"{sale.total_amount:,.2f}",
+        ])
+        if len(rows) == REPORT_CHUNK_SIZE:
+            yield [Table([SALES_HEADER] + rows, colWidths=SALES_COLUMNS, repeatRows=1, style=pdf.TABLE_STYLE)]
+            rows = []
+    if rows:
+        yield [Table([SALES_HEADER] + rows, colWidths=SALES_COLUMNS, repeatRows=1, style=pdf.TABLE_STYLE)]
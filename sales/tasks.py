@@ -0,0 +1,13 @@
+from jobs.registry import register
+from .receipts import prerender_receipts, prune_receipts, schedule_receipt_prune
+
+
+@register('sales.render_receipts')
+def render_receipts(sale_ids):
+    prerender_receipts(sale_ids)
+    schedule_receipt_prune()
+
+
+@register('sales.prune_receipts')
+def prune_receipt_cache():
+    prune_receipts()
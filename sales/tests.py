@@ -1,3 +1,454 @@
-from django.test import TestCase
+import contextlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
 
-# Create your tests here.
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.text import slugify
+from pypdf import PdfReader
+
+from jobs.models import Job
+from products.models import Category, Product, StockShard
+from products.stock import enable_sharding
+from sales.forms import SaleItemFormSet
+from sales.ingest import MAX_BATCH_SIZE, MAX_SALE_AGE
+from sales.loadtest import run_checkout_load, sale_form_data, stock_violations
+from sales.models import Sale, SaleIdempotencyKey
+from sales.receipts import RECEIPT_PRUNE_INTERVAL, RENDERERS, prerender_receipts, prune_receipts, receipt_path
+from sales.tasks import render_receipts
+from statement.models import InventoryStatement, ProductStockUpdate
+from statement.tasks import apply_pending_sales
+
+
+def create_products(*names, quantity=10):
+    """One product per name, all in the same category."""
+    category, _ = Category.objects.get_or_create(name='Stock', slug='stock')
+    return [
+        Product.objects.create(
+            category=category, name=name, slug=slugify(name),
+            regular_price=10, bulk_price=8, dozen_price=9, quantity=quantity,
+        )
+        for name in names
+    ]
+
+
+class SaleSubmissionQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = create_products(*(f'Product {i}' for i in range(40)), quantity=100)
+
+    def test_formset_validation_uses_one_query(self):
+        formset = SaleItemFormSet(sale_form_data([(product, 1) for product in self.products]))
+        with self.assertNumQueries(1):
+            self.assertTrue(formset.is_valid())
+
+    def test_sale_create_query_count_does_not_grow_with_basket(self):
+        counts = []
+        for size in (1, 40):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    reverse('sale_create'), sale_form_data([(product, 1) for product in self.products[:size]])
+                )
+            self.assertEqual(response.status_code, 302)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(Sale.objects.count(), 2)
+
+    def test_unknown_product_is_a_validation_error(self):
+        data = sale_form_data([(self.products[0], 1)])
+        data['items-0-product'] = '999999'
+        formset = SaleItemFormSet(data)
+        self.assertFalse(formset.is_valid())
+        self.assertIn('product', formset.errors[0])
+
+
+class SaleIdempotencyTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product, = create_products('Chips')
+
+    def test_form_issues_a_key(self):
+        response = self.client.get(reverse('sale_create'))
+        self.assertTrue(response.context['sale_form'].initial['idempotency_key'])
+
+    def test_replayed_submission_redirects_to_original_sale(self):
+        data = sale_form_data([(self.product, 3)], idempotency_key='replayed-key')
+        first = self.client.post(reverse('sale_create'), data)
+        replay = self.client.post(reverse('sale_create'), data)
+
+        sale = Sale.objects.get()
+        self.assertRedirects(first, reverse('sale_detail', args=[sale.id]), fetch_redirect_response=False)
+        self.assertRedirects(replay, reverse('sale_detail', args=[sale.id]), fetch_redirect_response=False)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 7)
+
+
+class ShardedStockTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product, = create_products('Bread', quantity=20)
+        enable_sharding(cls.product.pk, 4)
+
+    def shard_total(self):
+        return sum(StockShard.objects.filter(product=self.product).values_list('quantity', flat=True))
+
+    def test_sale_takes_stock_from_the_shards(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('sale_create'), sale_form_data([(self.product, 3)]))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.shard_total(), 17)
+
+        Product.reconcile_stock([self.product.pk])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 17)
+
+    def test_sale_larger_than_any_shard_drains_several(self):
+        response = self.client.post(reverse('sale_create'), sale_form_data([(self.product, 12)]))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.shard_total(), 8)
+
+    def test_sale_larger_than_the_stock_is_refused(self):
+        response = self.client.post(reverse('sale_create'), sale_form_data([(self.product, 21)]))
+        self.assertContains(response, 'Not enough stock')
+        self.assertEqual(self.shard_total(), 20)
+        self.assertFalse(Sale.objects.exists())
+
+
+class ReceiptCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        product, = create_products('Lace')
+        cls.sale = Sale.objects.create(seller_name='Counter', total_amount=20)
+        cls.sale.items.create(product=product, quantity=2, price_per_unit=10)
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.enterContext(self.settings(RECEIPT_CACHE_DIR=cache_dir))
+
+    def download(self):
+        response = self.client.get(reverse('generate_receipt', args=[self.sale.id]))
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    def test_download_renders_and_caches_the_receipt(self):
+        pdf = self.download()
+        self.assertTrue(pdf.startswith(b'%PDF'))
+        self.assertEqual(receipt_path(self.sale.id).read_bytes(), pdf)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.download(), pdf)
+
+    def test_prerendered_receipt_is_served_from_the_cache(self):
+        prerender_receipts([self.sale.id])
+        self.assertTrue(receipt_path(self.sale.id).exists())
+        with self.assertNumQueries(1):
+            self.download()
+
+    def test_renderers_have_their_own_cache_entries(self):
+        html_path = receipt_path(self.sale.id)
+        with override_settings(RECEIPT_RENDERER='reportlab'):
+            self.assertNotEqual(receipt_path(self.sale.id), html_path)
+            self.assertTrue(self.download().startswith(b'%PDF'))
+
+    def test_receipt_without_a_seller_name(self):
+        Sale.objects.filter(pk=self.sale.pk).update(seller_name=None)
+        for name in RENDERERS:
+            with self.subTest(renderer=name), override_settings(RECEIPT_RENDERER=name):
+                self.assertTrue(self.download().startswith(b'%PDF'))
+
+    def test_prune_deletes_receipts_past_the_max_age(self):
+        prerender_receipts([self.sale.id])
+        old = receipt_path(self.sale.id)
+        leftover = old.with_name('abandoned.tmp')
+        leftover.touch()
+        rendered_at = time.time() - timedelta(days=91).total_seconds()
+        for path in (old, leftover):
+            os.utime(path, (rendered_at, rendered_at))
+        with override_settings(RECEIPT_RENDERER='reportlab'):
+            prerender_receipts([self.sale.id])
+            recent = receipt_path(self.sale.id)
+
+        self.assertEqual(prune_receipts(), 2)
+        self.assertFalse(old.exists() or leftover.exists())
+        self.assertTrue(recent.exists())
+        # A pruned receipt is rendered again on download
+        self.assertTrue(self.download().startswith(b'%PDF'))
+        self.assertTrue(old.exists())
+
+    def test_rendering_queues_one_prune(self):
+        for sale_ids in ([self.sale.id], [self.sale.id + 1]):
+            render_receipts(sale_ids)
+        job = Job.objects.get(name='sales.prune_receipts')
+        self.assertGreater(job.run_after, timezone.now() + RECEIPT_PRUNE_INTERVAL - timedelta(minutes=1))
+
+
+class SalesExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        product, = create_products('Lace', quantity=1000)
+        for i in range(120):
+            sale = Sale.objects.create(seller_name=f'Seller {i}', total_amount=20)
+            sale.items.create(product=product, quantity=2, price_per_unit=10)
+
+    def download(self, name, **params):
+        response = self.client.get(reverse(name), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        return PdfReader(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_receipts_of_the_day_in_one_pdf(self):
+        with self.assertNumQueries(3):
+            receipts = self.download('sale_receipts_pdf')
+        self.assertEqual(len(receipts.pages), 120)
+
+    def test_receipts_follow_the_sale_list_filters(self):
+        sale = Sale.objects.earliest('id')
+        receipts = self.download('sale_receipts_pdf', q=str(sale.id))
+        self.assertIn(f"Receipt #{sale.id}", receipts.pages[0].extract_text())
+
+    def test_report_lists_every_sale(self):
+        report = self.download('sales_report_pdf')
+        text = ''.join(page.extract_text() for page in report.pages)
+        self.assertIn('Revenue by product', text)
+        self.assertIn('Seller 119', text)
+
+    def test_sales_without_a_seller_name(self):
+        Sale.objects.filter(pk=Sale.objects.earliest('id').pk).update(seller_name=None)
+        for name in ('sales_report_pdf', 'sale_receipts_pdf'):
+            with self.subTest(name):
+                self.assertTrue(self.download(name).pages)
+
+    def test_invalid_dates_are_rejected(self):
+        response = self.client.get(reverse('sales_report_pdf'), {'start_date': 'soon', 'end_date': 'later'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_report_streams_from_the_async_view(self):
+        # The async client sends ASGI requests, as uvicorn does
+        response = await self.async_client.get(reverse('sales_report_pdf'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        report = PdfReader(io.BytesIO(b''.join([chunk async for chunk in response.streaming_content])))
+        self.assertIn('Seller 119', ''.join(page.extract_text() for page in report.pages))
+
+    async def test_sale_pages_under_asgi(self):
+        sale = await Sale.objects.alatest('id')
+        response = await self.async_client.get(reverse('sale_list'))
+        self.assertContains(response, reverse('sale_detail', args=[sale.id]))
+        response = await self.async_client.get(reverse('sale_detail', args=[sale.id]))
+        self.assertContains(response, 'Lace')
+
+
+@override_settings(POS_TERMINAL_TOKENS=['terminal-1'])
+class SaleBatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.chips, cls.soda = create_products('Chips', 'Soda')
+
+    def setUp(self):
+        self.client = self.client_class(enforce_csrf_checks=True)
+
+    def post(self, payload, token='terminal-1'):
+        headers = {'Authorization': f'Bearer {token}'} if token else {}
+        return self.client.post(
+            reverse('sale_batch'), json.dumps(payload), content_type='application/json', headers=headers,
+        )
+
+    def sale(self, key, *lines, **extra):
+        return {
+            'idempotency_key': key, 'seller_name': 'Terminal 1',
+            'items': [{'product': product.pk, 'quantity': quantity} for product, quantity in lines],
+            **extra,
+        }
+
+    def results(self, *sales):
+        response = self.post({'sales': list(sales)})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results']
+
+    def quantity(self, product):
+        product.refresh_from_db()
+        return product.quantity
+
+    def test_records_the_batch_without_a_csrf_token(self):
+        results = self.results(self.sale('a', (self.chips, 2), (self.soda, 1)), self.sale('b', (self.chips, 3)))
+
+        self.assertEqual([result['status'] for result in results], ['created', 'created'])
+        first = Sale.objects.get(pk=results[0]['sale_id'])
+        self.assertEqual(first.total_amount, 30)
+        self.assertEqual(first.items.count(), 2)
+        self.assertEqual(self.quantity(self.chips), 5)
+        self.assertEqual(self.quantity(self.soda), 9)
+        self.assertEqual(ProductStockUpdate.objects.filter(product=self.chips).count(), 2)
+
+    def test_terminal_token_is_required(self):
+        for token in (None, 'wrong'):
+            response = self.post({'sales': [self.sale('a', (self.chips, 1))]}, token=token)
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+        self.assertFalse(Sale.objects.exists())
+
+    def test_replayed_keys_are_duplicates(self):
+        created, = self.results(self.sale('a', (self.chips, 2)))
+        replayed, repeated = self.results(self.sale('a', (self.chips, 2)), self.sale('a', (self.chips, 2)))
+
+        self.assertEqual(replayed, {'idempotency_key': 'a', 'status': 'duplicate', 'sale_id': created['sale_id']})
+        self.assertEqual(repeated, replayed)
+        self.assertEqual(Sale.objects.count(), 1)
+        self.assertEqual(self.quantity(self.chips), 8)
+
+    def test_invalid_sales_are_rejected_without_affecting_the_rest(self):
+        results = self.results(
+            self.sale('a', (self.chips, 0)),
+            {'idempotency_key': 'b', 'seller_name': 'Terminal 1', 'items': [{'product': 999999, 'quantity': 1}]},
+            self.sale('c', (self.soda, 1)),
+            {'seller_name': '', 'items': []},
+            self.sale('e', (self.soda, 1), sold_at='yesterday'),
+        )
+
+        self.assertEqual(
+            [result['status'] for result in results], ['rejected', 'rejected', 'created', 'rejected', 'rejected']
+        )
+        self.assertEqual(results[0]['errors'], ["Item 1: 'quantity' must be greater than zero."])
+        self.assertEqual(results[1]['errors'], ["Product with ID 999999 not found"])
+        self.assertEqual(len(results[3]['errors']), 3)
+        self.assertEqual(results[4]['errors'], ["'sold_at' must be an ISO 8601 date and time."])
+        self.assertEqual(self.quantity(self.soda), 9)
+
+    def test_custom_bulk_minimum_must_be_positive(self):
+        sale = self.sale('a', (self.chips, 1))
+        sale['items'][0].update(sale_type='bulk', custom_bulk_minimum=0)
+        result, = self.results(sale)
+        self.assertEqual(result['errors'], ["Item 1: 'custom_bulk_minimum' must be a positive number."])
+
+    def test_stock_is_checked_across_the_batch(self):
+        results = self.results(
+            self.sale('a', (self.chips, 6)),
+            self.sale('b', (self.chips, 6), (self.soda, 1)),
+            self.sale('c', (self.chips, 4)),
+        )
+
+        self.assertEqual([result['status'] for result in results], ['created', 'rejected', 'created'])
+        self.assertEqual(results[1]['errors'], ["Not enough stock for Chips: Available: 4, Needed: 6"])
+        self.assertEqual(self.quantity(self.chips), 0)
+        self.assertEqual(self.quantity(self.soda), 10)
+
+    def test_sales_keep_the_time_the_terminal_made_them(self):
+        now = timezone.now()
+        sold_at = (now - timedelta(hours=30)).replace(microsecond=0)
+        results = self.results(
+            self.sale('past', (self.chips, 1), sold_at=sold_at.isoformat()),
+            self.sale('future', (self.chips, 1), sold_at=(now + timedelta(days=1)).isoformat()),
+            self.sale('ancient', (self.chips, 1), sold_at='2001-01-01T12:00:00'),
+            self.sale('unstamped', (self.chips, 1)),
+        )
+        sale_dates = dict(Sale.objects.filter(pk__in=[r['sale_id'] for r in results]).values_list('pk', 'sale_date'))
+        past, future, ancient, unstamped = (sale_dates[result['sale_id']] for result in results)
+
+        self.assertEqual(past, sold_at)
+        self.assertLessEqual(future, timezone.now())
+        self.assertGreaterEqual(future, now)
+        self.assertAlmostEqual(ancient, now - MAX_SALE_AGE, delta=timedelta(minutes=1))
+        self.assertGreaterEqual(unstamped, now)
+
+    def test_back_dated_sales_keep_the_stock_of_past_statements(self):
+        today = timezone.localdate()
+        yesterday = InventoryStatement.objects.create(date=today - timedelta(days=1), total_products_in_stock=20)
+        item = yesterday.items.create(product=self.chips, opening_stock=10, closing_stock=10)
+        ProductStockUpdate.objects.create(product=self.chips, quantity_change=50, notes="Delivery")
+
+        now = timezone.now()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.results(
+                self.sale('a', (self.chips, 1), sold_at=(now - timedelta(days=1)).isoformat()),
+                self.sale('b', (self.chips, 2), sold_at=(now - timedelta(days=2)).isoformat()),
+            )
+        for job in Job.objects.filter(name='statement.apply_pending_sales'):
+            apply_pending_sales(**job.payload)
+
+        item.refresh_from_db()
+        self.assertEqual((item.opening_stock, item.invoiced_stock, item.closing_stock), (10, 1, 10))
+        yesterday.refresh_from_db()
+        self.assertEqual(
+            (yesterday.total_products_sold, yesterday.total_income, yesterday.total_products_in_stock), (1, 10, 20)
+        )
+        # Without a statement, the day is left to backfill_statements
+        self.assertFalse(InventoryStatement.objects.filter(date=today - timedelta(days=2)).exists())
+
+    def test_malformed_batches_are_refused(self):
+        for payload in ([], {'sales': []}, {'sales': 'a'}, {'sales': [{}] * (MAX_BATCH_SIZE + 1)}):
+            self.assertEqual(self.post(payload).status_code, 400)
+        response = self.client.post(
+            reverse('sale_batch'), 'not json', content_type='application/json',
+            headers={'Authorization': 'Bearer terminal-1'},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Sale.objects.exists())
+
+
+class ConcurrentSaleIdempotencyTests(TransactionTestCase):
+    # An in-memory SQLite database takes one writer at a time, as in run_checkout_load;
+    # the replays still race past the form and fail on the key's unique constraint
+    def test_parallel_duplicate_submissions_record_one_sale(self):
+        product, = create_products('Chips')
+        data = sale_form_data([(product, 3)], idempotency_key='double-click')
+        barrier = threading.Barrier(5)
+        one_at_a_time = (
+            threading.Lock() if connection.vendor == 'sqlite' and connection.is_in_memory_db()
+            else contextlib.nullcontext()
+        )
+        locations = []
+
+        def submit():
+            try:
+                barrier.wait()
+                with one_at_a_time:
+                    response = self.client_class().post(reverse('sale_create'), data)
+                locations.append(response.headers.get('Location'))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=submit) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sale = Sale.objects.get()
+        self.assertEqual(SaleIdempotencyKey.objects.get().sale, sale)
+        self.assertEqual(locations, [reverse('sale_detail', args=[sale.id])] * 5)
+        product.refresh_from_db()
+        self.assertEqual(product.quantity, 7)
+
+
+class CheckoutLoadTests(TransactionTestCase):
+    # Runs on SQLite too, one sale at a time on an in-memory database; see sales/loadtest.py
+    def test_concurrent_checkouts_never_oversell(self):
+        products = create_products('Hot 0', 'Hot 1', 'Hot 2', quantity=30)
+
+        # Demand is well above the stock, so some sales must be refused
+        result = run_checkout_load(products, workers=6, sales_per_worker=8, basket_size=2)
+
+        self.assertEqual(result['errors'], 0)
+        self.assertGreater(result['rejected'], 0)
+        self.assertEqual(result['recorded'], Sale.objects.count())
+        self.assertEqual(stock_violations({product.pk: 30 for product in products}), [])
+
+    def test_concurrent_checkouts_on_sharded_stock_never_oversell(self):
+        products = create_products('Hot 0', 'Hot 1', 'Hot 2', quantity=30)
+        for product in products:
+            enable_sharding(product.pk, 4)
+
+        result = run_checkout_load(products, workers=6, sales_per_worker=8, basket_size=2)
+
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['recorded'], Sale.objects.count())
+        self.assertEqual(stock_violations({product.pk: 30 for product in products}), [])
@@ -1,11 +1,14 @@
 from django.urls import path
-from .views import sale_create, sale_list, sale_detail, generate_receipt
+from .views import sale_create, sale_batch, sale_list, sale_detail, generate_receipt, sale_receipts_pdf, sales_report_pdf
 
 
 urlpatterns = [
      # Sale URLs
     path('sales/create/', sale_create, name='sale_create'),
+    path('sales/batch/', sale_batch, name='sale_batch'),
     path('sales/', sale_list, name='sale_list'),
     path('sales/<int:sale_id>/', sale_detail, name='sale_detail'),
     path('sales/<int:sale_id>/receipt/', generate_receipt, name='generate_receipt'),
+    path('sales/receipts/', sale_receipts_pdf, name='sale_receipts_pdf'),
+    path('sales/report/', sales_report_pdf, name='sales_report_pdf'),
 ]
@@ -1,168 +1,162 @@
-from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse
-from django.db import transaction
-from django.template.loader import render_to_string
-from xhtml2pdf import pisa
+import hmac
+import json
+import tempfile
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.shortcuts import aget_object_or_404, render, get_object_or_404, redirect
+from django.http import FileResponse, HttpResponse, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+from django.db import IntegrityError, transaction
 from django.core.exceptions import ValidationError
 from django.contrib import messages
 from django.db.models import Q
-from django.core.paginator import Paginator
-from products.models import Product
+from django.utils import timezone
+from django.utils.text import slugify
+from inventory.blocking import run_blocking
+from inventory.dashboard import dashboard_changed
+from inventory.pagination import KeysetPaginator
+from products.stock import atomic_with_retry, reserve_stock
 from sales.forms import SaleForm, SaleItemFormSet
-from sales.models import Sale, SaleItem
-from statement.models import ProductStockUpdate
+from sales.ingest import BatchError, record_sales
+from sales.models import Sale, SaleIdempotencyKey, SaleItem
+from sales.receipts import (
+    ReceiptError, awrite_receipts, cached_receipt, iter_receipt_sales, receipt_path, receipt_queryset, schedule_receipts,
+)
+from sales.reports import awrite_sales_report
+from statement.models import ProductDailySales, ProductStockUpdate
+from statement.tasks import schedule_statement_update
+
+# Bytes per read when streaming a PDF to an ASGI server
+PDF_CHUNK_SIZE = 64 * 1024
 
 # Sale Views
+def _record_sale(sale_form, sale_item_formset, user, idempotency_key):
+    """
+    Record the sale submitted in ``sale_form`` and ``sale_item_formset``.
+    Runs inside atomic_with_retry, so it may be rerun from the start and
+    must build all of its instances afresh.
+    """
+    # Create the sale
+    sale = Sale(seller_name=sale_form.cleaned_data['seller_name'], user=user)
+    sale.save()
+
+    # Claim the form's key before touching stock; a replayed
+    # form fails here (or waits for the original to commit)
+    if idempotency_key:
+        SaleIdempotencyKey.objects.create(key=idempotency_key, sale=sale)
+
+    # Collect all product IDs and quantities in one pass
+    product_quantities = {}
+    sale_items_data = []
+
+    for form in sale_item_formset:
+        if not form.has_changed() or not form.cleaned_data or form.cleaned_data.get('DELETE', False):
+            continue
+
+        product = form.cleaned_data.get('product')
+        quantity = form.cleaned_data.get('quantity', 0)
+        sale_type = form.cleaned_data.get('sale_type', 'regular')
+        custom_bulk_minimum = form.cleaned_data.get('custom_bulk_minimum')
+
+        if not product or not quantity:
+            continue
+
+        # Track the total quantity needed for each product
+        product_quantities[product.id] = product_quantities.get(product.id, 0) + quantity
+
+        # Store complete item data for later creation
+        sale_items_data.append({
+            'product': product,
+            'quantity': quantity,
+            'sale_type': sale_type,
+            'custom_bulk_minimum': custom_bulk_minimum
+        })
+
+    # Process products only if we have items
+    if not product_quantities:
+        return sale
+
+    # Lock the products in primary key order, check and take the stock
+    locked_products = reserve_stock(product_quantities)
+
+    # Prepare sale items for bulk creation
+    sale_items = []
+    for item_data in sale_items_data:
+        product = item_data['product']
+        sale_type = item_data['sale_type']
+        custom_bulk_minimum = item_data.get('custom_bulk_minimum')
+
+        # Additional validation for bulk purchases with the custom minimum
+        if sale_type == 'bulk' and custom_bulk_minimum is not None and custom_bulk_minimum > 0:
+            if custom_bulk_minimum < product.minimum_bulk_quantity:
+                raise ValidationError(
+                    f"Custom bulk minimum ({custom_bulk_minimum}) for {product.name} cannot be less than the product's default minimum ({product.minimum_bulk_quantity})."
+                )
+
+        # Create the sale item object (don't save yet)
+        sale_item = SaleItem(
+            sale=sale,
+            product=product,
+            quantity=item_data['quantity'],
+            sale_type=sale_type,
+            price_per_unit=SaleItem.unit_price(product, sale_type)
+        )
+        if custom_bulk_minimum is not None and custom_bulk_minimum > 0 and sale_type == 'bulk':
+            sale_item.custom_bulk_minimum = custom_bulk_minimum
+
+        sale_items.append(sale_item)
+
+    # Create all sale items in a single database query
+    SaleItem.objects.bulk_create(sale_items)
+    ProductDailySales.add_sale(sale, sale_items)
+
+    # Update sale total - use sum from python instead of another DB query
+    sale.total_amount = sum(item.quantity * item.price_per_unit for item in sale_items)
+    sale.save(update_fields=['total_amount'])
+
+    # Create stock update records in bulk
+    ProductStockUpdate.objects.bulk_create([
+        ProductStockUpdate(
+            product=locked_products[product_id],
+            quantity_change=-quantity_change,
+            notes=f"Sale ID: {sale.id} - Reduced stock by {quantity_change}"
+        )
+        for product_id, quantity_change in product_quantities.items()
+    ])
+
+    # Fold the sale into today's statement and render its receipt in the background
+    transaction.on_commit(lambda: schedule_statement_update(sale.sale_date))
+    transaction.on_commit(lambda: schedule_receipts([sale.id]))
+    dashboard_changed()
+    return sale
+
+
 def sale_create(request):
     """Create a new sale with multiple sale items - optimized version with custom bulk minimum support."""
-    products = Product.objects.filter(quantity__gt=0)
-    
     if request.method == 'POST':
         sale_form = SaleForm(request.POST)
         sale_item_formset = SaleItemFormSet(request.POST)
         
         if sale_form.is_valid() and sale_item_formset.is_valid():
+            idempotency_key = sale_form.cleaned_data.get('idempotency_key')
+            user = request.user if request.user.is_authenticated else None
             try:
-                with transaction.atomic():
-                    # Create the sale
-                    sale = sale_form.save(commit=False)
-                    sale.seller_name = sale_form.cleaned_data['seller_name']
-                    
-                    if request.user.is_authenticated:
-                        sale.user = request.user
-                    
-                    sale.save()
-                    
-                    # Collect all product IDs and quantities in one pass
-                    product_quantities = {}
-                    sale_items_data = []
-                    
-                    for form in sale_item_formset:
-                        if not form.has_changed() or not form.cleaned_data or form.cleaned_data.get('DELETE', False):
-                            continue
-                        
-                        product = form.cleaned_data.get('product')
-                        quantity = form.cleaned_data.get('quantity', 0)
-                        sale_type = form.cleaned_data.get('sale_type', 'regular')
-                        custom_bulk_minimum = form.cleaned_data.get('custom_bulk_minimum')
-                        
-                        if not product or not quantity:
-                            continue
-                            
-                        # Track the total quantity needed for each product
-                        if product.id in product_quantities:
-                            product_quantities[product.id] += quantity
-                        else:
-                            product_quantities[product.id] = quantity
-                        
-                        # Store complete item data for later creation
-                        sale_items_data.append({
-                            'product': product,
-                            'quantity': quantity,
-                            'sale_type': sale_type,
-                            'custom_bulk_minimum': custom_bulk_minimum
-                        })
-                    
-                    # Process products only if we have items
-                    if product_quantities:
-                        # Get all product IDs
-                        product_ids = list(product_quantities.keys())
-                        
-                        # Fetch all products at once with lock for update
-                        locked_products = {
-                            p.id: p for p in Product.objects.select_for_update().filter(pk__in=product_ids)
-                        }
-                        
-                        # Batch validate all stock in one pass
-                        insufficient_stock = []
-                        for product_id, needed_quantity in product_quantities.items():
-                            product = locked_products.get(product_id)
-                            if not product:
-                                raise ValidationError(f"Product with ID {product_id} not found")
-                                
-                            if product.quantity < needed_quantity:
-                                insufficient_stock.append(
-                                    f"{product.name}: Available: {product.quantity}, Needed: {needed_quantity}"
-                                )
-                        
-                        # If any product has insufficient stock, raise an error with all problematic products
-                        if insufficient_stock:
-                            raise ValidationError(
-                                f"Not enough stock for the following products:\n" + "\n".join(insufficient_stock)
-                            )
-                        
-                        # Prepare sale items for bulk creation
-                        sale_items = []
-                        for item_data in sale_items_data:
-                            product = item_data['product']
-                            product_instance = locked_products[product.id]
-                            sale_type = item_data['sale_type']
-                            quantity = item_data['quantity']
-                            custom_bulk_minimum = item_data.get('custom_bulk_minimum')
-                            
-                            # Set the price based on the sale type
-                            if sale_type == 'bulk':
-                                price_per_unit = product.bulk_price
-                                
-                                # Additional validation for bulk purchases with the custom minimum
-                                
-                                if custom_bulk_minimum is not None and custom_bulk_minimum > 0:
-                                    if custom_bulk_minimum < product.minimum_bulk_quantity:
-                                        raise ValidationError(
-                                            f"Custom bulk minimum ({custom_bulk_minimum}) for {product.name} cannot be less than the product's default minimum ({product.minimum_bulk_quantity})."
-                                        )
-                                    
-                            elif sale_type == 'dozen':
-                                price_per_unit = product.dozen_price
-                            else:
-                                price_per_unit = product.regular_price
-                            
-                            # Create the sale item object (don't save yet)
-                            sale_item = SaleItem(
-                                sale=sale,
-                                product=product,
-                                quantity=quantity,
-                                sale_type=sale_type,
-                                price_per_unit=price_per_unit
-                            )
-                            
-                            # If you want to store the custom bulk minimum in the database
-                            # Assuming you've added a custom_bulk_minimum field to the SaleItem model
-                            if custom_bulk_minimum is not None and custom_bulk_minimum > 0 and sale_type == 'bulk':
-                                sale_item.custom_bulk_minimum = custom_bulk_minimum
-                                
-                            sale_items.append(sale_item)
-                            
-                            # Update product quantity directly
-                            product_instance.quantity -= quantity
-                            
-                        # Bulk update all products at once
-                        products_to_update = list(locked_products.values())
-                        Product.objects.bulk_update(products_to_update, ['quantity'])
-                        
-                        # Create all sale items in a single database query
-                        SaleItem.objects.bulk_create(sale_items)
-                        
-                        # Update sale total - use sum from python instead of another DB query
-                        sale.total_amount = sum(item.quantity * item.price_per_unit for item in sale_items)
-                        sale.save(update_fields=['total_amount'])
-                        
-                        # Create stock update records in bulk
-                        stock_updates = []
-                        for product_id, quantity_change in product_quantities.items():
-                            product = locked_products[product_id]
-                            stock_updates.append(ProductStockUpdate(
-                                product=product,
-                                quantity_change=-quantity_change,
-                                notes=f"Sale ID: {sale.id} - Reduced stock by {quantity_change}"
-                            ))
-                        
-                        if stock_updates:
-                            ProductStockUpdate.objects.bulk_create(stock_updates)
-                    
-                    messages.success(request, 'Sale recorded successfully!')
-                    return redirect('sale_detail', sale_id=sale.id)
-                    
+                sale = atomic_with_retry(_record_sale, sale_form, sale_item_formset, user, idempotency_key)
+                messages.success(request, 'Sale recorded successfully!')
+                return redirect('sale_detail', sale_id=sale.id)
+            except IntegrityError as e:
+                original = idempotency_key and SaleIdempotencyKey.objects.filter(
+                    key=idempotency_key
+                ).values_list('sale_id', flat=True).first()
+                if original:
+                    # A resubmission of a form that was already recorded
+                    messages.info(request, 'This sale was already recorded.')
+                    return redirect('sale_detail', sale_id=original)
+                import logging
+                logging.error(f"Error creating sale: {str(e)}", exc_info=True)
+                messages.error(request, f"An error occurred: {str(e)}")
             except ValidationError as e:
                 messages.error(request, str(e))
             except Exception as e:
@@ -184,20 +178,48 @@ def sale_create(request):
         'title': 'Create Sale',
         'sale_form': sale_form,
         'sale_item_formset': sale_item_formset,
-        'products': products,
     }
     
     return render(request, 'sales/sale_form.html', context)
 
-def sale_list(request):
-    query = request.GET.get('q', '')
-    start_date = request.GET.get('start_date', '')
-    end_date = request.GET.get('end_date', '')
+def _terminal_authorized(request):
+    """Whether the request carries one of the POS_TERMINAL_TOKENS as its bearer token."""
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return False
+    return any(
+        hmac.compare_digest(token.encode(), allowed.encode()) for allowed in settings.POS_TERMINAL_TOKENS
+    )
 
-    # Fetch sales with related items in a single query
-    sales = Sale.objects.prefetch_related('items__product').select_related('user').order_by('-sale_date')
 
-    # Filtering logic
+# Terminals authenticate with a bearer token rather than a session cookie, so
+# there is no CSRF token to check
+@csrf_exempt
+@require_POST
+def sale_batch(request):
+    """
+    Record a JSON batch of sales queued by an offline terminal:
+    ``{"sales": [{"idempotency_key", "seller_name", "sold_at", "items": [...]}, ...]}``.
+    Responds with one result per sale; replayed keys return the original sale.
+    """
+    if not _terminal_authorized(request):
+        response = JsonResponse({'error': "A valid terminal token is required."}, status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+
+    try:
+        payload = json.loads(request.body)
+        if not isinstance(payload, dict):
+            raise BatchError("Expected a JSON object with a 'sales' list.")
+        results = record_sales(payload.get('sales'))
+    except (ValueError, BatchError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse({'results': results})
+
+
+def filter_sales(sales, query, start_date, end_date):
+    """Apply the sale_list search and date range filters to ``sales``."""
     filters = Q()
     if query:
         filters |= Q(user__username__icontains=query) | Q(id__icontains=query)
@@ -205,12 +227,23 @@ def sale_list(request):
         filters &= Q(sale_date__date__range=[start_date, end_date])
     if filters:
         sales = sales.filter(filters)
+    return sales
+
+
+async def sale_list(request):
+    query = request.GET.get('q', '')
+    start_date = request.GET.get('start_date', '')
+    end_date = request.GET.get('end_date', '')
+
+    # Fetch sales with related items in a single query
+    sales = filter_sales(
+        Sale.objects.prefetch_related('items__product').select_related('user'), query, start_date, end_date
+    )
 
     # Pagination
     PAGE_SIZE = 10
-    paginator = Paginator(sales, PAGE_SIZE)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    paginator = KeysetPaginator(sales, ('-sale_date', '-id'), PAGE_SIZE)
+    page_obj = await paginator.aget_page(request.GET.get('cursor'))
 
     return render(request, 'sales/sale_list.html', {
         'title': 'Sales',
@@ -221,8 +254,8 @@ def sale_list(request):
     })
 
 
-def sale_detail(request, sale_id):
-    sale = get_object_or_404(
+async def sale_detail(request, sale_id):
+    sale = await aget_object_or_404(
         Sale.objects.select_related('user').prefetch_related('items__product'),
         id=sale_id
     )
@@ -230,21 +263,86 @@ def sale_detail(request, sale_id):
     return render(request, 'sales/sale_detail.html', {'sale': sale})
 
 
-def generate_receipt(request, sale_id):
-    sale = get_object_or_404(
-        Sale.objects.select_related('user').prefetch_related('items__product'),
-        id=sale_id
-    )
+async def generate_receipt(request, sale_id):
+    # Receipts are normally rendered in the background right after checkout
+    path = receipt_path(sale_id)
+    if path.exists():
+        await aget_object_or_404(Sale.objects.only('id'), id=sale_id)
+    else:
+        sale = await aget_object_or_404(receipt_queryset(), id=sale_id)
+        try:
+            # The sale is fully loaded, so rendering needs no queries
+            path = await run_blocking(cached_receipt, sale)
+        except ReceiptError:
+            return HttpResponse("Error generating receipt", status=500)
 
-    html = render_to_string('sales/receipt.html', {'sale': sale, 'company_name': 'Modetex'})
+    return _pdf_response(request, path.open('rb'), f"receipt_{sale_id}.pdf")
 
-    # Convert to PDF
-    response = HttpResponse(content_type='application/pdf')
-    response['Content-Disposition'] = f'attachment; filename="receipt_{sale.id}.pdf"'
 
-    pisa_status = pisa.CreatePDF(html, dest=response)
+def _export_filters(request):
+    """
+    The sales matching the sale_list filters of an export (today's when no
+    filter is given) and a description of them, or ``(None, '')`` if the
+    dates are invalid.
+    """
+    query = request.GET.get('q', '')
+    start_date = request.GET.get('start_date', '')
+    end_date = request.GET.get('end_date', '')
+    if not query and not (start_date and end_date):
+        start_date = end_date = timezone.localdate().isoformat()
+    try:
+        sales = filter_sales(Sale.objects.all(), query, start_date, end_date)
+    except ValidationError:
+        return None, ''
+
+    period = []
+    if start_date and end_date:
+        period.append(start_date if start_date == end_date else f"{start_date} to {end_date}")
+    if query:
+        period.append(f'matching "{query}"')
+    return sales, ' '.join(period)
+
 
-    if pisa_status.err:
-        return HttpResponse("Error generating receipt", status=500)
+async def _file_chunks(file):
+    while chunk := file.read(PDF_CHUNK_SIZE):
+        yield chunk
 
+
+def _pdf_response(request, file, filename):
+    response = FileResponse(file, as_attachment=True, filename=filename, content_type='application/pdf')
+    if isinstance(request, ASGIRequest):
+        # An ASGI server reads a synchronous iterator into memory in full before sending it
+        response.streaming_content = _file_chunks(file)
     return response
+
+
+async def _pdf_download(request, write, filename):
+    # Spool the document to a temporary file and stream it from there
+    output = tempfile.TemporaryFile()
+    await write(output)
+    output.seek(0)
+    return _pdf_response(request, output, filename)
+
+
+async def sale_receipts_pdf(request):
+    """Every receipt matching the sale_list filters (today's by default), as one PDF."""
+    sales, period = _export_filters(request)
+    if sales is None:
+        return HttpResponse("Invalid date range", status=400)
+    return await _pdf_download(
+        request,
+        lambda output: awrite_receipts(iter_receipt_sales(sales), output, title=f"Receipts {period}"),
+        f"receipts_{slugify(period)}.pdf",
+    )
+
+
+async def sales_report_pdf(request):
+    """End-of-day report on the sales matching the sale_list filters (today's by default)."""
+    sales, period = _export_filters(request)
+    if sales is None:
+        return HttpResponse("Invalid date range", status=400)
+    return await _pdf_download(
+        request,
+        lambda output: awrite_sales_report(sales, output, period),
+        f"sales_report_{slugify(period)}.pdf",
+    )
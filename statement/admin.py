@@ -1,6 +1,6 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
-from statement.models import InventoryStatement, InventoryStatementItem, ProductStockUpdate
+from statement.models import InventoryStatement, InventoryStatementItem, ProductDailySales, ProductStockUpdate
 
 
 @admin.register(ProductStockUpdate)
@@ -10,6 +10,20 @@ class ProductStockUpdateAdmin(admin.ModelAdmin):
     search_fields = ('product__name', 'notes')
     date_hierarchy = 'date'
     
+@admin.register(ProductDailySales)
+class ProductDailySalesAdmin(admin.ModelAdmin):
+    list_display = ('product', 'date', 'units_sold', 'regular_revenue', 'bulk_revenue', 'dozen_revenue', 'received_stock')
+    list_filter = ('date',)
+    search_fields = ('product__name',)
+    date_hierarchy = 'date'
+
+    def has_add_permission(self, request):
+        return False  # Maintained automatically; use the rebuild_daily_sales command to repair
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 class InventoryStatementItemInline(admin.TabularInline):
     model = InventoryStatementItem
     extra = 0
@@ -28,10 +42,15 @@ class InventoryStatementAdmin(admin.ModelAdmin):
     
     def regenerate_statements(self, request, queryset):
         item_count = 0
-        statement_count = queryset.count()
+        statement_count = 0
         
         for statement in queryset:
-            item_count += statement.generate_statement_items()
+            try:
+                item_count += statement.regenerate()
+            except ValueError as e:
+                self.message_user(request, str(e), messages.WARNING)
+            else:
+                statement_count += 1
             
         self.message_user(request, f"Regenerated {item_count} inventory items across {statement_count} statements.")
     
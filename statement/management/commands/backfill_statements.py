@@ -0,0 +1,190 @@
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Max, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from products.models import Product
+from sales.models import Sale, SaleItem
+from statement.models import (STATEMENT_ITEM_BATCH_SIZE, InventoryStatement, InventoryStatementItem,
+                              ProductStockUpdate, stock_remarks)
+
+# Inconsistencies listed before the command gives up
+MAX_REPORTED = 20
+
+
+class Command(BaseCommand):
+    help = (
+        "Regenerate inventory statements for a range of dates in one pass, walking backwards "
+        "from current product quantities through the recorded sales and stock updates"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', type=date.fromisoformat, required=True, help="First date (YYYY-MM-DD)")
+        parser.add_argument('--to', dest='end', type=date.fromisoformat, help="Last date (YYYY-MM-DD), defaults to today")
+        parser.add_argument('--batch-days', type=int, default=31, help="Statements written per transaction")
+
+    def handle(self, *args, **options):
+        today = timezone.localdate()
+        start, end = options['start'], options['end'] or today
+        if start > end:
+            raise CommandError("--from must not be after --to")
+        if end > today:
+            raise CommandError("--to cannot be in the future")
+
+        # Sales up to here are covered by the movements read below
+        last_sale_id = Sale.objects.aggregate(last=Max('id'))['last'] or 0
+
+        products = list(Product.objects.values_list('id', 'quantity', 'restock_level', 'created'))
+        daily = self.daily_movements(start)
+
+        problems = self.negative_stock(start, end, today, products, daily)
+        if problems:
+            listed = '\n'.join(problems[:MAX_REPORTED])
+            more = f"\n... and {len(problems) - MAX_REPORTED} more" if len(problems) > MAX_REPORTED else ''
+            raise CommandError(
+                "The recorded sales and stock updates don't add up to the current quantities; "
+                f"walking back from them gives negative stock:\n{listed}{more}"
+            )
+
+        batch = []
+        for day, closing in self.walk(start, today, products, daily):
+            if day <= end:
+                batch.append(self.build_statement(day, products, closing, daily.get(day, {})))
+                if len(batch) >= options['batch_days']:
+                    self.write_batch(batch)
+                    batch = []
+
+        if batch:
+            self.write_batch(batch)
+
+        Sale.objects.filter(
+            pk__lte=last_sale_id, sale_date__date__range=(start, end), statement_applied=False
+        ).update(statement_applied=True)
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled statements from {start} to {end}."))
+
+    def daily_movements(self, start):
+        """
+        ``{day: {product_id: (units_sold, received, removed, income)}}`` since
+        ``start``, read from the SaleItem and ProductStockUpdate rows themselves.
+
+        Sales count on the day they were made. Their own stock updates are
+        left out (they'd count the units twice, and are dated when recorded,
+        which for a replayed offline sale is a later day); every other update
+        counts as stock received or, when negative, removed.
+        """
+        daily = defaultdict(lambda: defaultdict(lambda: [0, 0, 0, 0]))
+        for product_id, day, units_sold, income in (
+            SaleItem.objects.filter(sale__sale_date__date__gte=start).order_by()
+            .values_list('product', TruncDate('sale__sale_date'))
+            .annotate(units_sold=Sum('quantity'), income=Sum(F('quantity') * F('price_per_unit')))
+        ):
+            movements = daily[day][product_id]
+            movements[0], movements[3] = units_sold, income
+
+        for product_id, day, received, removed in (
+            ProductStockUpdate.objects.filter(date__gte=start).exclude(notes__startswith='Sale ID: ').order_by()
+            .values_list('product', 'date')
+            .annotate(
+                received=Sum('quantity_change', filter=Q(quantity_change__gt=0), default=0),
+                removed=Sum(-F('quantity_change'), filter=Q(quantity_change__lt=0), default=0),
+            )
+        ):
+            movements = daily[day][product_id]
+            movements[1], movements[2] = received, removed
+
+        return {
+            day: {product_id: tuple(movements) for product_id, movements in day_movements.items()}
+            for day, day_movements in daily.items()
+        }
+
+    def walk(self, start, today, products, daily):
+        """
+        Yield each day from today back to ``start`` with the closing stock of
+        every product on that day.
+        """
+        closing = {product_id: quantity for product_id, quantity, _, _ in products}
+        day = today
+        while day >= start:
+            yield day, closing
+            # The previous day closed with this day's opening stock
+            for product_id, (units_sold, received, removed, _) in daily.get(day, {}).items():
+                if product_id in closing:
+                    closing[product_id] += units_sold - received + removed
+            day -= timedelta(days=1)
+
+    def negative_stock(self, start, end, today, products, daily):
+        """Describe every statement item in the range that would open or close below zero."""
+        created = {product_id: timezone.localdate(created) for product_id, _, _, created in products}
+        problems = []
+        for day, closing in self.walk(start, today, products, daily):
+            if day > end:
+                continue
+            day_movements = daily.get(day, {})
+            for product_id, closing_stock in closing.items():
+                if created[product_id] > day:
+                    continue
+                units_sold, received, removed, _ = day_movements.get(product_id, (0, 0, 0, 0))
+                opening_stock = closing_stock + units_sold - received + removed
+                if min(opening_stock, closing_stock) < 0:
+                    problems.append(
+                        f"{day}: product {product_id} opens with {opening_stock} and closes with {closing_stock}"
+                    )
+        return problems
+
+    def build_statement(self, day, products, closing, day_movements):
+        items = []
+        for product_id, _, restock_level, created in products:
+            if timezone.localdate(created) > day:
+                continue  # Not in the catalog yet
+            units_sold, received, removed, _ = day_movements.get(product_id, (0, 0, 0, 0))
+            closing_stock = closing[product_id]
+            # Stock taken out other than by sales (breakage, corrections) shows as variance
+            items.append(InventoryStatementItem(
+                product_id=product_id,
+                opening_stock=closing_stock + units_sold - received + removed,
+                received_stock=received,
+                invoiced_stock=units_sold,
+                closing_stock=closing_stock,
+                variance=removed,
+                remarks=stock_remarks(removed, closing_stock, closing_stock <= restock_level, restock_level),
+            ))
+
+        totals = {
+            'total_income': sum(income for _, _, _, income in day_movements.values()),
+            'total_products_sold': sum(units_sold for units_sold, _, _, _ in day_movements.values()),
+            'total_products_in_stock': sum(item.closing_stock for item in items),
+        }
+        return day, totals, items
+
+    def write_batch(self, batch):
+        dates = [day for day, _, _ in batch]
+        with transaction.atomic():
+            statements = {s.date: s for s in InventoryStatement.objects.select_for_update().filter(date__in=dates)}
+            InventoryStatement.objects.bulk_create(
+                [InventoryStatement(date=day) for day in dates if day not in statements],
+                ignore_conflicts=True,
+            )
+            statements = {s.date: s for s in InventoryStatement.objects.filter(date__in=dates)}
+
+            InventoryStatementItem.objects.filter(inventory_statement__in=statements.values()).delete()
+
+            items = []
+            for day, totals, day_items in batch:
+                statement = statements[day]
+                for name, value in totals.items():
+                    setattr(statement, name, value)
+                for item in day_items:
+                    item.inventory_statement = statement
+                items.extend(day_items)
+
+            InventoryStatement.objects.bulk_update(
+                statements.values(), ['total_income', 'total_products_sold', 'total_products_in_stock']
+            )
+            InventoryStatementItem.objects.bulk_create(items, batch_size=STATEMENT_ITEM_BATCH_SIZE)
+
+        self.stdout.write(f"{min(dates)} to {max(dates)}: {len(dates)} statements, {len(items)} items")
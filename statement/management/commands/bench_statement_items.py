@@ -0,0 +1,132 @@
+import time as timer
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from products.models import Category, Product
+from sales.models import Sale, SaleItem
+from statement.models import (InventoryStatement, InventoryStatementItem, ProductDailySales,
+                              ProductStockUpdate, stock_remarks)
+
+
+class Rollback(Exception):
+    pass
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def legacy_generate_statement_items(statement):
+    """The original per-product engine, kept here as the benchmark baseline."""
+    day_start = timezone.make_aware(datetime.combine(statement.date, time.min))
+    day_end = timezone.make_aware(datetime.combine(statement.date, time.max))
+    statement.items.all().delete()
+
+    for product in Product.objects.all():
+        closing_stock = product.quantity
+        invoiced_stock = SaleItem.objects.filter(
+            sale__sale_date__gte=day_start,
+            sale__sale_date__lte=day_end,
+            product=product
+        ).aggregate(total_sold=Sum('quantity'))['total_sold'] or 0
+        received_stock = ProductStockUpdate.objects.filter(
+            product=product,
+            date=statement.date,
+            quantity_change__gt=0
+        ).aggregate(total_received=Sum('quantity_change'))['total_received'] or 0
+        opening_stock = closing_stock + invoiced_stock - received_stock
+
+        InventoryStatementItem.objects.create(
+            inventory_statement=statement,
+            product=product,
+            opening_stock=opening_stock,
+            received_stock=received_stock,
+            invoiced_stock=invoiced_stock,
+            closing_stock=closing_stock,
+            variance=0,
+            remarks=stock_remarks(0, closing_stock, product.needs_restock, product.restock_level)
+        )
+
+    return statement.items.count()
+
+
+def snapshot(statement):
+    return sorted(statement.items.values_list(
+        'product_id', 'opening_stock', 'received_stock', 'invoiced_stock',
+        'closing_stock', 'variance', 'remarks'
+    ))
+
+
+class Command(BaseCommand):
+    help = "Benchmark InventoryStatement.generate_statement_items against catalog size (changes are rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[250, 500, 1000, 2000, 4000, 8000])
+        parser.add_argument('--skip-legacy', action='store_true', help="Only time the set-based engine")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'products':>9} {'engine':>8} {'queries':>8} {'seconds':>9}")
+        for size in options['sizes']:
+            try:
+                with transaction.atomic():
+                    self.run_size(size, options['skip_legacy'])
+                    raise Rollback
+            except Rollback:
+                pass
+
+    def run_size(self, size, skip_legacy):
+        statement = self.populate(size)
+
+        results = {}
+        engines = [('set', InventoryStatement.generate_statement_items)]
+        if not skip_legacy:
+            engines.insert(0, ('legacy', legacy_generate_statement_items))
+
+        for name, engine in engines:
+            queries = QueryCounter()
+            with connection.execute_wrapper(queries):
+                started = timer.perf_counter()
+                engine(statement)
+                elapsed = timer.perf_counter() - started
+            results[name] = snapshot(statement)
+            self.stdout.write(f"{size:>9} {name:>8} {queries.count:>8} {elapsed:>9.3f}")
+
+        if 'legacy' in results and results['legacy'] != results['set']:
+            self.stderr.write(self.style.ERROR(f"Output mismatch for {size} products"))
+
+    def populate(self, size):
+        category = Category.objects.create(name='Benchmark', slug='benchmark')
+        Product.objects.bulk_create([
+            Product(
+                category=category, name=f'Bench product {i}', slug=f'bench-product-{i}',
+                regular_price=10, bulk_price=8, dozen_price=9,
+                quantity=100 + i % 50, restock_level=110, needs_restock=100 + i % 50 <= 110,
+            )
+            for i in range(size)
+        ], batch_size=1000)
+        products = list(Product.objects.filter(category=category).only('id'))
+
+        # Already applied: the set-based engine leaves pending sales to apply_pending_sales
+        sale = Sale.objects.bulk_create([Sale(seller_name='Benchmark', statement_applied=True)])[0]
+        SaleItem.objects.bulk_create([
+            SaleItem(sale=sale, product=product, quantity=1 + i % 3, price_per_unit=10)
+            for i, product in enumerate(products) if i % 2 == 0
+        ], batch_size=1000)
+        ProductStockUpdate.objects.bulk_create([
+            ProductStockUpdate(product=product, quantity_change=5)
+            for i, product in enumerate(products) if i % 5 == 0
+        ], batch_size=1000)
+
+        ProductDailySales.rebuild(timezone.localdate(), timezone.localdate())
+
+        statement, _ = InventoryStatement.objects.get_or_create(date=timezone.localdate())
+        return statement
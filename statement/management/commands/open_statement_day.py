@@ -0,0 +1,34 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from statement.models import InventoryStatement
+from statement.tasks import schedule_day_open
+
+
+class Command(BaseCommand):
+    help = (
+        "Create and populate the day's inventory statement (safe to rerun), and queue "
+        "the run_jobs worker to open each following day's just after midnight"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=date.fromisoformat, help="Day to open (YYYY-MM-DD), defaults to today")
+        parser.add_argument('--no-schedule', action='store_true', help="Don't queue the next day's opening (e.g. when run from cron)")
+
+    def handle(self, *args, **options):
+        day = options['date'] or timezone.localdate()
+        try:
+            statement, generated = InventoryStatement.open_day(day)
+        except ValueError as e:
+            raise CommandError(e)
+        if generated:
+            self.stdout.write(self.style.SUCCESS(f"Opened the statement for {day} with {statement.items.count()} items."))
+        else:
+            self.stdout.write(f"The statement for {day} was already open.")
+
+        if not options['no_schedule']:
+            next_day = max(day, timezone.localdate()) + timedelta(days=1)
+            schedule_day_open(next_day)
+            self.stdout.write(f"Queued the opening of {next_day}.")
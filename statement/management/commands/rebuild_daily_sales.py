@@ -0,0 +1,40 @@
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from sales.models import Sale
+from statement.models import ProductDailySales, ProductStockUpdate
+
+
+class Command(BaseCommand):
+    help = "Rebuild the ProductDailySales rollup from the raw sales and stock updates"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', type=date.fromisoformat, help="First date (YYYY-MM-DD), defaults to the earliest sale")
+        parser.add_argument('--to', dest='end', type=date.fromisoformat, help="Last date (YYYY-MM-DD), defaults to today")
+        parser.add_argument('--chunk-days', type=int, default=31, help="Days rebuilt per transaction")
+
+    def handle(self, *args, **options):
+        end = options['end'] or timezone.localdate()
+        start = options['start'] or self.earliest_date() or end
+        if start > end:
+            raise CommandError("--from must not be after --to")
+
+        chunk = timedelta(days=options['chunk_days'])
+        total = 0
+        while start <= end:
+            chunk_end = min(start + chunk - timedelta(days=1), end)
+            rows = ProductDailySales.rebuild(start, chunk_end)
+            total += rows
+            self.stdout.write(f"{start} to {chunk_end}: {rows} rows")
+            start = chunk_end + timedelta(days=1)
+
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {total} daily sales rows."))
+
+    def earliest_date(self):
+        first_sale = Sale.objects.aggregate(first=Min('sale_date'))['first']
+        first_update = ProductStockUpdate.objects.aggregate(first=Min('date'))['first']
+        dates = [d for d in (first_sale and timezone.localdate(first_sale), first_update) if d]
+        return min(dates) if dates else None
@@ -0,0 +1,34 @@
+# Generated by Django 5.1.5 on 2026-10-18 01:36
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_alter_product_dozen_price_and_more'),
+        ('statement', '0002_productstockupdate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductDailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('units_sold', models.PositiveIntegerField(default=0)),
+                ('regular_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('bulk_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('dozen_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('received_stock', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='products.product')),
+            ],
+            options={
+                'verbose_name': 'Product Daily Sales',
+                'verbose_name_plural': 'Product Daily Sales',
+                'indexes': [models.Index(fields=['date'], name='statement_p_date_b01751_idx')],
+                'constraints': [models.UniqueConstraint(fields=('product', 'date'), name='unique_product_daily_sales')],
+            },
+        ),
+    ]
@@ -1,8 +1,23 @@
-from django.db import models
-from django.db.models import Sum
-from datetime import datetime, time
+from django.db import connection, models, transaction
+from django.db.models import Case, DecimalField, Exists, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+from inventory.mixins import ChangeTrackingMixin
 from products.models import Product
-from sales.models import SaleItem
+from sales.models import Sale, SaleItem
+
+# Number of statement items written per INSERT when (re)generating a statement
+STATEMENT_ITEM_BATCH_SIZE = 500
+
+
+def stock_remarks(variance, closing_stock, needs_restock, restock_level):
+    """Return the remarks text shown for a statement item."""
+    if variance != 0:
+        return "Variance detected"
+    elif needs_restock or closing_stock <= restock_level:
+        return "Restock needed"
+    return "Normal"
+
 
 class ProductStockUpdate(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='stock_updates')
@@ -14,10 +29,161 @@ class ProductStockUpdate(models.Model):
         return f"{self.product.name} - {self.quantity_change} on {self.date}"
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        # Update product quantity after saving stock update
-        if self.quantity_change != 0:
-            self.product.update_quantity(self.quantity_change)
+        adding = self._state.adding
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Update product quantity after saving stock update
+            if self.quantity_change != 0:
+                self.product.update_quantity(self.quantity_change)
+            if adding and self.quantity_change > 0:
+                ProductDailySales.add(self.date, [{'product_id': self.product_id, 'received_stock': self.quantity_change}])
+
+
+class ProductDailySales(models.Model):
+    """
+    Per product, per day rollup of sales and received stock.
+
+    Kept up to date as sales and stock updates are recorded (and as sale
+    items are edited or deleted; see statement.signals), so statements and
+    reports read one row per product instead of scanning every SaleItem.
+    Use ``manage.py rebuild_daily_sales`` to backfill or repair it.
+    """
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    date = models.DateField()
+    units_sold = models.PositiveIntegerField(default=0)
+    regular_revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    bulk_revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    dozen_revenue = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    received_stock = models.PositiveIntegerField(default=0)
+
+    COUNTERS = ['units_sold', 'regular_revenue', 'bulk_revenue', 'dozen_revenue', 'received_stock']
+
+    class Meta:
+        verbose_name = 'Product Daily Sales'
+        verbose_name_plural = 'Product Daily Sales'
+        indexes = [models.Index(fields=['date'])]
+        constraints = [models.UniqueConstraint(fields=['product', 'date'], name='unique_product_daily_sales')]
+
+    def __str__(self):
+        return f"{self.product.name} - {self.date}"
+
+    @property
+    def revenue(self):
+        return self.regular_revenue + self.bulk_revenue + self.dozen_revenue
+
+    @classmethod
+    def add(cls, date, rows):
+        """
+        Add to the counters of ``date`` for each row, a dict with a
+        ``product_id`` and any of the COUNTERS, creating missing rows.
+
+        Uses INSERT ... ON CONFLICT DO UPDATE, so concurrent writers never
+        lose increments.
+        """
+        if not rows:
+            return
+
+        qn = connection.ops.quote_name
+        table = qn(cls._meta.db_table)
+        fields = [cls._meta.get_field(name) for name in ['product', 'date'] + cls.COUNTERS]
+        columns = [qn(field.column) for field in fields]
+        counters = columns[2:]
+
+        sql = (
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+            f"ON CONFLICT ({columns[0]}, {columns[1]}) DO UPDATE SET "
+            + ', '.join(f"{column} = {table}.{column} + EXCLUDED.{column}" for column in counters)
+        )
+        params = [
+            [row['product_id'], connection.ops.adapt_datefield_value(date)]
+            + [
+                field.get_db_prep_save(row.get(field.name, 0), connection)
+                for field in fields[2:]
+            ]
+            for row in rows
+        ]
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+
+    @classmethod
+    def subtract(cls, date, row):
+        """Take a row's counters (see ``add``) back out of the counters of ``date``."""
+        counters = {name: F(name) - value for name, value in row.items() if name != 'product_id'}
+        cls.objects.filter(product_id=row['product_id'], date=date).update(**counters)
+
+    @classmethod
+    def add_sale(cls, sale, sale_items):
+        """Add a recorded sale's items to the rollup of the sale's day."""
+        cls.add_sales([(sale, sale_items)])
+
+    @classmethod
+    def add_sales(cls, sales):
+        """Add ``(sale, sale_items)`` pairs to the rollup, one statement per sale day."""
+        days = {}
+        for sale, sale_items in sales:
+            rows = days.setdefault(timezone.localdate(sale.sale_date), {})
+            for item in sale_items:
+                row = rows.setdefault(item.product_id, {'product_id': item.product_id, 'units_sold': 0})
+                row['units_sold'] += item.quantity
+                revenue_field = f'{item.sale_type}_revenue'
+                row[revenue_field] = row.get(revenue_field, 0) + item.quantity * item.price_per_unit
+        for day, rows in days.items():
+            cls.add(day, list(rows.values()))
+
+    @classmethod
+    def rebuild(cls, start, end):
+        """Recompute the rollup for the dates from ``start`` to ``end`` (inclusive)."""
+        rows = {}
+
+        revenue = F('quantity') * F('price_per_unit')
+        sales = (
+            SaleItem.objects.filter(sale__sale_date__date__range=(start, end)).order_by()
+            .values('product', day=TruncDate('sale__sale_date'))
+            .annotate(
+                units_sold=Sum('quantity'),
+                regular_revenue=Sum(revenue, filter=Q(sale_type='regular')),
+                bulk_revenue=Sum(revenue, filter=Q(sale_type='bulk')),
+                dozen_revenue=Sum(revenue, filter=Q(sale_type='dozen')),
+            )
+        )
+        for row in sales:
+            key = row.pop('product'), row.pop('day')
+            rows[key] = {name: value or 0 for name, value in row.items()}
+
+        received = (
+            ProductStockUpdate.objects.filter(date__range=(start, end), quantity_change__gt=0).order_by()
+            .values('product', 'date')
+            .annotate(received_stock=Sum('quantity_change'))
+        )
+        for row in received:
+            rows.setdefault((row['product'], row['date']), {})['received_stock'] = row['received_stock']
+
+        with transaction.atomic():
+            cls.objects.filter(date__range=(start, end)).delete()
+            cls.objects.bulk_create(
+                [cls(product_id=product_id, date=day, **counters) for (product_id, day), counters in rows.items()],
+                batch_size=STATEMENT_ITEM_BATCH_SIZE,
+            )
+
+        return len(rows)
+
+def require_current_day(date):
+    """
+    Raise ValueError if ``date`` has passed. A statement's stock columns are
+    read from the current product quantities, which only describe today;
+    past days are rebuilt with ``manage.py backfill_statements``.
+    """
+    if date < timezone.localdate():
+        raise ValueError(f"{date} has passed; use backfill_statements to build its statement")
+
+
+# Statements created by the day-open job rather than by hand
+DAY_OPEN_DEFAULTS = {
+    'company_name': 'Your Company',
+    'prepared_by': 'System',
+    'notes': 'Automatically generated daily statement',
+}
+
 
 class InventoryStatement(models.Model):
     date = models.DateField(unique=True)
@@ -38,85 +204,303 @@ class InventoryStatement(models.Model):
         return f"Inventory Statement - {self.date}"
 
     def generate_statement_items(self):
-        today = self.date
-        self.items.all().delete()
+        """Rebuild this statement's items from current product stock.
+
+        Invoiced and received stock are read for the whole catalog from the
+        ProductDailySales rollup, and the items are written with bulk_create,
+        so the number of queries does not grow with the number of products.
+        Sales not yet marked ``statement_applied`` are left out, as if they
+        had not happened yet (their units are still in the closing stock);
+        see ``_daily_sales``.
+        """
+        items = self._build_items()
+
+        with transaction.atomic():
+            self.items.all().delete()
+            InventoryStatementItem.objects.bulk_create(items, batch_size=STATEMENT_ITEM_BATCH_SIZE)
+
+        return len(items)
+
+    def _daily_sales(self):
+        """
+        The day's ProductDailySales rows, less the sales not yet folded into
+        the statement (``pending_units`` and ``pending_income``).
+
+        Those sales are added by ``apply_pending_sales``. Reading the rollup
+        and the pending sales in the same query means a sale committed
+        meanwhile is either in both or in neither, so it can't be counted
+        here and then again when it is applied.
+        """
+        pending = self._pending_sale_items(OuterRef('product'))
+        units = pending.annotate(total=Sum('quantity')).values('total')
+        income = pending.annotate(total=Sum(F('quantity') * F('price_per_unit'))).values('total')
+        revenue_field = self._meta.get_field('total_income')
+        return ProductDailySales.objects.filter(date=self.date).annotate(
+            pending_units=Coalesce(Subquery(units), 0),
+            pending_income=Coalesce(Subquery(income), Value(0), output_field=DecimalField(
+                max_digits=revenue_field.max_digits, decimal_places=revenue_field.decimal_places,
+            )),
+        )
+
+    def _pending_sale_items(self, product):
+        """The day's sale items of ``product`` not yet folded into the statement, for a subquery."""
+        return (
+            SaleItem.objects.filter(product=product, sale__sale_date__date=self.date, sale__statement_applied=False)
+            .order_by().values('product')
+        )
+
+    def _build_items(self, product_ids=None):
+        """Build (unsaved) statement items for all products, or only the given ones."""
+        daily_sales = self._daily_sales()
         products = Product.objects.all()
 
-        for product in products:
-            closing_stock = product.quantity
-            today_start = datetime.combine(today, time.min)
-            today_end = datetime.combine(today, time.max)
-
-            # Get invoiced stock (sold items)
-            from sales.models import SaleItem
-            invoiced_stock = SaleItem.objects.filter(
-                sale__sale_date__gte=today_start,
-                sale__sale_date__lte=today_end,
-                product=product
-            ).aggregate(total_sold=Sum('quantity'))['total_sold'] or 0
-
-      
-            received_stock = ProductStockUpdate.objects.filter(
-                product=product,
-                date__range=(today_start.date(), today_end.date()),  # safer than exact match
-                quantity_change__gt=0
-            ).aggregate(total_received=Sum('quantity_change'))['total_received'] or 0
+        if product_ids is not None:
+            products = products.filter(pk__in=product_ids)
+            daily_sales = daily_sales.filter(product__in=product_ids)
+
+        # Get invoiced stock (sold items) and received stock per product
+        invoiced, received, pending = {}, {}, {}
+        for product_id, units_sold, received_stock, pending_units in daily_sales.values_list(
+            'product', F('units_sold') - F('pending_units'), 'received_stock', 'pending_units'
+        ):
+            invoiced[product_id] = units_sold
+            received[product_id] = received_stock
+            pending[product_id] = pending_units
 
+        items = []
+        for product_id, quantity, restock_level, needs_restock in products.values_list(
+            'id', 'quantity', 'restock_level', 'needs_restock'
+        ):
+            # The pending sales' units already left the product's quantity
+            closing_stock = quantity + pending.get(product_id, 0)
+            invoiced_stock = invoiced.get(product_id, 0)
+            received_stock = received.get(product_id, 0)
             opening_stock = closing_stock + invoiced_stock - received_stock
             variance = 0
 
-            if variance != 0:
-                remarks = "Variance detected"
-            elif product.needs_restock or closing_stock <= product.restock_level:
-                remarks = "Restock needed"
-            else:
-                remarks = "Normal"
-
-            InventoryStatementItem.objects.create(
+            items.append(InventoryStatementItem(
                 inventory_statement=self,
-                product=product,
+                product_id=product_id,
                 opening_stock=opening_stock,
                 received_stock=received_stock,
                 invoiced_stock=invoiced_stock,
                 closing_stock=closing_stock,
                 variance=variance,
-                remarks=remarks
+                remarks=stock_remarks(variance, closing_stock, needs_restock, restock_level),
+            ))
+
+        return items
+
+    def refresh_totals(self):
+        """Recompute the statement totals from the day's sales, less (and before) those still pending."""
+        day_totals = self._daily_sales().aggregate(
+            income=Sum(F('regular_revenue') + F('bulk_revenue') + F('dozen_revenue') - F('pending_income')),
+            units_sold=Sum(F('units_sold') - F('pending_units')),
+        )
+        self.total_income = day_totals['income'] or 0
+        self.total_products_sold = day_totals['units_sold'] or 0
+        self.total_products_in_stock = self._stock_total()
+        self.save(update_fields=['total_income', 'total_products_sold', 'total_products_in_stock'])
+
+    def _stock_total(self):
+        """The units in stock before the day's pending sales: the current quantities plus their units."""
+        in_stock = Product.objects.aggregate(total=Sum('quantity'))['total'] or 0
+        pending = SaleItem.objects.filter(
+            sale__sale_date__date=self.date, sale__statement_applied=False,
+        ).aggregate(total=Sum('quantity'))['total'] or 0
+        return in_stock + pending
+
+    def regenerate(self):
+        """
+        Full, on-demand rebuild of the statement items and totals. Sales
+        still waiting for ``apply_pending_sales`` are left to it.
+
+        Only today's (or a later) statement can be rebuilt; see
+        ``require_current_day``.
+        """
+        require_current_day(self.date)
+        with transaction.atomic():
+            item_count = self.generate_statement_items()
+            self.refresh_totals()
+        return item_count
+
+    @classmethod
+    def open_day(cls, date):
+        """
+        Create and populate the statement for ``date`` ahead of the day's
+        first visitor. Does nothing if it already has its items, so it is
+        safe to run repeatedly and from several workers at once.
+
+        Closing stock is read from the current product quantities, so only
+        today (or a later day) can be opened this way; see
+        ``require_current_day``.
+
+        Returns ``(statement, generated)``.
+        """
+        require_current_day(date)
+
+        with transaction.atomic():
+            statement, _ = cls.objects.get_or_create(date=date, defaults=DAY_OPEN_DEFAULTS)
+            # Serialise concurrent runs for the same day
+            statement = cls.objects.select_for_update().get(pk=statement.pk)
+            if statement.items.exists():
+                return statement, False
+
+            # Fold in every sale so far. They are marked first, since the
+            # rebuild leaves out the ones still pending
+            Sale.objects.filter(sale_date__date=date, statement_applied=False).update(statement_applied=True)
+            statement.regenerate()
+        return statement, True
+
+    @classmethod
+    def apply_pending_sales(cls, date):
+        """
+        Fold the day's sales that are not yet in its statement into it.
+
+        Only the items for the products in those sales and the statement
+        totals are adjusted, so the cost follows the basket sizes rather than
+        the catalog size. Today's statement is created (and fully generated)
+        if it does not exist yet.
+
+        A day that has passed (a sale recorded late, such as a terminal's
+        offline sale) only gets the units sold and the income added: its
+        opening and closing stock are a record of that day, which today's
+        quantities can't update. A past day without a statement is left to
+        ``backfill_statements``, and None is returned.
+        """
+        past = date < timezone.localdate()
+        with transaction.atomic():
+            if past:
+                statement = cls.objects.select_for_update().filter(date=date).first()
+                if statement is None:
+                    return None
+                created = False
+            else:
+                statement, created = cls.objects.get_or_create(date=date)
+                # Serialise concurrent runs for the same day
+                statement = cls.objects.select_for_update().get(pk=statement.pk)
+
+            sale_ids = list(
+                Sale.objects.filter(sale_date__date=date, statement_applied=False).values_list('pk', flat=True)
             )
+            if created:
+                # Marked first, so that the rebuild includes them
+                Sale.objects.filter(pk__in=sale_ids).update(statement_applied=True)
+                statement.regenerate()
+            elif sale_ids:
+                statement._apply_sales(sale_ids, stock=not past)
+                Sale.objects.filter(pk__in=sale_ids).update(statement_applied=True)
+
+        return statement
+
+    def _apply_sales(self, sale_ids, stock=True):
+        """
+        Add the given sales to the items of their products and to the totals;
+        with ``stock``, also move the items' closing stock (and the stock
+        total) to the current quantities.
+        """
+        sold = dict(
+            SaleItem.objects.filter(sale__in=sale_ids).order_by()
+            .values('product')
+            .annotate(total=Sum('quantity'))
+            .values_list('product', 'total')
+        )
+        income = Sale.objects.filter(pk__in=sale_ids).aggregate(total=Sum('total_amount'))['total'] or 0
+        units_sold = sum(sold.values())
 
-        return self.items.count()
+        totals = {
+            'total_income': F('total_income') + income,
+            'total_products_sold': F('total_products_sold') + units_sold,
+        }
+        if stock:
+            # Stock was already reduced when the sales were recorded
+            totals['total_products_in_stock'] = Product.objects.aggregate(total=Sum('quantity'))['total'] or 0
+        InventoryStatement.objects.filter(pk=self.pk).update(**totals)
 
+        if not stock:
+            items = list(self.items.filter(product_id__in=sold))
+            for item in items:
+                item.invoiced_stock += sold[item.product_id]
+            InventoryStatementItem.objects.bulk_update(items, ['invoiced_stock'])
+            return
 
-    def refresh_items(self):
-        """Refresh all inventory statement items based on current product data"""
-        items = self.items.select_related('product').all()
-        
+        items = list(self.items.filter(product_id__in=sold).select_related('product'))
         for item in items:
             product = item.product
-            
-            # Update closing stock to match current product quantity
+            item.invoiced_stock += sold[item.product_id]
             item.closing_stock = product.quantity
-            
-            # Keep the relationship: opening_stock + received_stock - invoiced_stock = closing_stock
-            # So recalculate opening stock based on this
             item.opening_stock = item.closing_stock + item.invoiced_stock - item.received_stock
-            
-            # Update remarks based on product state
-            if item.variance != 0:
-                item.remarks = "Variance detected"
-            elif product.needs_restock or product.quantity <= product.restock_level:
-                item.remarks = "Restock needed"
-            else:
-                item.remarks = "Normal"
-                
-            item.save()
-            
+            item.remarks = stock_remarks(item.variance, item.closing_stock, product.needs_restock, product.restock_level)
+        InventoryStatementItem.objects.bulk_update(
+            items, ['invoiced_stock', 'opening_stock', 'closing_stock', 'remarks']
+        )
+
+        # Products added to the catalog after the statement was generated
+        missing = set(sold) - {item.product_id for item in items}
+        if missing:
+            InventoryStatementItem.objects.bulk_create(self._build_items(missing))
+
+    def refresh_items(self, product_ids=None):
+        """
+        Refresh inventory statement items based on current product data.
+
+        All items (or only those for ``product_ids``) are rewritten by a single
+        UPDATE that reads the product columns through subqueries, so the cost
+        in queries does not depend on how many items there are.
+
+        Only today's (or a later) statement can be refreshed; see
+        ``require_current_day``.
+        """
+        require_current_day(self.date)
+        items = self.items.all()
+        if product_ids is not None:
+            items = items.filter(product_id__in=product_ids)
+
+        product = Product.objects.filter(pk=OuterRef('product_id'))
+        quantity = Subquery(product.values('quantity')[:1])
+        # As in _build_items, sales not yet applied count as not sold yet
+        pending = Coalesce(
+            Subquery(self._pending_sale_items(OuterRef('product_id')).annotate(total=Sum('quantity')).values('total')),
+            0,
+        )
+        needs_restock = Exists(product.filter(Q(needs_restock=True) | Q(quantity__lte=F('restock_level'))))
+        received = Coalesce(
+            Subquery(
+                ProductDailySales.objects.filter(product=OuterRef('product_id'), date=self.date)
+                .values('received_stock')[:1]
+            ),
+            0,
+        )
+
+        item_count = items.update(
+            # Update closing stock to match current product quantity (before pending sales)
+            closing_stock=quantity + pending,
+            # Stock received today, from the daily rollup
+            received_stock=received,
+            # Keep the relationship: opening_stock + received_stock - invoiced_stock = closing_stock
+            opening_stock=quantity + pending + F('invoiced_stock') - received,
+            # Update remarks based on product state (see stock_remarks)
+            remarks=Case(
+                When(~Q(variance=0), then=Value("Variance detected")),
+                When(needs_restock, then=Value("Restock needed")),
+                default=Value("Normal"),
+            ),
+        )
+
+        # Products added to the catalog after the statement was generated
+        if product_ids is not None:
+            missing = set(product_ids) - set(items.order_by().values_list('product_id', flat=True))
+            if missing:
+                item_count += len(InventoryStatementItem.objects.bulk_create(self._build_items(missing)))
+
         # Update statement totals
-        self.total_products_in_stock = Product.objects.aggregate(total=Sum('quantity'))['total'] or 0
+        self.total_products_in_stock = self._stock_total()
         self.save(update_fields=['total_products_in_stock'])
-        
-        return items.count()
 
-class InventoryStatementItem(models.Model):
+        return item_count
+
+
+class InventoryStatementItem(ChangeTrackingMixin, models.Model):
     inventory_statement = models.ForeignKey(InventoryStatement, related_name='items', on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     opening_stock = models.PositiveIntegerField(default=0)
@@ -140,8 +524,13 @@ class InventoryStatementItem(models.Model):
         also update the related product's quantity.
         """
         if self.pk:
-            orig = InventoryStatementItem.objects.get(pk=self.pk)
-            if orig.received_stock != self.received_stock:
+            if self.is_tracked():
+                received_changed = 'received_stock' in self.get_changed_fields()
+            else:
+                orig_received = InventoryStatementItem.objects.filter(pk=self.pk).values_list('received_stock', flat=True).first()
+                received_changed = orig_received != self.received_stock
+
+            if received_changed:
                 self.closing_stock = self.opening_stock + self.received_stock - self.invoiced_stock
                 
                 # Update product quantity if requested
@@ -150,12 +539,11 @@ class InventoryStatementItem(models.Model):
                     self.product.update_quantity(quantity_change)
                 
                 # Update remarks based on product state
-                if self.variance != 0:
-                    self.remarks = "Variance detected"
-                elif self.product.needs_restock or self.closing_stock <= self.product.restock_level:
-                    self.remarks = "Restock needed"
-                else:
-                    self.remarks = "Normal"
+                self.remarks = stock_remarks(self.variance, self.closing_stock, self.product.needs_restock, self.product.restock_level)
+
+            # Only write the columns that actually changed
+            if self.is_tracked() and 'update_fields' not in kwargs:
+                kwargs['update_fields'] = self.get_changed_fields()
         else:
             self.closing_stock = self.opening_stock + self.received_stock - self.invoiced_stock
             
@@ -1,90 +1,130 @@
-from django.db.models.signals import post_save
+from asgiref.local import Local
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
-from django.utils.timezone import now
-from .models import ProductStockUpdate, InventoryStatement, InventoryStatementItem
+from django.utils import timezone
+from inventory.dashboard import dashboard_changed
+from .models import InventoryStatement, ProductDailySales, ProductStockUpdate
 from products.models import Product
 from sales.models import Sale, SaleItem
-from django.db.models import Sum
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Create a flag to prevent signal recursion
-inventory_update_in_progress = False
-product_update_in_progress = False
+# Products waiting to be refreshed in the statements, kept per thread / async
+# context (like Django's DB connections) so concurrent requests never see or
+# suppress each other's work.
+_pending = Local()
 
-@receiver(post_save, sender=Sale)
-def update_inventory_statement(sender, instance, created, **kwargs):
-    global inventory_update_in_progress
-    
-    # Prevent signal recursion
-    if inventory_update_in_progress:
-        return
-        
-    today = now().date()
-    if instance.sale_date.date() == today:
-        try:
-            inventory_update_in_progress = True
-            
-            # Get or create today's statement
-            statement, _ = InventoryStatement.objects.get_or_create(date=today)
-            
-            # Use more efficient queries with subqueries where possible
-            statement.total_income = Sale.objects.filter(sale_date__date=today).aggregate(total=Sum('total_amount'))['total'] or 0
-            statement.total_products_sold = SaleItem.objects.filter(sale__sale_date__date=today).aggregate(total=Sum('quantity'))['total'] or 0
-            statement.total_products_in_stock = Product.objects.aggregate(total=Sum('quantity'))['total'] or 0
-            
-            # Only update the necessary fields
-            statement.save(update_fields=['total_income', 'total_products_sold', 'total_products_in_stock'])
-            
-            # Generate statement items asynchronously if possible
-            # You could use a task queue like Celery for this
-            statement.generate_statement_items()
-            
-        finally:
-            inventory_update_in_progress = False
+# Product fields that statement items are derived from
+STATEMENT_PRODUCT_FIELDS = {'quantity', 'restock_level', 'needs_restock'}
+
+# Sale item columns the ProductDailySales rollup is derived from
+ROLLUP_ITEM_FIELDS = ['sale_id', 'product_id', 'quantity', 'sale_type', 'price_per_unit']
+
+# Sales are folded into the daily statement by the background job queued in
+# sales.views.sale_create (see statement.tasks); full regeneration is on demand only.
 
 
 @receiver(post_save, sender=Product)
 def update_product_in_statements(sender, instance, **kwargs):
-    """Update inventory statement items when a product is updated"""
-    global product_update_in_progress
-    
-    # Prevent signal recursion
-    if product_update_in_progress:
+    """Queue a statement refresh for a product once the current transaction commits"""
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and not STATEMENT_PRODUCT_FIELDS.intersection(update_fields):
+        # Nothing shown on a statement changed
+        return
+
+    queue_product_refresh(instance.pk)
+
+
+def queue_product_refresh(product_id):
+    if getattr(_pending, 'product_ids', None) is None:
+        _pending.product_ids = set()
+    _pending.product_ids.add(product_id)
+    # The first callback to run refreshes every queued product, so several
+    # saves within one transaction are merged into a single refresh; the
+    # rest find nothing left to do. Products queued in a transaction that
+    # rolls back are picked up by the next commit.
+    transaction.on_commit(flush_product_refreshes)
+
+
+@receiver(post_save, sender=ProductStockUpdate)
+def update_received_stock_in_statements(sender, instance, created, **kwargs):
+    """Stock changes bypass Product.save, so queue the product's refresh here"""
+    if created:
+        queue_product_refresh(instance.product_id)
+
+
+def flush_product_refreshes():
+    """Refresh the statement items of every product queued in this context"""
+    while getattr(_pending, 'product_ids', None):
+        product_ids = _pending.product_ids
+        # Saves made while refreshing start a new batch instead of being dropped
+        _pending.product_ids = None
+        try:
+            refresh_products_in_statements(product_ids)
+        except Exception as e:
+            logger.error(f"Error updating inventory statement items for products {sorted(product_ids)}: {str(e)}")
+
+
+def refresh_products_in_statements(product_ids):
+    """
+    Update today's inventory statement items for the given products.
+
+    Past statements are a record of their day and are left alone, so a
+    product edit costs the same few queries however long its history is.
+    """
+    statement = InventoryStatement.objects.filter(date=timezone.localdate()).first()
+    if statement is not None:
+        statement.refresh_items(product_ids)
+
+
+# The checkout and the batch ingestion bulk-create their sale items and add
+# them to the ProductDailySales rollup themselves. Items saved or deleted one
+# by one (the admin, SaleItemForm, deleting a sale) are kept in step here.
+
+@receiver(pre_save, sender=SaleItem)
+def remember_stored_sale_item(sender, instance, raw=False, **kwargs):
+    """Note what the rollup holds for the item, so an edit can take it back out"""
+    if raw or instance._state.adding:
+        instance._stored_rollup_values = None
+    elif instance.is_tracked():
+        instance._stored_rollup_values = tuple(instance.get_loaded_value(name) for name in ROLLUP_ITEM_FIELDS)
+    else:
+        instance._stored_rollup_values = (
+            SaleItem.objects.filter(pk=instance.pk).values_list(*ROLLUP_ITEM_FIELDS).first()
+        )
+
+
+@receiver(post_save, sender=SaleItem)
+def update_daily_sales_for_item(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    stored = getattr(instance, '_stored_rollup_values', None)
+    current = tuple(getattr(instance, name) for name in ROLLUP_ITEM_FIELDS)
+    if stored == current:
+        return
+    if stored is not None:
+        update_daily_sales(stored, remove=True)
+    update_daily_sales(current)
+
+
+@receiver(post_delete, sender=SaleItem)
+def remove_sale_item_from_daily_sales(sender, instance, **kwargs):
+    update_daily_sales(tuple(getattr(instance, name) for name in ROLLUP_ITEM_FIELDS), remove=True)
+
+
+def update_daily_sales(values, remove=False):
+    """Add a sale item's ROLLUP_ITEM_FIELDS ``values`` to its day's rollup, or take them out"""
+    sale_id, product_id, quantity, sale_type, price_per_unit = values
+    # Still there when its items are deleted along with it
+    sale_date = Sale.objects.filter(pk=sale_id).values_list('sale_date', flat=True).first()
+    if sale_date is None:
         return
-    
-    try:
-        product_update_in_progress = True
-        
-        # Find all inventory statement items related to this product
-        statement_items = InventoryStatementItem.objects.filter(product=instance)
-        
-        for item in statement_items:
-            # Update closing stock
-            item.closing_stock = instance.quantity
-            
-            # Recalculate opening stock based on the relationship:
-            # opening_stock = closing_stock + invoiced_stock - received_stock
-            item.opening_stock = item.closing_stock + item.invoiced_stock - item.received_stock
-            
-            # Update remarks based on product's needs_restock flag
-            if item.variance != 0:
-                item.remarks = "Variance detected"
-            elif instance.needs_restock or instance.quantity <= instance.restock_level:
-                item.remarks = "Restock needed"
-            else:
-                item.remarks = "Normal"
-                
-            # Save the item without triggering other signals
-            item.save()
-            
-            # Update the parent statement totals
-            statement = item.inventory_statement
-            statement.total_products_in_stock = Product.objects.aggregate(total=Sum('quantity'))['total'] or 0
-            statement.save(update_fields=['total_products_in_stock'])
-            
-    except Exception as e:
-        logger.error(f"Error updating inventory statement items for product {instance.name}: {str(e)}")
-    finally:
-        product_update_in_progress = False
\ No newline at end of file
+    day = timezone.localdate(sale_date)
+    row = {'product_id': product_id, 'units_sold': quantity, f'{sale_type}_revenue': quantity * price_per_unit}
+    if remove:
+        ProductDailySales.subtract(day, row)
+    else:
+        ProductDailySales.add(day, [row])
+    dashboard_changed()
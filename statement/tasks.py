@@ -0,0 +1,57 @@
+import datetime
+import logging
+from datetime import timedelta
+
+from django.utils import timezone
+
+from jobs.models import Job
+from jobs.registry import register
+from .models import InventoryStatement
+
+logger = logging.getLogger(__name__)
+
+# Sales within this window are folded into the statement by a single job
+STATEMENT_UPDATE_DELAY = timedelta(seconds=60)
+# The day's statement is opened this long after local midnight
+DAY_OPEN_TIME = datetime.time(0, 1)
+
+
+def schedule_statement_update(sale_date):
+    """Queue (or coalesce into) the statement update for the sale's day."""
+    day = timezone.localdate(sale_date)
+    Job.enqueue(
+        'statement.apply_pending_sales',
+        key=day.isoformat(),
+        payload={'date': day.isoformat()},
+        delay=STATEMENT_UPDATE_DELAY,
+    )
+
+
+@register('statement.apply_pending_sales')
+def apply_pending_sales(date):
+    InventoryStatement.apply_pending_sales(datetime.date.fromisoformat(date))
+
+
+def schedule_day_open(day):
+    """Queue the opening of ``day``'s statement for just after that day starts (now if it has)."""
+    opens_at = timezone.make_aware(datetime.datetime.combine(day, DAY_OPEN_TIME))
+    Job.enqueue(
+        'statement.open_day',
+        key=day.isoformat(),
+        payload={'date': day.isoformat()},
+        delay=max(opens_at - timezone.now(), timedelta(0)),
+    )
+
+
+@register('statement.open_day')
+def open_day(date):
+    day = datetime.date.fromisoformat(date)
+    today = timezone.localdate()
+    if day < today:
+        # The worker fell behind; opening the day now would give it today's stock
+        logger.warning("Not opening the statement for %s, which has passed; see backfill_statements", day)
+        schedule_day_open(today)
+    else:
+        InventoryStatement.open_day(day)
+    # Keep the schedule going: the next day's run is queued by this one
+    schedule_day_open(max(day, today) + timedelta(days=1))
@@ -1,3 +1,558 @@
-from django.test import TestCase
+import contextlib
+import io
+import random
+import threading
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.urls import reverse
+from django.utils import timezone
+
+from jobs.models import Job
+from jobs.worker import run_pending
+from products.models import Category, Product
+from products.stock import atomic_with_retry
+from sales.loadtest import run_checkout_load, sale_form_data
+from sales.models import Sale, SaleItem
+from statement import signals
+from statement.management.commands.bench_statement_items import (
+    Command as BenchmarkCommand, legacy_generate_statement_items, snapshot,
+)
+from statement.models import InventoryStatement, InventoryStatementItem, ProductDailySales, ProductStockUpdate
+from statement.tasks import open_day as open_day_task
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DayOpenTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Drinks', slug='drinks')
+        for i in range(3):
+            Product.objects.create(
+                category=category, name=f'Juice {i}', slug=f'juice-{i}',
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=20,
+            )
+
+    def test_open_day_is_idempotent(self):
+        today = timezone.localdate()
+        statement, generated = InventoryStatement.open_day(today)
+        self.assertTrue(generated)
+        self.assertEqual(statement.items.count(), 3)
+
+        again, generated = InventoryStatement.open_day(today)
+        self.assertFalse(generated)
+        self.assertEqual(again.pk, statement.pk)
+        self.assertEqual(again.items.count(), 3)
+
+    def test_home_does_not_create_the_statement(self):
+        self.client.get(reverse('home'))
+        self.assertFalse(InventoryStatement.objects.exists())
+
+    def test_command_opens_today_and_queues_tomorrow(self):
+        call_command('open_statement_day', stdout=io.StringIO())
+        today = timezone.localdate()
+        self.assertTrue(InventoryStatement.objects.get(date=today).items.exists())
+        job = Job.objects.get(name='statement.open_day')
+        self.assertEqual(job.key, (today + timedelta(days=1)).isoformat())
+        self.assertGreater(job.run_after, timezone.now())
+
+    def test_viewing_an_empty_statement_queues_its_generation(self):
+        statement = InventoryStatement.objects.create(date=timezone.localdate())
+        Sale.objects.create(seller_name='Counter')
+
+        self.client.get(reverse('inventory_statement_detail', args=[statement.id]))
+        self.assertFalse(statement.items.exists())
+
+        run_pending()
+        self.assertEqual(statement.items.count(), 3)
+        self.assertFalse(Sale.objects.filter(statement_applied=False).exists())
+
+    def test_viewing_an_empty_past_statement_queues_nothing(self):
+        statement = InventoryStatement.objects.create(date=timezone.localdate() - timedelta(days=1))
+        response = self.client.get(reverse('inventory_statement_detail', args=[statement.id]))
+        self.assertIn('backfill_statements', [str(message) for message in response.context['messages']][0])
+        self.assertFalse(Job.objects.exists())
+
+    def test_regenerate_needs_a_post(self):
+        statement, _ = InventoryStatement.open_day(timezone.localdate())
+        statement.items.all().delete()
+        self.client.get(reverse('regenerate_inventory_statement', args=[statement.id]), {'confirm': 'yes'})
+        self.assertFalse(statement.items.exists())
+        self.client.post(reverse('regenerate_inventory_statement', args=[statement.id]))
+        self.assertEqual(statement.items.count(), 3)
+
+
+    def test_past_days_are_not_opened(self):
+        yesterday = timezone.localdate() - timedelta(days=1)
+        with self.assertRaises(ValueError):
+            InventoryStatement.open_day(yesterday)
+        with self.assertRaises(CommandError):
+            call_command('open_statement_day', '--date', yesterday.isoformat(), stdout=io.StringIO())
+        self.assertFalse(InventoryStatement.objects.exists())
+
+    def test_past_statements_are_not_regenerated(self):
+        statement = InventoryStatement.objects.create(date=timezone.localdate() - timedelta(days=1))
+        with self.assertRaises(ValueError):
+            statement.regenerate()
+        self.client.post(reverse('regenerate_inventory_statement', args=[statement.id]))
+        self.assertFalse(statement.items.exists())
+
+    def test_late_open_day_job_opens_today_and_keeps_the_schedule(self):
+        today = timezone.localdate()
+        with self.assertLogs('statement.tasks', 'WARNING'):
+            open_day_task((today - timedelta(days=1)).isoformat())
+        self.assertFalse(InventoryStatement.objects.exists())
+        self.assertEqual(
+            set(Job.objects.filter(name='statement.open_day').values_list('key', flat=True)),
+            {today.isoformat(), (today + timedelta(days=1)).isoformat()},
+        )
+
+        run_pending()
+        self.assertTrue(InventoryStatement.objects.get(date=today).items.exists())
+
+    def test_pending_sales_are_counted_once(self):
+        today = timezone.localdate()
+        product = Product.objects.earliest('id')
+        self.client.post(reverse('sale_create'), sale_form_data([(product, 2)]))
+        statement, _ = InventoryStatement.open_day(today)
+        self.assertEqual(statement.items.get(product=product).invoiced_stock, 2)
+
+        # Recorded after the statement was opened, and not yet applied by its job
+        self.client.post(reverse('sale_create'), sale_form_data([(product, 3)]))
+        statement.regenerate()
+        item = statement.items.get(product=product)
+        # Left out until applied, as if not sold yet
+        self.assertEqual((item.invoiced_stock, item.opening_stock, item.closing_stock), (2, 20, 18))
+        statement.refresh_items([product.pk])
+        item = statement.items.get(product=product)
+        self.assertEqual((item.invoiced_stock, item.opening_stock, item.closing_stock), (2, 20, 18))
+        statement.refresh_from_db()
+        self.assertEqual((statement.total_products_sold, statement.total_products_in_stock), (2, 58))
+
+        InventoryStatement.apply_pending_sales(today)
+        statement.refresh_from_db()
+        item = statement.items.get(product=product)
+        self.assertEqual((item.invoiced_stock, item.opening_stock, item.closing_stock), (5, 20, 15))
+        self.assertEqual((statement.total_products_sold, statement.total_income), (5, 50))
+
+
+
+
+
+def snapshot_item(item):
+    return (item.opening_stock, item.received_stock, item.invoiced_stock, item.closing_stock, item.remarks)
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StatementRefreshTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Pantry', slug='pantry')
+        cls.products = cls.create_products(3)
+        cls.today = timezone.localdate()
+        cls.statement, _ = InventoryStatement.open_day(cls.today)
+        # A history of past statements that a product edit must not touch
+        cls.past = [
+            InventoryStatement.objects.create(date=cls.today - timedelta(days=days)) for days in range(1, 6)
+        ]
+        InventoryStatementItem.objects.bulk_create(
+            InventoryStatementItem(inventory_statement=statement, product=product, opening_stock=30, closing_stock=30)
+            for statement in cls.past for product in cls.products
+        )
+
+    @classmethod
+    def create_products(cls, count):
+        start = Product.objects.count()
+        return [
+            Product.objects.create(
+                category=cls.category, name=f'Pantry {i}', slug=f'pantry-{i}',
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=30, restock_level=5,
+            )
+            for i in range(start, start + count)
+        ]
+
+    def test_refresh_items_takes_the_same_queries_for_any_number_of_items(self):
+        for product in self.products:
+            Product.objects.filter(pk=product.pk).update(quantity=4)
+        with self.assertNumQueries(4):
+            self.assertEqual(self.statement.refresh_items(), 3)
+
+        # New products get their items through the product save receiver
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_products(20)
+        with self.assertNumQueries(4):
+            self.assertEqual(self.statement.refresh_items(), 23)
+
+        item = self.statement.items.get(product=self.products[0])
+        self.assertEqual((item.closing_stock, item.opening_stock, item.remarks), (4, 4, "Restock needed"))
+
+    def test_product_edits_refresh_only_todays_statement(self):
+        product = self.products[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            ProductStockUpdate.objects.create(product=product, quantity_change=12)
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(6):
+            signals.refresh_products_in_statements({product.pk})
+
+        item = self.statement.items.get(product=product)
+        self.assertEqual((item.opening_stock, item.received_stock, item.closing_stock), (30, 12, 42))
+        self.assertEqual(
+            set(InventoryStatementItem.objects.filter(inventory_statement__in=self.past).values_list(
+                'opening_stock', 'received_stock', 'closing_stock',
+            )),
+            {(30, 0, 30)},
+        )
+
+    def test_applying_a_sale_touches_only_its_basket(self):
+        sold, other = self.products[0], self.products[1]
+        for catalog_size in (3, 23):
+            with self.subTest(catalog_size=catalog_size):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.create_products(catalog_size - Product.objects.count())
+                before = {item.pk: item for item in self.statement.items.all()}
+                self.assertEqual(len(before), catalog_size)
+
+                self.client.post(reverse('sale_create'), sale_form_data([(sold, 2)]))
+                with self.assertNumQueries(12):
+                    InventoryStatement.apply_pending_sales(self.today)
+
+                changed = [
+                    item.product_id for item in self.statement.items.all()
+                    if snapshot_item(item) != snapshot_item(before[item.pk])
+                ]
+                self.assertEqual(changed, [sold.pk])
+        self.assertEqual(self.statement.items.get(product=other).invoiced_stock, 0)
+        self.assertEqual(self.statement.items.get(product=sold).invoiced_stock, 4)
+
+    def test_csv_export_streams_the_items_in_two_queries(self):
+        for catalog_size in (3, 23):
+            with self.subTest(catalog_size=catalog_size):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.create_products(catalog_size - Product.objects.count())
+                with self.assertNumQueries(2):
+                    response = self.client.get(reverse('export_inventory_statement_csv', args=[self.statement.id]))
+                    lines = b''.join(response.streaming_content).decode().splitlines()
+
+                self.assertEqual(
+                    response['Content-Disposition'], f'attachment; filename="inventory_statement_{self.today}.csv"'
+                )
+                self.assertEqual(len(lines), catalog_size + 1)
+                self.assertEqual(lines[0], 'Item Code,Item Name,Opening Stock,Received Stock,'
+                                           'Invoiced Stock,Closing Stock,Variance,Remarks')
+                self.assertEqual(lines[1], f'{self.products[0].pk},Pantry 0,30,0,0,30,0,Normal')
+
+    def test_past_statements_are_not_refreshed(self):
+        with self.assertRaises(ValueError):
+            self.past[0].refresh_items()
+        self.client.post(reverse('inventory_statement_detail', args=[self.past[0].id]), {'refresh': '1'})
+        self.assertEqual(
+            set(self.past[0].items.values_list('closing_stock', flat=True)), {30},
+        )
+
+class StatementEngineTests(TestCase):
+    def test_set_based_engine_matches_the_legacy_engine(self):
+        statement = BenchmarkCommand().populate(60)
+
+        legacy_generate_statement_items(statement)
+        legacy = snapshot(statement)
+        statement.generate_statement_items()
+        self.assertEqual(snapshot(statement), legacy)
+        self.assertEqual(len(legacy), 60)
+
+    def test_benchmark_reports_no_mismatch(self):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('bench_statement_items', '--sizes', '20', '40', stdout=out, stderr=err)
+        self.assertEqual(err.getvalue(), '')
+        self.assertEqual(len(out.getvalue().splitlines()), 5)
+        self.assertFalse(Product.objects.exists())
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class DailySalesRollupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Snacks', slug='snacks')
+        cls.crisps, cls.nuts = (
+            Product.objects.create(
+                category=category, name=name, slug=name.lower(),
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=50,
+            )
+            for name in ('Crisps', 'Nuts')
+        )
+
+    def rollup(self):
+        return {
+            (row.pop('product'), row.pop('date')): row
+            for row in ProductDailySales.objects.values('product', 'date', *ProductDailySales.COUNTERS)
+        }
+
+    def record_sale(self, sale_date, *lines):
+        """Record a sale of ``(product, quantity, sale_type)`` lines as the checkout does."""
+        sale = Sale.objects.create(seller_name='Counter', sale_date=sale_date)
+        items = SaleItem.objects.bulk_create(
+            SaleItem(
+                sale=sale, product=product, quantity=quantity, sale_type=sale_type,
+                price_per_unit=SaleItem.unit_price(product, sale_type),
+            )
+            for product, quantity, sale_type in lines
+        )
+        ProductDailySales.add_sale(sale, items)
+
+    def test_add_creates_then_increments_the_day_row(self):
+        today = timezone.localdate()
+        ProductDailySales.add(today, [{'product_id': self.crisps.pk, 'units_sold': 2, 'regular_revenue': 20}])
+        ProductDailySales.add(today, [
+            {'product_id': self.crisps.pk, 'units_sold': 3, 'bulk_revenue': 24},
+            {'product_id': self.nuts.pk, 'received_stock': 6},
+        ])
+        ProductDailySales.add(today - timedelta(days=1), [{'product_id': self.crisps.pk, 'units_sold': 1}])
+
+        rollup = self.rollup()
+        self.assertEqual(len(rollup), 3)
+        crisps = rollup[self.crisps.pk, today]
+        self.assertEqual(
+            (crisps['units_sold'], crisps['regular_revenue'], crisps['bulk_revenue'], crisps['received_stock']),
+            (5, 20, 24, 0),
+        )
+        self.assertEqual(rollup[self.nuts.pk, today]['received_stock'], 6)
+        self.assertEqual(rollup[self.crisps.pk, today - timedelta(days=1)]['units_sold'], 1)
+
+    def test_repeated_sales_on_a_day_add_up(self):
+        product = self.crisps
+        self.client.post(reverse('sale_create'), sale_form_data([(product, 2)]))
+        self.client.post(reverse('sale_create'), sale_form_data([(product, 3)]))
+
+        row = ProductDailySales.objects.get(product=product, date=timezone.localdate())
+        self.assertEqual((row.units_sold, row.regular_revenue, row.revenue), (5, 50, 50))
+
+    def test_rebuild_matches_the_incremental_rollup(self):
+        now = timezone.now()
+        self.record_sale(now - timedelta(days=2), (self.crisps, 4, 'regular'), (self.nuts, 12, 'dozen'))
+        self.record_sale(now - timedelta(days=1), (self.crisps, 6, 'bulk'))
+        self.record_sale(now, (self.crisps, 1, 'regular'), (self.crisps, 6, 'bulk'))
+        self.record_sale(now, (self.nuts, 2, 'regular'))
+        ProductStockUpdate.objects.create(product=self.nuts, quantity_change=10)
+        ProductStockUpdate.objects.create(product=self.nuts, quantity_change=-3)
+        incremental = self.rollup()
+
+        ProductDailySales.objects.update(units_sold=0, regular_revenue=0, received_stock=0)
+        call_command('rebuild_daily_sales', stdout=io.StringIO())
+        self.assertEqual(self.rollup(), incremental)
+        self.assertEqual(incremental[self.crisps.pk, timezone.localdate()]['units_sold'], 7)
+        self.assertEqual(incremental[self.nuts.pk, timezone.localdate()]['received_stock'], 10)
+
+    def test_admin_edits_and_deletes_update_the_rollup(self):
+        self.record_sale(timezone.now(), (self.crisps, 4, 'regular'), (self.nuts, 1, 'regular'))
+        item = SaleItem.objects.get(product=self.crisps)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'secret'))
+
+        response = self.client.post(reverse('admin:sales_saleitem_change', args=[item.pk]), {
+            'sale': item.sale_id, 'product': self.crisps.pk, 'quantity': 6, 'sale_type': 'bulk',
+            'price_per_unit': '8.00', 'custom_bulk_minimum': '',
+        })
+        self.assertEqual(response.status_code, 302)
+        row = ProductDailySales.objects.get(product=self.crisps)
+        self.assertEqual((row.units_sold, row.regular_revenue, row.bulk_revenue), (6, 0, 48))
+        edited = self.rollup()
+        call_command('rebuild_daily_sales', stdout=io.StringIO())
+        self.assertEqual(self.rollup(), edited)
+
+        item.sale.delete()
+        self.assertEqual(
+            list(ProductDailySales.objects.values_list('units_sold', 'regular_revenue', 'bulk_revenue')),
+            [(0, 0, 0), (0, 0, 0)],
+        )
+
+class BackfillStatementTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Drinks', slug='drinks')
+        cls.product = Product.objects.create(
+            category=category, name='Juice', slug='juice', regular_price=10, bulk_price=8, dozen_price=9,
+            quantity=10, restock_level=2,
+        )
+        cls.today = timezone.localdate()
+        Product.objects.filter(pk=cls.product.pk).update(created=timezone.now() - timedelta(days=5))
+
+    def sell(self, days_ago, quantity):
+        sale = Sale.objects.create(seller_name='Counter', sale_date=timezone.now() - timedelta(days=days_ago))
+        SaleItem.objects.create(sale=sale, product=self.product, quantity=quantity, price_per_unit=10)
+        self.stock_update(0, -quantity, notes=f"Sale ID: {sale.id} - Reduced stock by {quantity}")
+
+    def stock_update(self, days_ago, quantity_change, notes=''):
+        update, = ProductStockUpdate.objects.bulk_create(
+            [ProductStockUpdate(product=self.product, quantity_change=quantity_change, notes=notes)]
+        )
+        ProductStockUpdate.objects.filter(pk=update.pk).update(date=self.today - timedelta(days=days_ago))
+
+    def backfill(self, days):
+        start = self.today - timedelta(days=days)
+        call_command('backfill_statements', '--from', start.isoformat(), stdout=io.StringIO())
+
+    def item(self, days_ago):
+        return InventoryStatementItem.objects.get(inventory_statement__date=self.today - timedelta(days=days_ago))
+
+    def test_walks_back_through_sales_and_stock_updates(self):
+        # Two days ago 3 were sold; yesterday 5 arrived and 2 were written off
+        self.sell(2, 3)
+        self.stock_update(1, 5)
+        self.stock_update(1, -2, notes='Broken')
+
+        self.backfill(2)
+
+        sold_day, yesterday, today = self.item(2), self.item(1), self.item(0)
+        self.assertEqual(
+            (sold_day.opening_stock, sold_day.received_stock, sold_day.invoiced_stock, sold_day.closing_stock),
+            (10, 0, 3, 7),
+        )
+        self.assertEqual(
+            (yesterday.opening_stock, yesterday.received_stock, yesterday.closing_stock, yesterday.variance),
+            (7, 5, 10, 2),
+        )
+        self.assertEqual(yesterday.remarks, 'Variance detected')
+        self.assertEqual((today.opening_stock, today.closing_stock), (10, 10))
+
+        statement = InventoryStatement.objects.get(date=self.today - timedelta(days=2))
+        self.assertEqual((statement.total_income, statement.total_products_sold), (30, 3))
+        self.assertFalse(Sale.objects.filter(statement_applied=False).exists())
+
+    def test_history_that_does_not_add_up_is_reported(self):
+        # More arrived yesterday than the product holds now, with nothing sold
+        self.stock_update(1, 15)
+
+        with self.assertRaisesMessage(CommandError, 'product %d opens with -5 and closes with 10' % self.product.pk):
+            self.backfill(1)
+        self.assertFalse(InventoryStatement.objects.exists())
+
+
+@skipUnlessDBFeature('has_select_for_update')
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConcurrentStatementTests(TransactionTestCase):
+    def test_concurrent_sales_are_folded_into_the_statement_once(self):
+        category = Category.objects.create(name='Hot', slug='hot')
+        products = [
+            Product.objects.create(
+                category=category, name=f'Hot {i}', slug=f'hot-{i}',
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=1000,
+            )
+            for i in range(4)
+        ]
+        today = timezone.localdate()
+        InventoryStatement.open_day(today)
+
+        # Fold sales in while they are being recorded, as the job would
+        done = threading.Event()
+
+        def fold():
+            try:
+                while not done.is_set():
+                    InventoryStatement.apply_pending_sales(today)
+            finally:
+                connection.close()
+
+        folders = [threading.Thread(target=fold) for _ in range(2)]
+        for thread in folders:
+            thread.start()
+        try:
+            result = run_checkout_load(products, workers=8, sales_per_worker=6, basket_size=2)
+        finally:
+            done.set()
+            for thread in folders:
+                thread.join()
+        InventoryStatement.apply_pending_sales(today)
+
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['recorded'], 48)
+        self.assertFalse(Sale.objects.filter(statement_applied=False).exists())
+
+        statement = InventoryStatement.objects.get(date=today)
+        sold = dict(SaleItem.objects.values_list('product').annotate(total=Sum('quantity')))
+        self.assertEqual(statement.total_income, Sale.objects.aggregate(total=Sum('total_amount'))['total'])
+        self.assertEqual(statement.total_products_sold, sum(sold.values()))
+        quantities = dict(Product.objects.values_list('pk', 'quantity'))
+        for item in statement.items.all():
+            self.assertEqual(item.invoiced_stock, sold.get(item.product_id, 0))
+            # Moved to the current quantity each time a batch of sales is applied
+            self.assertEqual(item.closing_stock, quantities[item.product_id])
+            self.assertEqual(item.opening_stock, 1000)
+
+        # The incremental statement matches a full rebuild
+        fields = ('product', 'opening_stock', 'invoiced_stock', 'closing_stock')
+        folded = sorted(statement.items.values_list(*fields))
+        totals = (statement.total_income, statement.total_products_sold, statement.total_products_in_stock)
+        statement.regenerate()
+        statement.refresh_from_db()
+        self.assertEqual(sorted(statement.items.values_list(*fields)), folded)
+        self.assertEqual((statement.total_income, statement.total_products_sold, statement.total_products_in_stock), totals)
+
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ConcurrentProductRefreshTests(TransactionTestCase):
+    """
+    Product saves and stock updates from many threads, each queueing its
+    refreshes in its own context (statement.signals._pending). Runs on SQLite
+    too, where the threads take turns: it has a single writer, and a shared
+    in-memory database refuses a second one outright.
+    """
+
+    def test_concurrent_product_edits_are_refreshed_on_commit(self):
+        category = Category.objects.create(name='Shelf', slug='shelf')
+        products = [
+            Product.objects.create(
+                category=category, name=f'Shelf {i}', slug=f'shelf-{i}',
+                regular_price=10, bulk_price=8, dozen_price=9, quantity=50, restock_level=40,
+            )
+            for i in range(3)
+        ]
+        today = timezone.localdate()
+        statement, _ = InventoryStatement.open_day(today)
+        serial = threading.Lock() if connection.vendor == 'sqlite' else None
+        start_together = threading.Barrier(6)
+        queued, flushed = [], []
+
+        def change(product_id, received, restock_level):
+            product = Product.objects.get(pk=product_id)
+            if received:
+                ProductStockUpdate.objects.create(product=product, quantity_change=received)
+            else:
+                product.restock_level = restock_level
+                product.save()
+            # Queued in this thread's context until the transaction commits
+            return product_id in (signals._pending.product_ids or ())
+
+        def edit(number):
+            rng = random.Random(number)
+            try:
+                start_together.wait()
+                for _ in range(8):
+                    args = rng.choice(products).pk, rng.choice([0, rng.randint(1, 20)]), rng.randint(0, 100)
+                    with serial or contextlib.nullcontext():
+                        queued.append(atomic_with_retry(change, *args))
+                    flushed.append(not signals._pending.product_ids)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=edit, args=(number,)) for number in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(queued), 48)
+        self.assertTrue(all(queued))
+        self.assertTrue(all(flushed))
+
+        received = dict(
+            ProductStockUpdate.objects.order_by().values_list('product').annotate(total=Sum('quantity_change'))
+        )
+        for item in statement.items.select_related('product'):
+            product = item.product
+            self.assertEqual(item.closing_stock, product.quantity)
+            self.assertEqual(item.received_stock, received.get(product.pk, 0))
+            self.assertEqual(item.opening_stock, 50)
+            self.assertEqual(item.remarks, "Restock needed" if product.quantity <= product.restock_level else "Normal")
+        statement.refresh_from_db()
+        self.assertEqual(statement.total_products_in_stock, 150 + sum(received.values()))
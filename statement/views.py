@@ -3,10 +3,10 @@ from django.db.models import Sum
 from django.utils import timezone
 from django.contrib import messages
 from django.urls import reverse
-from django.http import HttpResponse
-import csv
+from inventory.exports import queryset_rows, stream_csv
 from .models import InventoryStatement
 from .forms import InventoryStatementForm, InventoryStatementItemFormSet
+from .tasks import schedule_day_open
 
 # Inventory Statement Views
 def inventory_statement_list(request):
@@ -37,8 +37,8 @@ def create_inventory_statement(request):
             
             statement.save()
             
-            # Generate inventory statement items
-            item_count = statement.generate_statement_items()
+            # Generate inventory statement items and totals
+            item_count = statement.regenerate()
             
             messages.success(request, f'Inventory statement for {statement.date} created with {item_count} items.')
             return redirect('inventory_statement_detail', statement_id=statement.id)
@@ -57,18 +57,24 @@ def inventory_statement_detail(request, statement_id):
     """View to display a detailed inventory statement."""
     statement = get_object_or_404(InventoryStatement, id=statement_id)
     
-    # Keep your refresh logic
-    if 'refresh' in request.GET:
-        refreshed_count = statement.refresh_items()
-        messages.success(request, f'Refreshed {refreshed_count} inventory items with current product data.')
+    if request.method == 'POST' and 'refresh' in request.POST:
+        try:
+            refreshed_count = statement.refresh_items()
+        except ValueError as e:
+            messages.error(request, str(e))
+        else:
+            messages.success(request, f'Refreshed {refreshed_count} inventory items with current product data.')
         return redirect('inventory_statement_detail', statement_id=statement.id)
-    
-    # Generate statement items if needed
-    if not statement.items.exists():
-        statement.generate_statement_items()
-    
-    # Get all items
+
+    # Viewing never writes the statement: a statement without items is
+    # populated by the day-open job, which only opens today (or later)
     items = statement.items.all()
+    if not items.exists():
+        if statement.date >= timezone.localdate():
+            schedule_day_open(statement.date)
+            messages.info(request, 'The statement items are being generated. Reload the page in a moment.')
+        else:
+            messages.info(request, 'This statement has no items. Past days are rebuilt with the backfill_statements command.')
     
     # Handle filtering
     filter_type = request.GET.get('filter')
@@ -115,42 +121,30 @@ def regenerate_inventory_statement(request, statement_id):
     """Regenerate inventory statement items"""
     statement = get_object_or_404(InventoryStatement, id=statement_id)
     
-    if request.method == 'POST' or request.GET.get('confirm') == 'yes':
-        # Regenerate all statement items
-        item_count = statement.generate_statement_items()
-        messages.success(request, f'Inventory statement regenerated with {item_count} items')
-        return redirect('inventory_statement_detail', statement_id=statement.id)
-    
-    return render(request, 'inventory/regenerate_confirmation.html', {
-        'statement': statement,
-        'title': 'Regenerate Inventory Statement'
-    })
+    if request.method == 'POST':
+        # Regenerate all statement items and totals
+        try:
+            item_count = statement.regenerate()
+        except ValueError as e:
+            messages.error(request, str(e))
+        else:
+            messages.success(request, f'Inventory statement regenerated with {item_count} items')
+    return redirect('inventory_statement_detail', statement_id=statement.id)
 
 def export_inventory_statement_csv(request, statement_id):
     """Export inventory statement as CSV"""
     statement = get_object_or_404(InventoryStatement, id=statement_id)
-    items = statement.items.all()
-    
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = f'attachment; filename="inventory_statement_{statement.date}.csv"'
-    
-    writer = csv.writer(response)
-    writer.writerow(['Item Code', 'Item Name', 'Opening Stock', 'Received Stock', 
-                     'Invoiced Stock', 'Closing Stock', 'Variance', 'Remarks'])
-    
-    for item in items:
-        writer.writerow([
-            item.product.id,
-            item.product.name,
-            item.opening_stock,
-            item.received_stock,
-            item.invoiced_stock,
-            item.closing_stock,
-            item.variance,
-            item.remarks
-        ])
-    
-    return response
+    rows = queryset_rows(statement.items.all(), [
+        'product_id', 'product__name', 'opening_stock', 'received_stock',
+        'invoiced_stock', 'closing_stock', 'variance', 'remarks'
+    ])
+
+    return stream_csv(
+        f'inventory_statement_{statement.date}.csv',
+        ['Item Code', 'Item Name', 'Opening Stock', 'Received Stock',
+         'Invoiced Stock', 'Closing Stock', 'Variance', 'Remarks'],
+        rows,
+    )
 
 def export_inventory_statement_pdf(request, statement_id):
     """Export inventory statement as PDF"""